@@ -36,6 +36,7 @@ sed -i "s/\(version='\)[^'\"]\+/\1%{version}-%{release}/g" setup.py
 %doc README.md
 %doc LICENSE
 %doc CHANGES
+%{_bindir}/planex-build
 %{_bindir}/planex-cache
 %{_bindir}/planex-depend
 %{_bindir}/planex-extract
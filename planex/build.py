@@ -0,0 +1,318 @@
+"""
+planex-build: Build binary packages in critical-path order
+
+GNU make builds the binary packages in whatever order it happens to
+find them.   planex-build reads the build graph written by
+planex-depend --graph-out and always starts the package which heads the
+longest remaining chain of dependent builds, so that the packages which
+serialize the build are started as early as possible.
+"""
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+import Queue
+
+import argcomplete
+
+from planex.util import add_common_parser_options
+from planex.util import setup_logging
+from planex.util import setup_sigint_handler
+
+
+class CycleError(Exception):
+    """Exception raised when the build graph contains a cycle"""
+    pass
+
+
+def dependencies(graph):
+    """
+    Return a dictionary mapping each package in the graph to the set of
+    packages which must be built before it.
+    """
+    deps = dict((name, set()) for name in graph["nodes"])
+    for edge in graph["edges"]:
+        if edge["from"] != edge["to"] and edge["to"] in deps:
+            deps[edge["from"]].add(edge["to"])
+    return deps
+
+
+def dependents(deps):
+    """
+    Invert a dependency map, returning a dictionary mapping each package
+    to the set of packages which must be built after it.
+    """
+    result = dict((name, set()) for name in deps)
+    for name, requires in deps.items():
+        for required in requires:
+            result[required].add(name)
+    return result
+
+
+def topological_order(deps):
+    """
+    Return the packages in an order in which they can be built.
+    Raises CycleError if there is no such order.
+    """
+    waiting = dict((name, len(requires)) for name, requires in deps.items())
+    users = dependents(deps)
+    ready = sorted(name for name, count in waiting.items() if count == 0)
+    order = []
+    while ready:
+        name = ready.pop()
+        order.append(name)
+        for user in users[name]:
+            waiting[user] -= 1
+            if waiting[user] == 0:
+                ready.append(user)
+
+    if len(order) != len(deps):
+        raise CycleError("build dependency cycle among: %s" %
+                         ", ".join(sorted(set(deps) - set(order))))
+    return order
+
+
+def critical_path_lengths(deps, weights):
+    """
+    Return a dictionary mapping each package to the length of the
+    longest chain of builds which starts with it: its own weight plus
+    the longest chain of any package which depends on it.
+    """
+    users = dependents(deps)
+    lengths = {}
+    for name in reversed(topological_order(deps)):
+        lengths[name] = weights.get(name, 1.0) + max(
+            [lengths[user] for user in users[name]] or [0.0])
+    return lengths
+
+
+def mtime(path):
+    """Return the modification time of path, or None if it is missing"""
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def up_to_date(node, required_nodes):
+    """
+    Return True if the target of node is newer than its source package
+    and than the targets of the packages it requires, as make would
+    decide.
+    """
+    target_time = mtime(node["target"])
+    if target_time is None:
+        return False
+    inputs = [node["srpm"]] + [required["target"]
+                               for required in required_nodes]
+    return all((mtime(path) or 0) <= target_time for path in inputs)
+
+
+class Scheduler(object):
+    """
+    Runs package builds through a bounded pool of workers, always
+    starting the ready package with the longest critical path first.
+    """
+
+    # pylint: disable=R0902
+
+    def __init__(self, graph, args, weights):
+        self.graph = graph
+        self.args = args
+        self.deps = dependencies(graph)
+        self.users = dependents(self.deps)
+        self.priority = critical_path_lengths(self.deps, weights)
+        self.durations = {}
+        self.failed = set()
+        self.repo_lock = threading.Lock()
+        self.results = Queue.Queue()
+
+    def commands(self, name):
+        """Return the commands which build a package and publish it in
+           the local repository"""
+        node = self.graph["nodes"][name]
+        mock = [self.args.mock]
+        if self.args.configdir:
+            mock.append("--configdir=%s" % self.args.configdir)
+        mock += ["--resultdir=%s" % os.path.dirname(node["target"]),
+                 node["srpm"]]
+        createrepo = [self.args.createrepo, "--update", self.args.repo]
+        # Take the same locks around mock and createrepo as Makefile.rules
+        return (["flock", "--shared", "--timeout", "300", self.args.repo] +
+                mock,
+                ["flock", "--exclusive", "--timeout", "300",
+                 self.args.repo] + createrepo)
+
+    def build(self, name):
+        """
+        Build one package.   Runs in a worker thread, so the result is
+        always reported, even if a command cannot be run at all:
+        otherwise run would wait for it forever.
+        """
+        start = time.time()
+        success = False
+        try:
+            mock, createrepo = self.commands(name)
+            logging.info("[MOCK] %s", self.graph["nodes"][name]["srpm"])
+            success = subprocess.call(mock) == 0
+            if success:
+                logging.info("[CREATEREPO] %s", name)
+                with self.repo_lock:
+                    success = subprocess.call(createrepo) == 0
+        except OSError as exn:
+            logging.error("Could not run build command for %s: %s",
+                          name, exn)
+        finally:
+            self.results.put((name, success, time.time() - start))
+
+    def blocked(self, name):
+        """Return True if a package cannot be built because a package it
+           depends on failed"""
+        return any(required in self.failed for required in self.deps[name])
+
+    def run(self):
+        """
+        Build every out-of-date package.   Returns True if all builds
+        succeeded.
+        """
+        # pylint: disable=R0912
+
+        waiting = dict((name, set(requires))
+                       for name, requires in self.deps.items())
+        ready = [name for name, requires in waiting.items() if not requires]
+        running = 0
+
+        while ready or running:
+            # Start the ready packages with the longest chains first
+            ready.sort(key=lambda name: (-self.priority[name], name))
+            while ready and running < self.args.jobs:
+                name = ready.pop(0)
+                node = self.graph["nodes"][name]
+                required = [self.graph["nodes"][dep]
+                            for dep in self.deps[name]]
+                if self.blocked(name):
+                    self.failed.add(name)
+                    self.results.put((name, None, 0.0))
+                elif self.args.dry_run or up_to_date(node, required):
+                    if self.args.dry_run:
+                        print "%s (critical path %.1f)" % (
+                            name, self.priority[name])
+                    self.results.put((name, True, None))
+                else:
+                    thread = threading.Thread(target=self.build,
+                                              args=(name,))
+                    thread.daemon = True
+                    thread.start()
+                running += 1
+
+            name, success, duration = self.results.get()
+            running -= 1
+            if success is False:
+                logging.error("Failed to build %s", name)
+                self.failed.add(name)
+                if not self.args.keep_going:
+                    # Let the running builds finish, but start no more
+                    ready = []
+                    waiting = {}
+            if duration is not None and success:
+                self.durations[name] = duration
+
+            # Feed the finished package to the packages which need it
+            for user in self.users[name]:
+                if user in waiting:
+                    waiting[user].discard(name)
+                    if not waiting[user]:
+                        del waiting[user]
+                        ready.append(user)
+
+        return not self.failed
+
+
+def load_weights(path):
+    """Load the build durations recorded by a previous run"""
+    if path and os.path.exists(path):
+        with open(path) as timings:
+            return json.load(timings)
+    return {}
+
+
+def save_weights(path, weights, durations):
+    """Record the build durations measured by this run"""
+    if path:
+        weights.update(durations)
+        tmp_path = path + "~"
+        with open(tmp_path, "w") as timings:
+            json.dump(weights, timings, indent=2, sort_keys=True)
+        os.rename(tmp_path, path)
+
+
+def parse_args_or_exit(argv=None):
+    """
+    Parse command line options
+    """
+    parser = argparse.ArgumentParser(
+        description='Build binary packages in critical-path order')
+    add_common_parser_options(parser)
+    parser.add_argument('graph', help='Build graph written by '
+                        'planex-depend --graph-out')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                        help='Number of packages to build concurrently')
+    parser.add_argument('-k', '--keep-going', action='store_true',
+                        help='Keep building packages which do not depend '
+                        'on a failed build')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='Print the build order without building')
+    parser.add_argument('--configdir', metavar='DIR', default=None,
+                        help='Mock configuration directory')
+    parser.add_argument('--repo', metavar='DIR', default='RPMS',
+                        help='Local repository of built packages')
+    parser.add_argument('--timings', metavar='FILE', default=None,
+                        help='File in which to record build durations, '
+                        'used to weight the critical path on later runs')
+    parser.add_argument('--mock', default='planex-build-mock',
+                        help='Command used to build a source package')
+    parser.add_argument('--createrepo', default='createrepo',
+                        help='Command used to update the local repository')
+    argcomplete.autocomplete(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    """
+    Main function.  Build the packages in the graph.
+    """
+    setup_sigint_handler()
+    args = parse_args_or_exit(argv)
+    setup_logging(args)
+
+    with open(args.graph) as graph_file:
+        graph = json.load(graph_file)
+
+    weights = load_weights(args.timings)
+    try:
+        scheduler = Scheduler(graph, args, weights)
+    except CycleError as exn:
+        sys.exit("%s: %s" % (sys.argv[0], exn))
+
+    success = scheduler.run()
+    save_weights(args.timings, weights, scheduler.durations)
+    if not success:
+        sys.exit("%s: failed to build: %s" %
+                 (sys.argv[0], ", ".join(sorted(scheduler.failed))))
+
+
+def _main():
+    """
+    Entry point for setuptools CLI wrapper
+    """
+    main(sys.argv[1:])
+
+
+# Entry point when run directly
+if __name__ == "__main__":
+    _main()
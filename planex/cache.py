@@ -5,13 +5,22 @@ planex-cache: A caching wrapper around mock for building RPMs
 """
 
 import argparse
+import atexit
+import errno
+import fcntl
 import hashlib
 import itertools
+import json
 import logging
 import os
 import shutil
+import socket
 import sys
 import tempfile
+import threading
+import time
+import urlparse
+from stat import S_IMODE, S_ISDIR
 import yum
 
 import argcomplete
@@ -19,7 +28,19 @@ import rpm
 
 from planex import util
 
-PLANEX_CACHE_SALT = "planex-cache-1"
+PLANEX_CACHE_SALT = "planex-cache-2"
+
+# File written into a cache entry once all of its build products are in
+# place.   Entries without it are ignored.
+COMPLETE_MARKER = "complete"
+
+# Age in seconds after which a hidden staging or build directory in a
+# cache directory is assumed to have been left by a crashed build
+STALE_DIR_AGE = 24 * 60 * 60
+
+# Seconds to wait for the cache server to hash an SRPM, including any
+# reload of the package sack, before hashing it in-process instead
+CACHE_SERVER_TIMEOUT = 300
 
 
 def parse_args_or_exit(argv=None):
@@ -31,6 +52,13 @@ def parse_args_or_exit(argv=None):
     parser.add_argument(
         '--cachedirs', default='~/.planex-cache:/misc/cache/planex-cache',
         help='colon-separated cache search path')
+    parser.add_argument(
+        '--daemon', metavar='SOCKET', default=None,
+        help='Ask the cache server listening on SOCKET for package hashes, '
+        'loading the package sack here if there is none')
+    parser.add_argument(
+        '--serve', metavar='SOCKET', default=None,
+        help='Run a cache server on SOCKET which keeps package sacks loaded')
     # Overridden mock arguments.  Help text taken directly from mock.
     parser.add_argument(
         '--configdir', default="/etc/mock",
@@ -54,18 +82,168 @@ RFC4880_HASHES = {
     11: "SHA224"}
 
 
-def setup_yumbase(yumbase):
+# Directory holding snapshots of populated yum caches, one for each set
+# of repositories, from which each planex-cache run seeds its private
+# cache
+YUM_SNAPSHOT_ROOT = "~/.planex-yum-snapshots"
+
+
+def tree_signature(path):
+    """Return a list of the files under path with their sizes and
+       modification times, which changes when yum updates its cache"""
+    signature = []
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            stat = os.lstat(os.path.join(dirpath, filename))
+            signature.append([os.path.relpath(os.path.join(dirpath, filename),
+                                              path),
+                              stat.st_size, int(stat.st_mtime)])
+    return sorted(signature)
+
+
+def clone_tree(src, dst):
+    """
+    Reflink or copy the files under src into dst, which is created if
+    it does not exist.   Files are never hard linked, because yum
+    rewrites the files in its cache in place.
+    """
+    for dirpath, dirnames, filenames in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(dirpath, src))
+        util.makedirs(target)
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), os.path.join(target, name))
+            elif not os.path.isdir(path):
+                util.clone_file(path, os.path.join(target, name), link=False)
+
+
+def snapshot_dir_for(yumbase, snapshot_root):
+    """
+    Return the snapshot directory under snapshot_root for the
+    repositories which yumbase reads, creating it if necessary.
+    Raises OSError if the directory is not private to us, because
+    another user could plant yum metadata in it to be used in builds.
+    """
+    repos = sorted([str(repo.id), [str(url) for url in repo.baseurl]]
+                   for repo in yumbase.repos.listEnabled())
+    key = hashlib.sha256(json.dumps(repos)).hexdigest()
+    snapshot_dir = os.path.join(os.path.expanduser(snapshot_root), key)
+
+    util.makedirs(os.path.dirname(snapshot_dir))
+    try:
+        os.mkdir(snapshot_dir, 0700)
+    except OSError as exn:
+        if exn.errno != errno.EEXIST:
+            raise
+    dir_stat = os.lstat(snapshot_dir)
+    if (not S_ISDIR(dir_stat.st_mode) or dir_stat.st_uid != os.getuid() or
+            S_IMODE(dir_stat.st_mode) != 0700):
+        raise OSError(errno.EPERM, "Not a private directory", snapshot_dir)
+    return snapshot_dir
+
+
+def make_private_dir(snapshot_dir):
+    """
+    Return a new private directory in which yum can create its cache,
+    which is removed at exit.   It is made in the snapshot directory if
+    there is one, so that files can be reflinked between them.
+    """
+    private_dir = tempfile.mkdtemp(prefix="private-", dir=snapshot_dir)
+    atexit.register(shutil.rmtree, private_dir, True)
+    return private_dir
+
+
+def yum_cache_root(private_dir, cachedir):
+    """
+    Return the directory which yum created in private_dir for its
+    cache.   cachedir, yum's conf.cachedir, is the subdirectory of it
+    for the configured architecture and release.
+    """
+    relpath = os.path.relpath(cachedir, private_dir)
+    return os.path.join(private_dir, relpath.split(os.sep)[0])
+
+
+def seed_cache_dir(snapshot_dir, cache_dir):
     """
-    Set up the YUM database.
+    Seed the empty yum cache at cache_dir from the shared snapshot, if
+    there is one.
     """
-    # the following call creates a /var/tmp/yum-<username>-<random>
-    # directory to use as a cache.   reuse=True makes yum check
-    # for similarly-named directories and re-use them, which makes
-    # dependency searching much faster. However, this causes breakage
-    # for concurrent builds.
+    snapshot = os.path.join(snapshot_dir, "current")
+    try:
+        with open(os.path.join(snapshot_dir, "lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            if os.path.isdir(snapshot):
+                clone_tree(snapshot, cache_dir)
+    except (IOError, OSError) as exn:
+        # yum will populate the private cache from scratch
+        logging.debug("Could not seed yum cache from %s: %s", snapshot, exn)
+        shutil.rmtree(cache_dir, True)
+        util.makedirs(cache_dir)
+
+
+def publish_cache_dir(cache_dir, snapshot_dir):
+    """
+    Replace the shared snapshot with the yum cache at cache_dir, if it
+    has changed.   The new snapshot is cloned aside and renamed into
+    place under an exclusive lock, so runs seeding from it always see a
+    complete cache.
+    """
+    snapshot = os.path.join(snapshot_dir, "current")
+    signature_path = os.path.join(snapshot_dir, "signature.json")
+    signature = tree_signature(cache_dir)
+
+    with open(os.path.join(snapshot_dir, "lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(signature_path) as signature_file:
+                if json.load(signature_file) == signature:
+                    return
+        except (IOError, ValueError):
+            pass
+
+        staging_dir = tempfile.mkdtemp(prefix="staging-", dir=snapshot_dir)
+        clone_tree(cache_dir, os.path.join(staging_dir, "current"))
+        if os.path.isdir(snapshot):
+            os.rename(snapshot, os.path.join(staging_dir, "old"))
+        os.rename(os.path.join(staging_dir, "current"), snapshot)
+        with open(signature_path + "~", "w") as signature_file:
+            json.dump(signature, signature_file)
+        os.rename(signature_path + "~", signature_path)
+        shutil.rmtree(staging_dir, True)
+        logging.debug("Published yum cache snapshot to %s", snapshot)
 
-    yumbase.setCacheDir(force=True, reuse=True)
+
+def setup_yumbase(yumbase, snapshot_root=YUM_SNAPSHOT_ROOT):
+    """
+    Set up the YUM database.   Returns the private directory holding
+    its cache, which is removed at exit.
+    """
+    # setCacheDir creates a yum-<username>-<random> directory to use as
+    # a cache.   reuse=True would make yum re-use a similarly-named
+    # directory, which makes dependency searching much faster, but
+    # concurrent builds sharing one directory corrupt it.   So each run
+    # gets a private directory, seeded from a shared snapshot of a
+    # populated cache, and publishes its cache back.
+    try:
+        snapshot_dir = snapshot_dir_for(yumbase, snapshot_root)
+    except OSError as exn:
+        logging.warning("Not using yum cache snapshot: %s", exn)
+        snapshot_dir = None
+
+    private_dir = make_private_dir(snapshot_dir)
+    yumbase.setCacheDir(force=True, tmpdir=private_dir, reuse=False)
+    cache_dir = yum_cache_root(private_dir, yumbase.conf.cachedir)
+    if snapshot_dir:
+        seed_cache_dir(snapshot_dir, cache_dir)
     yumbase.repos.populateSack(cacheonly=True)
+    if snapshot_dir:
+        try:
+            publish_cache_dir(cache_dir, snapshot_dir)
+        except (IOError, OSError) as exn:
+            # Other runs will just have to populate their own caches
+            logging.debug("Could not publish yum cache snapshot: %s", exn)
+    return private_dir
 
 
 def load_srpm_from_file(filename):
@@ -83,16 +261,113 @@ def cache_locations(cachedirs, pkg_hash):
     return [os.path.join(x, pkg_hash) for x in cachedirs]
 
 
+def entry_complete(cache_dir):
+    """
+    Return true if the cache entry at cache_dir was completely written.
+    Entries written by older versions of planex-cache have no marker and
+    are treated as missing, because they may be only partly populated.
+    """
+    return os.path.isfile(os.path.join(cache_dir, COMPLETE_MARKER))
+
+
 def in_cache(cachedirs, pkg_hash):
     """
     Return true if build products with the given hash are in the cache
     """
-    return any(os.path.isdir(x) for x in cache_locations(cachedirs, pkg_hash))
+    return any(entry_complete(x) for x in cache_locations(cachedirs, pkg_hash))
+
+
+def fsync_path(path):
+    """Flush the file or directory at path to disk"""
+    fdesc = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fdesc)
+    finally:
+        os.close(fdesc)
+
+
+def publish_cache_entry(staging_dir, cache_dir):
+    """
+    Rename the fully populated staging_dir to cache_dir.   An incomplete
+    entry left at cache_dir by a crash or by an older planex-cache is
+    moved aside and removed first.   Returns False if a complete entry
+    was published by a racing build instead.
+    """
+    # mkdtemp made the staging directory private to us, but the entry
+    # must be as readable as any other directory we create
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(staging_dir, 0777 & ~umask)
+
+    try:
+        os.rename(staging_dir, cache_dir)
+        fsync_path(os.path.dirname(cache_dir))
+        return True
+    except OSError as exn:
+        if exn.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+            raise
+
+    if entry_complete(cache_dir):
+        return False
+
+    stale_dir = tempfile.mkdtemp(prefix=".stale-",
+                                 dir=os.path.dirname(cache_dir))
+    stale_entry = os.path.join(stale_dir, "entry")
+    try:
+        os.rename(cache_dir, stale_entry)
+    except OSError as exn:
+        # A racing build may have moved it aside already
+        if exn.errno != errno.ENOENT:
+            raise
+    if entry_complete(stale_entry):
+        # A racing build published a complete entry after we checked:
+        # put it back, unless yet another build has replaced it
+        try:
+            os.rename(stale_entry, cache_dir)
+        except OSError as exn:
+            if exn.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+        shutil.rmtree(stale_dir, True)
+        return False
+    shutil.rmtree(stale_dir, True)
+
+    try:
+        os.rename(staging_dir, cache_dir)
+        fsync_path(os.path.dirname(cache_dir))
+        return True
+    except OSError as exn:
+        if exn.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+            raise
+        return False
+
+
+def remove_stale_dirs(cachedir):
+    """
+    Remove the staging and build directories left in cachedir by
+    builds which crashed.   Directories modified recently may belong to
+    builds which are still running, and are left alone.
+    """
+    cutoff = time.time() - STALE_DIR_AGE
+    for name in os.listdir(cachedir):
+        path = os.path.join(cachedir, name)
+        try:
+            if (name.startswith(".") and os.path.isdir(path) and
+                    os.path.getmtime(path) < cutoff):
+                logging.debug("Removing stale directory %s", path)
+                shutil.rmtree(path, True)
+        except OSError:
+            # Removed by another build
+            pass
 
 
 def add_to_cache(cachedirs, pkg_hash, build_dir):
     """
-    Add the build products in build_dir to the cache
+    Add the build products in build_dir to the cache.   The entry is
+    populated in a staging directory next to its final location and
+    then renamed into place, so readers never see a partial entry.
+    The build products are moved into the entry if build_dir is on the
+    same filesystem, and reflinked or copied otherwise.   They are moved
+    back if the entry is not published.
     """
 
     # Another racing build may have written this package into the cache
@@ -103,15 +378,50 @@ def add_to_cache(cachedirs, pkg_hash, build_dir):
         return
 
     cache_dir = cache_locations(cachedirs, pkg_hash)[0]
-    cache_output_dir = os.path.join(cache_dir, "output")
-
-    if not os.path.isdir(cache_output_dir):
-        os.makedirs(cache_output_dir)
-
-    for fname in os.listdir(build_dir):
-        shutil.copy(os.path.join(build_dir, fname), cache_output_dir)
-
-    logging.debug("copied to %s", cache_output_dir)
+    util.makedirs(cachedirs[0])
+    remove_stale_dirs(cachedirs[0])
+    staging_dir = tempfile.mkdtemp(prefix=".%s-" % pkg_hash,
+                                   dir=cachedirs[0])
+    try:
+        staging_output_dir = os.path.join(staging_dir, "output")
+        os.mkdir(staging_output_dir)
+
+        # Files are never hard linked: results are copied out of the
+        # cache and touched, which must not change the cached files.
+        # Everything the marker vouches for must reach the disk before
+        # it, so that a crash cannot leave a complete but empty entry.
+        for fname in os.listdir(build_dir):
+            staged = os.path.join(staging_output_dir, fname)
+            try:
+                os.rename(os.path.join(build_dir, fname), staged)
+            except OSError as exn:
+                if exn.errno != errno.EXDEV:
+                    raise
+                util.clone_file(os.path.join(build_dir, fname), staged,
+                                link=False)
+            fsync_path(staged)
+        fsync_path(staging_output_dir)
+
+        with open(os.path.join(staging_dir, COMPLETE_MARKER), "w") as marker:
+            marker.write("%s\n" % pkg_hash)
+            marker.flush()
+            os.fsync(marker.fileno())
+        fsync_path(staging_dir)
+
+        if publish_cache_entry(staging_dir, cache_dir):
+            logging.debug("moved to %s", cache_dir)
+        else:
+            logging.debug("binary package cached by another build, "
+                          "skipping")
+    finally:
+        if os.path.isdir(staging_dir):
+            # Not published: give the build products back
+            for fname in os.listdir(staging_output_dir):
+                dest = os.path.join(build_dir, fname)
+                if not os.path.exists(dest):
+                    shutil.move(os.path.join(staging_output_dir, fname),
+                                dest)
+            shutil.rmtree(staging_dir, True)
 
 
 def get_from_specified_cache(cache_dir, resultdir):
@@ -125,7 +435,12 @@ def get_from_specified_cache(cache_dir, resultdir):
 
     for cached_file in os.listdir(build_output):
         cached_file_path = os.path.join(build_output, cached_file)
-        shutil.copy(cached_file_path, resultdir)
+        dest = os.path.join(resultdir, cached_file)
+        # Not a hard link, because the result is touched below and a
+        # shared inode would change the timestamps of the cached file
+        # and of the results in every other checkout
+        method = util.clone_file(cached_file_path, dest, link=False)
+        logging.debug("%s %s to %s", method, cached_file_path, dest)
 
         try:
             os.utime(cached_file_path, None)
@@ -134,6 +449,9 @@ def get_from_specified_cache(cache_dir, resultdir):
             # The cache might be mounted read-only, for example.
             pass
 
+        # The result must be newer than its source package for make
+        os.utime(dest, None)
+
 
 def get_from_cache(cachedirs, pkg_hash, resultdir):
     """
@@ -141,17 +459,88 @@ def get_from_cache(cachedirs, pkg_hash, resultdir):
     """
     possibilities = cache_locations(cachedirs, pkg_hash)
     logging.debug("Possible cache hits: %s" + ", ".join(possibilities))
-    cache_dir = next(itertools.ifilter(os.path.isdir, possibilities), None)
+    cache_dir = next(itertools.ifilter(entry_complete, possibilities), None)
     if cache_dir:
         get_from_specified_cache(cache_dir, resultdir)
 
 
-def get_srpm_hash(srpm, yumbase):
+class DependencyIndex(object):
+    """
+    Persistent map from the NEVRA and checksum of a build dependency to
+    its contribution to the hashes of the packages which build against
+    it, shared by all planex-cache runs using the same cache.   Computing
+    the contribution means downloading the dependency's header and
+    hashing the digests of all of its files; after the first time it is
+    a dictionary lookup.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.digests = self.load()
+        self.added = {}
+
+    def load(self):
+        """Read the index"""
+        if not self.path:
+            return {}
+        try:
+            with open(self.path) as index:
+                return json.load(index)
+        except (IOError, ValueError):
+            return {}
+
+    def digest(self, pkg, yumbase, digestalgo):
+        """Return the contribution of pkg to a package hash"""
+        algo, checksum, _ = pkg.returnChecksums()[0]
+        key = "%s-%s:%s-%s.%s %s:%s" % (
+            pkg.name, pkg.epoch, pkg.version, pkg.release, pkg.arch, algo,
+            checksum)
+        if key in self.digests:
+            return self.digests[key]
+
+        dep_hash = hashlib.md5()
+        dep_hash.update(checksum)
+        yumbase.downloadHeader(pkg)
+        hdr = pkg.returnLocalHeader()
+        logging.debug("  File hashes (%s):", digestalgo)
+        for name, digest in zip(hdr.filenames, hdr.filedigests):
+            logging.debug("    %s: %s", name, digest)
+            dep_hash.update(digest)
+
+        self.digests[key] = self.added[key] = dep_hash.hexdigest()
+        return self.digests[key]
+
+    def save(self):
+        """
+        Merge the digests computed by this run into the index.   The
+        index is re-read under an exclusive lock, so that digests added
+        by concurrent runs are not lost, and replaced atomically.
+        """
+        if not self.path or not self.added:
+            return
+        util.makedirs(os.path.dirname(self.path))
+        with open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            digests = self.load()
+            digests.update(self.added)
+            tmp_path = "%s.%d~" % (self.path, os.getpid())
+            with open(tmp_path, "w") as index:
+                json.dump(digests, index)
+            os.rename(tmp_path, self.path)
+        self.added = {}
+
+
+def get_srpm_hash(srpm, yumbase, dep_index=None):
     """
     Calculate the cache hash of srpm, including the hashes of its build
     dependencies.  Only the first layer of dependencies are hashed -
     as OCaml libraries are statically linked this should be sufficient.
+    Each dependency contributes a digest of its checksum and file hashes,
+    looked up in dep_index if one is given.
     """
+    if dep_index is None:
+        dep_index = DependencyIndex(None)
+
     pkg_hash = hashlib.md5()
     pkg_hash.update(PLANEX_CACHE_SALT)
 
@@ -171,16 +560,9 @@ def get_srpm_hash(srpm, yumbase):
         try:
             pkgs = yumbase.pkgSack.returnNewestByNameArch(patterns=[req])
             for pkg in pkgs:
-                algo, checksum, _ = pkg.returnChecksums()[0]
-                logging.debug("  %s: %s (%s: %s)", req, pkg, algo, checksum)
-                pkg_hash.update(checksum)
-
-                yumbase.downloadHeader(pkg)
-                hdr = pkg.returnLocalHeader()
-                logging.debug("  File hashes (%s):", digestalgo)
-                for name, digest in zip(hdr.filenames, hdr.filedigests):
-                    logging.debug("    %s: %s", name, digest)
-                    pkg_hash.update(digest)
+                dep_digest = dep_index.digest(pkg, yumbase, digestalgo)
+                logging.debug("  %s: %s (%s)", req, pkg, dep_digest)
+                pkg_hash.update(dep_digest)
 
         except yum.Errors.PackageSackError as pse:
             logging.debug("  %s", pse)
@@ -189,12 +571,15 @@ def get_srpm_hash(srpm, yumbase):
     return pkg_hash.hexdigest()
 
 
-def build_package(configdir, root, passthrough_args):
+def build_package(configdir, root, passthrough_args, work_dir=None):
     """
     Spawn a mock process to build the package.   Some arguments
-    are intercepted and rewritten, for instance --resultdir.
+    are intercepted and rewritten, for instance --resultdir.   The
+    results are written to a new directory in work_dir, if given, so
+    that they can be renamed into a cache on the same filesystem.
     """
-    working_directory = tempfile.mkdtemp(prefix="planex-cache")
+    working_directory = tempfile.mkdtemp(prefix=".planex-build-",
+                                         dir=work_dir)
     logging.debug("Mock working directory: %s", working_directory)
 
     cmd = ["/usr/bin/mock", "--configdir=%s" % configdir,
@@ -208,6 +593,154 @@ def build_package(configdir, root, passthrough_args):
     return working_directory
 
 
+def hash_srpm(config, srpm_path, cachedirs, yumbase=None, dep_index=None):
+    """
+    Return the cache hash of the SRPM at srpm_path, built with the mock
+    configuration config.   yumbase and dep_index are loaded from
+    scratch if they are not given.
+    """
+    if yumbase is None:
+        yumbase = util.get_yumbase(util.load_mock_config(config))
+        setup_yumbase(yumbase)
+    if dep_index is None:
+        dep_index = DependencyIndex(os.path.join(cachedirs[0],
+                                                 "dependency-digests.json"))
+
+    srpm = load_srpm_from_file(srpm_path)
+    pkg_hash = get_srpm_hash(srpm, yumbase, dep_index)
+    try:
+        dep_index.save()
+    except (IOError, OSError):
+        # If we can't save the index, that's not a fatal error
+        pass
+    return pkg_hash
+
+
+def repo_signature(yumbase):
+    """
+    Return the modification times of the metadata of the local
+    repositories which yumbase reads.   They change whenever createrepo
+    updates a repository.
+    """
+    signature = []
+    for repo in yumbase.repos.listEnabled():
+        for baseurl in repo.baseurl:
+            url = urlparse.urlparse(baseurl)
+            if url.scheme == "file":
+                repomd = os.path.join(url.path, "repodata", "repomd.xml")
+                try:
+                    signature.append(os.stat(repomd).st_mtime)
+                except OSError:
+                    signature.append(None)
+    return signature
+
+
+class CacheServer(object):
+    """
+    Answers hash and cache lookup requests from planex-cache processes
+    over a Unix socket, keeping the package sack of each mock
+    configuration loaded between requests.   A sack is only reloaded
+    when the metadata of a local repository it reads has changed.
+    """
+
+    # pylint: disable=R0903
+
+    def __init__(self, snapshot_root=YUM_SNAPSHOT_ROOT):
+        self.lock = threading.Lock()
+        self.snapshot_root = snapshot_root
+        self.yumbases = {}
+        self.dep_indexes = {}
+
+    def yumbase(self, config):
+        """Return an up-to-date YumBase for the mock configuration"""
+        yumbase, signature, private_dir = self.yumbases.get(
+            config, (None, None, None))
+        if yumbase is None or repo_signature(yumbase) != signature:
+            logging.debug("Loading package sack for %s", config)
+            if yumbase is not None:
+                # The server runs for a long time: do not leave a cache
+                # directory behind for every reload until it exits
+                yumbase.close()
+                shutil.rmtree(private_dir, True)
+            yumbase = util.get_yumbase(util.load_mock_config(config))
+            private_dir = setup_yumbase(yumbase, self.snapshot_root)
+            self.yumbases[config] = (yumbase, repo_signature(yumbase),
+                                     private_dir)
+        return yumbase
+
+    def handle(self, request):
+        """Hash an SRPM and look it up in the cache"""
+        config = str(request["config"])
+        cachedirs = [str(cachedir) for cachedir in request["cachedirs"]]
+        index_path = os.path.join(cachedirs[0], "dependency-digests.json")
+
+        # yum is not thread-safe
+        with self.lock:
+            if index_path not in self.dep_indexes:
+                self.dep_indexes[index_path] = DependencyIndex(index_path)
+            pkg_hash = hash_srpm(config, str(request["srpm"]), cachedirs,
+                                 self.yumbase(config),
+                                 self.dep_indexes[index_path])
+        return {"hash": pkg_hash, "cached": in_cache(cachedirs, pkg_hash)}
+
+
+def request_hash(socket_path, config, srpm_path, cachedirs):
+    """
+    Ask the cache server listening on socket_path for the hash of an
+    SRPM.   Returns None if there is no server, or it failed or did not
+    answer within CACHE_SERVER_TIMEOUT seconds.
+    """
+    try:
+        response = util.unix_socket_request(
+            socket_path, {"config": os.path.abspath(config),
+                          "srpm": os.path.abspath(srpm_path),
+                          "cachedirs": cachedirs},
+            timeout=CACHE_SERVER_TIMEOUT)
+    except (socket.error, ValueError):
+        # socket.timeout is a socket.error
+        return None
+    if "error" in response:
+        return None
+    return str(response["hash"])
+
+
+def build_and_cache(intercepted_args, passthrough_args, cachedirs,
+                    pkg_hash, resultdir):
+    """
+    Build the package, add the build products to the cache and put
+    them in resultdir.   They are built next to the cache if possible,
+    so that they are renamed into it and then reflinked or copied into
+    resultdir once.
+    """
+    try:
+        util.makedirs(cachedirs[0])
+        work_dir = cachedirs[0]
+    except OSError:
+        work_dir = None
+    build_output = build_package(intercepted_args.configdir,
+                                 intercepted_args.root, passthrough_args,
+                                 work_dir)
+    try:
+        add_to_cache(cachedirs, pkg_hash, build_output)
+    except OSError:
+        # If we can't cache the result, that's not a fatal error
+        pass
+
+    # The build products are left behind if they could not be moved
+    # into the cache
+    built = os.listdir(build_output)
+    for cached_file in built:
+        dest = os.path.join(resultdir, cached_file)
+
+        if os.path.exists(dest):
+            os.unlink(dest)
+        shutil.move(os.path.join(build_output, cached_file), resultdir)
+    shutil.rmtree(build_output, True)
+
+    if not built:
+        get_from_cache(cachedirs, pkg_hash, resultdir)
+
+
 def main(argv):
     """
     Main function.  Parse spec file and iterate over its sources, downloading
@@ -218,24 +751,41 @@ def main(argv):
     config = os.path.join(intercepted_args.configdir,
                           intercepted_args.root + ".cfg")
 
-    # Initialize yum before setting up logging, because yum uses
-    # logging with a different default loglevel.   This avoids
-    # having yum print lots of irrelevant messages during startup.
-    yum_config = util.load_mock_config(config)
-    yumbase = util.get_yumbase(yum_config)
-    setup_yumbase(yumbase)
-
-    util.setup_logging(intercepted_args)
-
-    srpm = load_srpm_from_file(passthrough_args[-1])
-    pkg_hash = get_srpm_hash(srpm, yumbase)
+    if intercepted_args.serve:
+        util.setup_logging(intercepted_args)
+        try:
+            util.serve_unix_socket(intercepted_args.serve,
+                                   CacheServer().handle)
+        except socket.error as exn:
+            sys.exit("%s: %s" % (sys.argv[0], exn))
+        return
 
     cachedirs = [os.path.expanduser(x) for x
                  in intercepted_args.cachedirs.split(':')]
 
+    pkg_hash = None
+    if intercepted_args.daemon:
+        pkg_hash = request_hash(intercepted_args.daemon, config,
+                                passthrough_args[-1], cachedirs)
+
+    if pkg_hash is None:
+        # Initialize yum before setting up logging, because yum uses
+        # logging with a different default loglevel.   This avoids
+        # having yum print lots of irrelevant messages during startup.
+        yumbase = util.get_yumbase(util.load_mock_config(config))
+        setup_yumbase(yumbase)
+        util.setup_logging(intercepted_args)
+        pkg_hash = hash_srpm(config, passthrough_args[-1], cachedirs,
+                             yumbase)
+    else:
+        util.setup_logging(intercepted_args)
+        logging.debug("Package hash from cache server: %s", pkg_hash)
+
     # Expand default resultdir as done in mock.backend.Root
-    resultdir = intercepted_args.resultdir or \
-        yum_config['resultdir'] % yum_config
+    resultdir = intercepted_args.resultdir
+    if not resultdir:
+        yum_config = util.load_mock_config(config)
+        resultdir = yum_config['resultdir'] % yum_config
 
     if not os.path.isdir(resultdir):
         os.makedirs(resultdir)
@@ -243,20 +793,8 @@ def main(argv):
     # Rebuild if not available in the cache
     if not in_cache(cachedirs, pkg_hash):
         logging.debug("Cache miss - rebuilding")
-        build_output = build_package(intercepted_args.configdir,
-                                     intercepted_args.root, passthrough_args)
-        try:
-            add_to_cache(cachedirs, pkg_hash, build_output)
-        except OSError:
-            # If we can't cache the result, that's not a fatal error
-            pass
-
-        for cached_file in os.listdir(build_output):
-            dest = os.path.join(resultdir, cached_file)
-
-            if os.path.exists(dest):
-                os.unlink(dest)
-            shutil.move(os.path.join(build_output, cached_file), resultdir)
+        build_and_cache(intercepted_args, passthrough_args, cachedirs,
+                        pkg_hash, resultdir)
     else:
         get_from_cache(cachedirs, pkg_hash, resultdir)
 
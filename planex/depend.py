@@ -6,13 +6,19 @@ planex-depend: Generate Makefile-format dependencies from spec files
 
 import argparse
 import glob
+import json
+import multiprocessing
 import os
 import sys
+import time
 import urlparse
 
 import argcomplete
 from planex.util import add_common_parser_options
 from planex.util import setup_sigint_handler
+from planex.provides import ProvidesIndex
+from planex.speccache import SpecCache
+from planex import specscan
 import planex.spec as pkg
 
 
@@ -60,14 +66,38 @@ def build_rpm_from_srpm(spec):
 
 def package_to_rpm_map(specs):
     """
-    Generate a mapping from RPM package names to the RPM files
-    which provide them.
+    Generate an index mapping the packages provided by specs to the
+    RPM files which provide them.
     """
-    provides_to_rpm = {}
-    for spec in specs:
-        for provided in spec.provides():
-            provides_to_rpm[provided] = spec.binary_package_paths()[-1]
-    return provides_to_rpm
+    return ProvidesIndex(specs)
+
+
+def version_constraints(spec):
+    """
+    Return a dictionary mapping each name spec build-requires to the list
+    of (operator, evr) constraints on it.   A name may be required more
+    than once, as in BuildRequires: foo >= 1, foo < 2.
+    """
+    constraints = {}
+    for (name, oper, evr) in spec.versioned_buildrequires():
+        constraints.setdefault(name, []).append((oper, evr))
+    return constraints
+
+
+def resolve_buildrequires(spec, provides_to_rpm):
+    """
+    Return a list of (buildrequire, provider) pairs for the build
+    requirements of spec which are provided by specs in the index.
+    """
+    constraints = version_constraints(spec)
+    resolved = []
+    for buildreq in spec.buildrequires():
+        # Some buildrequires come from the system repository
+        provider = provides_to_rpm.resolve_all(
+            buildreq, constraints.get(buildreq, []))
+        if provider is not None:
+            resolved.append((buildreq, provider))
+    return resolved
 
 
 def buildrequires_for_rpm(spec, provides_to_rpm):
@@ -75,11 +105,260 @@ def buildrequires_for_rpm(spec, provides_to_rpm):
     Generate build dependency rules between binary RPMs
     """
     rpmpath = spec.binary_package_paths()[-1]
-    for buildreq in spec.buildrequires():
-        # Some buildrequires come from the system repository
-        if buildreq in provides_to_rpm:
-            buildreqrpm = provides_to_rpm[buildreq]
-            print "%s: %s" % (rpmpath, buildreqrpm)
+    for _, provider in resolve_buildrequires(spec, provides_to_rpm):
+        print "%s: %s" % (rpmpath, provider.target)
+
+
+def build_graph(specs, provides_to_rpm, pinned):
+    """
+    Return the build graph of specs as a JSON-serializable dictionary.
+    Each node is a package, described by its spec, source package,
+    binary packages, provides, sources and whether it is pinned.
+    Each edge records that the 'from' package must be built after the
+    'to' package because it requires something 'to' provides.
+    """
+    names = dict((spec.specpath(), spec.name()) for spec in specs)
+    nodes = {}
+    edges = []
+    for spec in specs:
+        nodes[spec.name()] = {
+            "name": spec.name(),
+            "version": spec.version(),
+            "spec": spec.specpath(),
+            "srpm": spec.source_package_path(),
+            "rpms": spec.binary_package_paths(),
+            "target": spec.binary_package_paths()[-1],
+            "provides": sorted(spec.provides()),
+            "buildrequires": sorted(spec.buildrequires()),
+            "sources": [{"url": url, "path": path} for (url, path)
+                        in zip(spec.source_urls(), spec.source_paths())],
+            "pinned": spec.specpath() in pinned,
+        }
+        for buildreq, provider in resolve_buildrequires(spec,
+                                                        provides_to_rpm):
+            edges.append({"from": spec.name(),
+                          "to": names[provider.spec_path],
+                          "requires": buildreq,
+                          "rpm": provider.rpm_path})
+    edges.sort(key=lambda edge: (edge["from"], edge["to"], edge["requires"]))
+    return {"nodes": nodes, "edges": edges}
+
+
+def graph_to_dot(graph):
+    """
+    Return the build graph in Graphviz DOT format.   Pinned packages
+    are drawn in bold.
+    """
+    lines = ["digraph planex {"]
+    for name, node in sorted(graph["nodes"].items()):
+        attrs = 'label=%s' % json.dumps("%s\n%s" % (name, node["version"]))
+        if node["pinned"]:
+            attrs += ', style=bold'
+        lines.append('    %s [%s];' % (json.dumps(name), attrs))
+
+    edges = sorted(set((edge["from"], edge["to"])
+                       for edge in graph["edges"]))
+    for (from_node, to_node) in edges:
+        if from_node != to_node:
+            lines.append('    %s -> %s;' % (json.dumps(from_node),
+                                            json.dumps(to_node)))
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def write_graph(graph, basename):
+    """
+    Write the build graph to basename.json and basename.dot
+    """
+    with open(basename + ".json", "w") as json_file:
+        json.dump(graph, json_file, indent=2, sort_keys=True)
+    with open(basename + ".dot", "w") as dot_file:
+        dot_file.write(graph_to_dot(graph))
+
+
+def dependency_map(specs, provides_to_rpm):
+    """
+    Return a dictionary mapping the name of each spec to the set of
+    names of the specs whose packages it requires to build.
+    """
+    names = dict((spec.specpath(), spec.name()) for spec in specs)
+    return dict((spec.name(),
+                 set(names[provider.spec_path] for (_, provider)
+                     in resolve_buildrequires(spec, provides_to_rpm)))
+                for spec in specs)
+
+
+def find_cycles(deps):
+    """
+    Return the cycles in a dependency map, as a sorted list of sorted
+    lists of the packages in each strongly-connected component.
+    A package which requires itself is a cycle of one.
+    This is Tarjan's algorithm, written iteratively so that very long
+    dependency chains cannot overflow the Python stack.
+    """
+    # pylint: disable=R0912
+    index = {}
+    lowlink = {}
+    stack = []
+    position = {}
+    on_stack = set()
+    cycles = []
+
+    for root in sorted(deps):
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        position[root] = len(stack)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(sorted(deps[root])))]
+
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in index:
+                    index[child] = lowlink[child] = len(index)
+                    position[child] = len(stack)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(sorted(deps[child]))))
+                    break
+                elif child in on_stack:
+                    lowlink[node] = min(lowlink[node], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    # node is the root of a strongly-connected component
+                    component = stack[position[node]:]
+                    del stack[position[node]:]
+                    on_stack.difference_update(component)
+                    if len(component) > 1 or node in deps[node]:
+                        cycles.append(sorted(component))
+
+    return sorted(cycles)
+
+
+def analyze(specs, provides_to_rpm):
+    """
+    Check the build dependencies of specs, returning a dictionary with:
+      cycles: lists of packages which require each other to build
+      unresolved: requirements provided by no spec, which must come from
+                  the system repositories, mapped to the packages needing
+                  them
+      unsatisfied: (package, requirement) pairs where a spec provides the
+                   requirement but not a version which satisfies it
+      duplicates: names provided by more than one spec, mapped to those
+                  specs
+    """
+    unresolved = {}
+    unsatisfied = []
+    for spec in specs:
+        for name, constraints in version_constraints(spec).items():
+            if name not in provides_to_rpm:
+                unresolved.setdefault(name, []).append(spec.name())
+            elif provides_to_rpm.unsatisfied_versions(name, constraints):
+                unsatisfied.append(
+                    (spec.name(), ", ".join(
+                        ("%s %s %s" % (name, oper, evr)).strip()
+                        for (oper, evr) in constraints)))
+
+    return {"cycles": find_cycles(dependency_map(specs, provides_to_rpm)),
+            "unresolved": unresolved,
+            "unsatisfied": sorted(unsatisfied),
+            "duplicates": provides_to_rpm.duplicates()}
+
+
+def print_report(report, timings, full):
+    """
+    Print the dependency analysis to stderr.   Cycles are always
+    reported; everything else only if full is True.
+    """
+    for cycle in report["cycles"]:
+        sys.stderr.write("warning: build dependency cycle: %s\n" %
+                         " -> ".join(cycle + cycle[:1]))
+    if not full:
+        return
+
+    for name, spec_paths in sorted(report["duplicates"].items()):
+        sys.stderr.write("warning: %s is provided by more than one spec: "
+                         "%s\n" % (name, ", ".join(spec_paths)))
+    for pkg_name, requirement in report["unsatisfied"]:
+        sys.stderr.write("warning: %s requires %s, but no spec provides a "
+                         "matching version\n" % (pkg_name, requirement))
+    for name, pkg_names in sorted(report["unresolved"].items()):
+        sys.stderr.write("info: %s is not provided by any spec "
+                         "(required by %s)\n" %
+                         (name, ", ".join(sorted(pkg_names))))
+    sys.stderr.write("info: %d cycles, %d duplicate provides, "
+                     "%d unsatisfied versions, %d unresolved requirements\n"
+                     % (len(report["cycles"]), len(report["duplicates"]),
+                        len(report["unsatisfied"]),
+                        len(report["unresolved"])))
+    for phase, duration in timings:
+        sys.stderr.write("info: %s took %.3fs\n" % (phase, duration))
+
+
+def load_spec(spec_path, macros, options, cache):
+    """
+    Parse the spec at spec_path, using the spec cache if there is one
+    and the fast spec scanner if it was requested.
+    """
+    if cache is not None:
+        return cache.load(spec_path,
+                          check_package_name=options.check_package_names,
+                          defines=macros, fast_scan=options.fast_scan)
+    if options.fast_scan:
+        return specscan.load(spec_path,
+                             check_package_name=options.check_package_names,
+                             defines=macros)
+    return pkg.Spec(spec_path, check_package_name=options.check_package_names,
+                    defines=macros)
+
+
+def _load_spec_summary(job):
+    """
+    Worker for load_specs: parse one spec in a pool process and return
+    a picklable summary of it, together with the scanner statistics for
+    this spec.   Each worker process has its own copy of the librpm
+    macro state, so workers cannot interfere with each other.
+    """
+    spec_path, macros, options = job
+    stats_before = dict(specscan.STATS)
+    cache = SpecCache(options.spec_cache) if options.spec_cache else None
+    spec = load_spec(spec_path, macros, options, cache)
+    if not isinstance(spec, pkg.SpecSummary):
+        spec = pkg.SpecSummary.of_spec(spec)
+    return spec, dict((key, value - stats_before[key])
+                      for key, value in specscan.STATS.items())
+
+
+def load_specs(spec_paths, macros, options):
+    """
+    Parse all the specs in spec_paths, returning them in the same order.
+    If options.jobs is greater than one, the specs are parsed by a pool
+    of worker processes.
+    """
+    if options.jobs > 1 and len(spec_paths) > 1:
+        pool = multiprocessing.Pool(min(options.jobs, len(spec_paths)))
+        try:
+            results = pool.map(_load_spec_summary,
+                               [(spec_path, macros, options)
+                                for spec_path in spec_paths])
+        finally:
+            pool.terminate()
+            pool.join()
+
+        for _, stats in results:
+            for key, value in stats.items():
+                specscan.STATS[key] += value
+        return [spec for (spec, _) in results]
+
+    cache = SpecCache(options.spec_cache) if options.spec_cache else None
+    return [load_spec(spec_path, macros, options, cache)
+            for spec_path in spec_paths]
 
 
 def parse_cmdline():
@@ -108,6 +387,23 @@ def parse_cmdline():
     parser.add_argument(
         "-D", "--define", default=[], action="append",
         help="--define='MACRO EXPR' define MACRO with value EXPR")
+    parser.add_argument(
+        "--spec-cache", metavar="DIR", default=None,
+        help="Directory in which to cache parsed spec files")
+    parser.add_argument(
+        "-j", "--jobs", metavar="N", type=int, default=1,
+        help="Number of processes to use to parse spec files")
+    parser.add_argument(
+        "--fast-scan", action="store_true", default=False,
+        help="Read simple spec files without parsing them with librpm")
+    parser.add_argument(
+        "--graph-out", metavar="BASENAME", default=None,
+        help="Also write the build graph to BASENAME.json and "
+        "BASENAME.dot")
+    parser.add_argument(
+        "--report", action="store_true", default=False,
+        help="Report duplicate provides, unresolved build requirements "
+        "and timings to stderr (cycles are always reported)")
     argcomplete.autocomplete(parser)
     return parser.parse_args()
 
@@ -141,36 +437,42 @@ def main():
         print "# warning: --dist is deprecated"
         macros.insert(1, ('dist', args.dist))
 
-    pins = {}
+    timings = []
+    phase_start = time.time()
+
+    pin_paths = []
     if args.pins_dir:
         pins_glob = os.path.join(args.pins_dir, "*.spec")
         pin_paths = glob.glob(pins_glob)
-        for pin_path in pin_paths:
-            spec = pkg.Spec(pin_path,
-                            check_package_name=args.check_package_names,
-                            defines=macros)
-            pins[os.path.basename(pin_path)] = spec
 
-    for spec_path in args.specs:
-        try:
-            spec = pkg.Spec(spec_path,
-                            check_package_name=args.check_package_names,
-                            defines=macros)
-            pkg_name = spec.name()
-
-            spec_name = os.path.basename(spec_path)
-            if spec_name in pins:
-                print "# Pinning '%s' to '%s'" % (pkg_name,
-                                                  pins[spec_name].specpath())
-                specs[spec_name] = pins[spec_name]
-            else:
-                specs[spec_name] = spec
+    try:
+        loaded = load_specs(pin_paths + args.specs, macros, args)
+    except pkg.SpecNameMismatch as exn:
+        sys.stderr.write("error: %s\n" % exn.message)
+        sys.exit(1)
 
-        except pkg.SpecNameMismatch as exn:
-            sys.stderr.write("error: %s\n" % exn.message)
-            sys.exit(1)
+    pins = dict((os.path.basename(pin_path), spec)
+                for (pin_path, spec) in zip(pin_paths, loaded))
+
+    for spec_path, spec in zip(args.specs, loaded[len(pin_paths):]):
+        pkg_name = spec.name()
+
+        spec_name = os.path.basename(spec_path)
+        if spec_name in pins:
+            print "# Pinning '%s' to '%s'" % (pkg_name,
+                                              pins[spec_name].specpath())
+            specs[spec_name] = pins[spec_name]
+        else:
+            specs[spec_name] = spec
+
+    timings.append(("parse", time.time() - phase_start))
+    phase_start = time.time()
 
     provides_to_rpm = package_to_rpm_map(specs.values())
+    report = analyze(specs.values(), provides_to_rpm)
+
+    timings.append(("index", time.time() - phase_start))
+    phase_start = time.time()
 
     for spec in specs.itervalues():
         build_srpm_from_spec(spec)
@@ -190,11 +492,23 @@ def main():
         print "%s.srpm: %s" % (spec.name(), spec.source_package_path())
     print ""
 
+    if args.fast_scan:
+        print "# spec scanner: %s" % specscan.report()
+        print ""
+
     print "rpms: " + " \\\n\t".join(all_rpms)
     print ""
     print "srpms: " + " \\\n\t".join(all_srpms)
     print ""
 
+    if args.graph_out:
+        pinned = set(spec.specpath() for spec in pins.values())
+        write_graph(build_graph(specs.values(), provides_to_rpm, pinned),
+                    args.graph_out)
+
+    timings.append(("emit", time.time() - phase_start))
+    print_report(report, timings, args.report)
+
 
 if __name__ == "__main__":
     main()
@@ -2,122 +2,85 @@
 planex-fetch: Download sources referred to by a spec file
 """
 
+from collections import OrderedDict
+
 import argparse
 import json
 import logging
 import os
-import shutil
+import socket
 import sys
 import urlparse
 
 import argcomplete
-import pkg_resources
 import pycurl
 
+from planex.mirrors import MirrorStats
+from planex.sourcestore import DEFAULT_STORE_SIZE, SourceStore
+from planex.throttle import Throttle
+from planex.transfer import CurlPool, Transfer, fetch_all
 from planex.util import add_common_parser_options
-from planex.util import run
+from planex.util import sha256_of_file
 from planex.util import setup_logging
+from planex.util import serve_unix_socket
 from planex.util import setup_sigint_handler
+from planex.util import unix_socket_request
 import planex.spec
+import planex.specscan
 
 
-# This should include all of the extensions in the Makefile.rules for fetch
-SUPPORTED_EXT_TO_MIME = {
-    '.tar': 'application/x-tar',
-    '.gz': 'application/x-gzip',
-    '.tgz': 'application/x-gzip',
-    '.txz': 'application/x-gzip',
-    '.bz2': 'application/x-bzip2',
-    '.tbz': 'application/x-bzip2',
-    '.zip': 'application/zip',
-    '.pdf': 'application/pdf',
-    '.patch': 'text/x-diff'
-}
-
 SUPPORTED_URL_SCHEMES = ["http", "https", "file", "ftp"]
 
 
-def curl_get(url_string, out_file):
-    """
-    Fetch the contents of url and store to file represented by out_file
-    """
-    curl = pycurl.Curl()
-
-    # General options
-    useragent = "planex-fetch/%s" % pkg_resources.require("planex")[0].version
-    curl.setopt(pycurl.USERAGENT, useragent)
-    curl.setopt(pycurl.FOLLOWLOCATION, True)
-    curl.setopt(pycurl.MAXREDIRS, 5)
-    curl.setopt(pycurl.CONNECTTIMEOUT, 30)
-    curl.setopt(pycurl.TIMEOUT, 300)
-    curl.setopt(pycurl.FAILONERROR, True)
-
-    # Cribbed from /usr/lib64/python2.6/site-packages/curl/__init__.py
-    curl.setopt(pycurl.SSL_VERIFYHOST, 2)
-    curl.setopt(pycurl.COOKIEFILE, "/dev/null")
-    curl.setopt(pycurl.NETRC, 1)
-    # If we use threads, we should also set NOSIGNAL and ignore SIGPIPE
-
-    # Set URL to fetch and file to which to write the response
-    curl.setopt(pycurl.URL, url_string)
-    curl.setopt(pycurl.WRITEDATA, out_file)
-
-    try:
-        curl.perform()
-    finally:
-        curl.close()
-
-
-def make_dir(path):
+class FetchServer(object):
     """
-    Ensure that path exists
+    Performs transfers on behalf of planex-fetch processes which connect
+    to it over a Unix socket, so that connections, DNS lookups and TLS
+    sessions stay warm across the many planex-fetch invocations of a
+    make run.
     """
-    if not os.path.isdir(path):
-        os.makedirs(path)
-
 
-def best_effort_file_verify(path):
-    """
-    Given a path, check if the file at that path has a sensible format.
-    If the file has an extension then it checks that the mime-type of this file
-    matches that of the file extension as defined by the IANA:
-        http://www.iana.org/assignments/media-types/media-types.xhtml
-    """
-    _, ext = os.path.splitext(path)
-    if ext and ext in SUPPORTED_EXT_TO_MIME:
-        # output of `file` is of form: "<path>: <mime-type>"
-        cmd = ["file", "--mime-type", path]
-        stdout = run(cmd, check=False)['stdout'].strip()
-        _, _, mime_type = stdout.partition(': ')
-
-        if SUPPORTED_EXT_TO_MIME[ext] != mime_type:
-            sys.exit("%s: Fetched file format looks incorrect: %s: %s" %
-                     (sys.argv[0], path, mime_type))
+    # pylint: disable=R0903
+
+    def __init__(self):
+        self.pool = CurlPool(shared=True)
+
+    def handle(self, request):
+        """Perform the transfers in a request from run_transfers"""
+        store = None
+        if request["store_dirs"]:
+            store = SourceStore(request["store_dirs"], request["store_size"])
+        stats = MirrorStats(request["mirror_stats"])
+        throttle = None
+        if request["lock_dir"]:
+            throttle = Throttle(request["lock_dir"],
+                                request["host_connections"],
+                                request["bandwidth"])
+        transfers = [Transfer.from_dict(data, store, stats)
+                     for data in request["transfers"]]
+        try:
+            failed = fetch_all(transfers, request["parallel"], self.pool,
+                               throttle)
+        except SystemExit as exn:
+            # Bad format or checksum: report it to the client
+            return {"error": str(exn.code)}
+        except IOError as exn:
+            return {"error": "%s: %s: %s" % (sys.argv[0], exn.strerror,
+                                             exn.filename)}
+        finally:
+            # Failures are worth recording even if the request failed
+            stats.save()
+        return {"failed": [(transfer.url_string, transfer.error.args[1])
+                           for transfer in failed]}
 
 
 def fetch_http(url, filename, retries):
     """
     Download the file at url and store it as filename
     """
-
-    while True:
-        retries -= 1
-        try:
-            url_string = urlparse.urlunparse(url)
-            logging.debug("Fetching %s to %s", url_string, filename)
-
-            make_dir(os.path.dirname(filename))
-            tmp_filename = filename + "~"
-            with open(tmp_filename, "wb") as tmp_file:
-                curl_get(url_string, tmp_file)
-                best_effort_file_verify(tmp_filename)
-                shutil.move(tmp_filename, filename)
-                return
-
-        except pycurl.error as exn:
-            logging.debug(exn.args[1])
-            if not retries > 0:
-                raise
+    failed = fetch_all([Transfer(url, filename, retries)])
+    if failed:
+        raise failed[0].error
 
 
 def check_supported_url(url):
@@ -148,33 +111,103 @@ def parse_args_or_exit(argv=None):
     """
     parser = argparse.ArgumentParser(description='Download package sources')
     add_common_parser_options(parser)
-    parser.add_argument('spec_or_link', help='RPM Spec or link file')
-    parser.add_argument("sources", metavar="SOURCE", nargs="+",
-                        help="Source file to fetch")
+    parser.add_argument('spec_or_link', nargs='?',
+                        help='RPM Spec or link file')
+    parser.add_argument("sources", metavar="SOURCE", nargs="*",
+                        help="Source file to fetch, or further spec files "
+                        "with --all")
+    parser.add_argument('--all', action='store_true', default=False,
+                        help='Fetch every missing source of all the spec '
+                        'files given')
     parser.add_argument('--retries', '-r',
                         help='Number of times to retry a failed download',
                         type=int, default=5)
+    parser.add_argument('--parallel', '-P', metavar='N', type=int, default=4,
+                        help='Number of downloads to run at once')
     parser.add_argument("-t", "--topdir", metavar="DIR", default=None,
                         help='Set rpmbuild toplevel directory [deprecated]')
     parser.add_argument('--no-package-name-check', dest="check_package_names",
                         action="store_false", default=True,
                         help="Don't check that package name matches spec "
                         "file name")
-    parser.add_argument('--mirror',
-                        help="Set the URL to a local mirror for downloads")
+    parser.add_argument('--mirror', default=[], action='append',
+                        help="Add the URL of a mirror to try before the "
+                        "upstream URL.   May be repeated: the mirrors which "
+                        "have been fastest and most reliable are tried "
+                        "first")
+    parser.add_argument('--mirror-stats', metavar='FILE',
+                        default='~/.planex-mirror-stats',
+                        help='File recording the speed and reliability of '
+                        'mirrors')
     parser.add_argument("-D", "--define", default=[], action="append",
                         help="--define='MACRO EXPR' define MACRO with "
                         "value EXPR")
+    parser.add_argument('--store-dirs', metavar='DIRS', default=None,
+                        help='Colon-separated search path of content-'
+                        'addressed source stores shared between checkouts')
+    parser.add_argument('--store-size', metavar='MB', type=int,
+                        default=DEFAULT_STORE_SIZE,
+                        help='Size to which the first source store is '
+                        'trimmed, least recently used files first')
+    parser.add_argument('--lockfile', metavar='FILE', default=None,
+                        help='File recording the sha256 of each source URL. '
+                        'A SPEC.lock file next to a spec, or in '
+                        '--spec-lock-dir, overrides it')
+    parser.add_argument('--spec-lock-dir', metavar='DIR', default=None,
+                        help='Directory holding the SPEC.lock files, for '
+                        'specs which are copied or generated elsewhere')
+    parser.add_argument('--update-lockfile', action='store_true',
+                        default=False,
+                        help='With --all, record the checksums of all the '
+                        'sources in the lock file')
+    parser.add_argument('--lock-dir', metavar='DIR', default=None,
+                        help='Directory of lock files through which '
+                        'concurrent planex-fetch processes share the '
+                        'per-host and bandwidth limits')
+    parser.add_argument('--host-connections', metavar='N', type=int,
+                        default=4,
+                        help='With --lock-dir, the number of downloads '
+                        'which may run at once from each host')
+    parser.add_argument('--bandwidth', metavar='KB/S', type=int, default=0,
+                        help='With --lock-dir, the total download rate '
+                        'shared by all processes (default: unlimited)')
+    parser.add_argument('--daemon', metavar='SOCKET', default=None,
+                        help='Hand downloads to the fetch server listening '
+                        'on SOCKET, fetching directly if there is none')
+    parser.add_argument('--serve', metavar='SOCKET', default=None,
+                        help='Run a fetch server on SOCKET, which keeps '
+                        'connections open between planex-fetch runs')
+    parser.add_argument("--fast-scan", action="store_true", default=False,
+                        help="Read simple spec files without parsing them "
+                        "with librpm")
     argcomplete.autocomplete(parser)
-    return parser.parse_args(argv)
+    args = parser.parse_args(argv)
+    if args.serve:
+        return args
+    if not args.spec_or_link or not (args.all or args.sources):
+        parser.error("too few arguments")
+    if args.update_lockfile and not (args.all and args.lockfile):
+        parser.error("--update-lockfile requires --all and --lockfile")
+    return args
 
 
-def fetch_sources(args):
+def load_spec(path, args, macros):
     """
-    Parse spec file and iterate over its sources, downloading them as
-    appropriate.
+    Parse the spec at path, with the fast spec scanner if requested
     """
+    if args.fast_scan:
+        return planex.specscan.load(
+            path, check_package_name=args.check_package_names,
+            defines=macros)
+    return planex.spec.Spec(path, check_package_name=args.check_package_names,
+                            defines=macros)
+
 
+def parse_macros(args):
+    """
+    Return the macros defined on the command line as a list of
+    (name, value) pairs
+    """
     macros = [tuple(macro.split(' ', 1)) for macro in args.define]
 
     if any(len(macro) != 2 for macro in macros):
@@ -188,36 +221,114 @@ def fetch_sources(args):
         print "# warning: --topdir is deprecated"
         macros.insert(0, ('_topdir', args.topdir))
 
-    spec = planex.spec.Spec(args.spec_or_link,
-                            check_package_name=args.check_package_names,
-                            defines=macros)
+    return macros
+
+
+def lockfile_for_spec(spec_path, spec_lock_dir=None):
+    """
+    Return the path of the lock file which records the checksums of
+    the sources of one spec: SPEC.lock in spec_lock_dir if given,
+    otherwise next to the spec
+    """
+    lockfile = os.path.splitext(spec_path)[0] + ".lock"
+    if spec_lock_dir:
+        return os.path.join(spec_lock_dir, os.path.basename(lockfile))
+    return lockfile
 
+
+def load_lockfile(path):
+    """
+    Return a dictionary mapping source URLs to the sha256 digests
+    recorded for them in a lock file, or an empty dictionary if there
+    is no lock file
+    """
+    if not path or not os.path.exists(path):
+        return {}
     try:
-        sources = [url_for_source(spec, source) for source in args.sources]
-    except KeyError as exn:
-        sys.exit("%s: No source corresponding to %s" % (sys.argv[0], exn))
+        with open(path) as lockfile:
+            return dict((str(url), str(digest)) for url, digest
+                        in json.load(lockfile).items())
+    except ValueError as exn:
+        sys.exit("%s: Invalid lock file %s: %s" % (sys.argv[0], path, exn))
+
+
+def write_lockfile(path, digests):
+    """Write a lock file recording the sha256 digests of sources"""
+    tmp_path = path + "~"
+    with open(tmp_path, "w") as lockfile:
+        json.dump(digests, lockfile, indent=2, sort_keys=True)
+        lockfile.write("\n")
+    os.rename(tmp_path, path)
+
+
+def spec_lock(args, spec_path):
+    """
+    Return the source checksums which apply to a spec: those in the
+    repository-wide lock file, overridden by those in the spec's own
+    """
+    lock = load_lockfile(args.lockfile)
+    lock.update(load_lockfile(lockfile_for_spec(spec_path,
+                                                args.spec_lock_dir)))
+    return lock
+
+
+def mirror_url(mirror, url):
+    """
+    Return the URL of the copy of url on a mirror, which is a URL or a
+    local directory holding the files from every upstream URL
+    """
+    if not urlparse.urlparse(mirror).scheme:
+        mirror = "file://" + mirror
+    return urlparse.urlparse(os.path.join(mirror,
+                                          os.path.basename(url.path)))
+
+
+def source_store(args):
+    """Return the source store named on the command line, if any"""
+    if args.store_dirs:
+        return SourceStore(args.store_dirs, args.store_size * 1024 * 1024)
+    return None
+
 
+def mirror_stats(args):
+    """Return the statistics used to order the mirrors"""
+    return MirrorStats(args.mirror_stats if args.mirror else None)
+
+
+def transfers_for_sources(sources, args, transfers, lock, store, stats):
+    """
+    Add a Transfer to the transfers dictionary, which is keyed by URL,
+    for each (path, url) pair in sources which must be downloaded.
+    A URL which is already in the dictionary is downloaded only once
+    and copied to the other paths.   lock maps upstream URLs to the
+    sha256 digests which their files must have.
+    """
+    # pylint: disable=R0913
     for path, url in sources:
         check_supported_url(url)
         if url.scheme in SUPPORTED_URL_SCHEMES:
-            if url.scheme != "file" and args.mirror:
-                if not urlparse.urlparse(args.mirror).scheme:
-                    args.mirror = "file://" + args.mirror
-                mpath = os.path.join(args.mirror, os.path.basename(url.path))
-                url = urlparse.urlparse(mpath)
+            # Stored files are keyed by the upstream URL, so that
+            # checkouts using different mirrors share them
+            store_key = urlparse.urlunparse(url)
+            expected_sha256 = lock.get(store_key)
+            if url.scheme == "file":
+                store_key = None
+            elif store and store.fetch(store_key, path, expected_sha256):
+                continue
+
+            mirrors = []
+            if url.scheme != "file":
+                mirrors = stats.order([mirror_url(mirror, url)
+                                       for mirror in args.mirror])
 
-            try:
-                fetch_http(url, path, args.retries + 1)
-
-            except pycurl.error as exn:
-                # Curl download failed
-                sys.exit("%s: Failed to fetch %s: %s" %
-                         (sys.argv[0], urlparse.urlunparse(url), exn.args[1]))
-
-            except IOError as exn:
-                # IO error saving source file
-                sys.exit("%s: %s: %s" %
-                         (sys.argv[0], exn.strerror, exn.filename))
+            url_string = urlparse.urlunparse(url)
+            if url_string not in transfers:
+                transfers[url_string] = Transfer(
+                    url, path, args.retries + 1,
+                    store if store_key else None, store_key,
+                    expected_sha256, mirrors, stats)
+            elif path != transfers[url_string].filename:
+                transfers[url_string].copies.append(path)
 
         elif url.scheme == '' and os.path.dirname(url.path) == '':
             if not os.path.exists(path):
@@ -234,6 +345,164 @@ def fetch_sources(args):
                      (sys.argv[0], url.scheme))
 
 
+def absolute_path(path):
+    """
+    Return path as an absolute path, or None if it is None.   Paths
+    sent to a fetch server must not depend on its working directory.
+    """
+    if path is None:
+        return None
+    return os.path.abspath(os.path.expanduser(path))
+
+
+def fetch_request(transfers, args):
+    """Return the request which hands transfers to a fetch server"""
+    store_dirs = None
+    if args.store_dirs:
+        store_dirs = ":".join(absolute_path(store_dir) for store_dir
+                              in args.store_dirs.split(':') if store_dir)
+    return {"transfers": [transfer.to_dict() for transfer in transfers],
+            "parallel": args.parallel,
+            "store_dirs": store_dirs,
+            "store_size": args.store_size * 1024 * 1024,
+            "mirror_stats": (absolute_path(args.mirror_stats)
+                             if args.mirror else None),
+            "lock_dir": absolute_path(args.lock_dir),
+            "host_connections": args.host_connections,
+            "bandwidth": args.bandwidth * 1024}
+
+
+def request_transfers(transfers, args):
+    """
+    Hand transfers to the fetch server listening on args.daemon.
+    Returns its response, or None if no server is running.
+    """
+    try:
+        return unix_socket_request(args.daemon,
+                                   fetch_request(transfers, args))
+    except socket.error as exn:
+        logging.debug("Fetch server unavailable, fetching directly: %s",
+                      exn)
+        return None
+
+
+def run_transfers(transfers, args):
+    """
+    Perform transfers, through the fetch server if one is running,
+    exiting with an error message if any of them fail
+    """
+    response = None
+    if args.daemon and transfers:
+        response = request_transfers(transfers, args)
+
+    if response is not None:
+        if "error" in response:
+            sys.exit(response["error"])
+        failed = [(url_string, str(errmsg))
+                  for url_string, errmsg in response["failed"]]
+    else:
+        try:
+            throttle = None
+            if args.lock_dir:
+                throttle = Throttle(args.lock_dir, args.host_connections,
+                                    args.bandwidth * 1024)
+            failed = [(transfer.url_string, transfer.error.args[1])
+                      for transfer in fetch_all(transfers, args.parallel,
+                                                throttle=throttle)]
+
+        except IOError as exn:
+            # IO error saving source file
+            sys.exit("%s: %s: %s" %
+                     (sys.argv[0], exn.strerror, exn.filename))
+
+    if failed:
+        # Curl download failed
+        sys.exit("\n".join("%s: Failed to fetch %s: %s" %
+                           (sys.argv[0], url_string, errmsg)
+                           for url_string, errmsg in failed))
+
+
+def fetch_sources(args):
+    """
+    Parse spec file and iterate over its sources, downloading them as
+    appropriate.
+    """
+    macros = parse_macros(args)
+    spec = load_spec(args.spec_or_link, args, macros)
+
+    try:
+        sources = [url_for_source(spec, source) for source in args.sources]
+    except KeyError as exn:
+        sys.exit("%s: No source corresponding to %s" % (sys.argv[0], exn))
+
+    transfers = OrderedDict()
+    stats = mirror_stats(args)
+    transfers_for_sources(sources, args, transfers,
+                          spec_lock(args, args.spec_or_link),
+                          source_store(args), stats)
+    try:
+        run_transfers(transfers.values(), args)
+    finally:
+        stats.save()
+
+
+def remote_sources(spec):
+    """
+    Return the (path, url) pairs of the sources of spec which must be
+    downloaded.   Local sources are skipped: they are part of the
+    repository or are made by other rules.   So are sources with
+    unsupported schemes, such as git://, which other tools fetch, as
+    planex-depend does not make rules for them.
+    """
+    return [(source, url) for (source, url) in spec.all_sources()
+            if url.scheme in SUPPORTED_URL_SCHEMES]
+
+
+def missing_remote_sources(spec):
+    """
+    Return the (path, url) pairs of the sources of spec which must be
+    downloaded and are not present yet.
+    """
+    return [(source, url) for (source, url) in remote_sources(spec)
+            if not os.path.exists(source)]
+
+
+def fetch_all_sources(args):
+    """
+    Parse every spec file named on the command line and download all of
+    their sources which are not already present, in one batch.
+    """
+    macros = parse_macros(args)
+    transfers = OrderedDict()
+    store = source_store(args)
+    stats = mirror_stats(args)
+    downloaded = []
+    for path in [args.spec_or_link] + args.sources:
+        if not path.endswith('.spec'):
+            logging.debug("Skipping %s", path)
+            continue
+        spec = load_spec(path, args, macros)
+        # When updating the lock file, the checksums in it are the ones
+        # being replaced, so they are not enforced
+        lock = {} if args.update_lockfile else spec_lock(args, path)
+        transfers_for_sources(missing_remote_sources(spec), args,
+                              transfers, lock, store, stats)
+        downloaded += remote_sources(spec)
+
+    logging.debug("Fetching %d sources", len(transfers))
+    try:
+        run_transfers(transfers.values(), args)
+    finally:
+        stats.save()
+
+    if args.update_lockfile:
+        # Record the checksums of every source of a known-good tree
+        lock = load_lockfile(args.lockfile)
+        for source, url in downloaded:
+            lock[urlparse.urlunparse(url)] = sha256_of_file(source)
+        write_lockfile(args.lockfile, lock)
+
+
 def fetch_via_link(args):
     """
     Parse link file and download patch tarball.
@@ -270,7 +539,14 @@ def main(argv):
     args = parse_args_or_exit(argv)
     setup_logging(args)
 
-    if args.spec_or_link.endswith('.spec'):
+    if args.serve:
+        try:
+            serve_unix_socket(args.serve, FetchServer().handle)
+        except socket.error as exn:
+            sys.exit("%s: %s" % (sys.argv[0], exn))
+    elif args.all:
+        fetch_all_sources(args)
+    elif args.spec_or_link.endswith('.spec'):
         fetch_sources(args)
     elif args.spec_or_link.endswith('.lnk'):
         fetch_via_link(args)
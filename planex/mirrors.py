@@ -0,0 +1,107 @@
+"""
+Download statistics for the hosts planex-fetch uses as mirrors.
+
+The statistics are kept in a small JSON file, shared by every
+planex-fetch process on the host, which maps each host to the average
+speed of recent downloads from it and the number of downloads from it
+which have failed since the last one succeeded.   Mirrors are tried
+healthiest and fastest first.
+"""
+
+import fcntl
+import json
+import logging
+import os
+
+# Weight given to the newest measurement in the moving average of speed
+SPEED_WEIGHT = 0.3
+
+# Number of consecutive failures after which a host is tried last
+MAX_FAILURES = 3
+
+
+def host_of(url):
+    """Return the key under which statistics for url are recorded"""
+    return url.netloc or url.scheme
+
+
+class MirrorStats(object):
+    """Download statistics for mirror hosts"""
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path) if path else None
+        self.hosts = self.load()
+        self.updates = {}
+
+    def load(self):
+        """Read the statistics file"""
+        if not self.path:
+            return {}
+        try:
+            with open(self.path) as stats_file:
+                return json.load(stats_file)
+        except (IOError, ValueError):
+            return {}
+
+    def sort_key(self, url):
+        """Return the key by which mirror URLs are ordered"""
+        stats = self.hosts.get(host_of(url), {})
+        return (min(stats.get("failures", 0), MAX_FAILURES),
+                -stats.get("speed", 0.0))
+
+    def order(self, urls):
+        """Return urls ordered healthiest and fastest host first"""
+        return sorted(urls, key=self.sort_key)
+
+    def record_success(self, url, speed):
+        """Record a completed download from url at speed bytes/second"""
+        self.updates.setdefault(host_of(url), []).append(speed)
+        self.update(host_of(url), [speed])
+
+    def record_failure(self, url):
+        """Record a failed download from url"""
+        self.updates.setdefault(host_of(url), []).append(None)
+        self.update(host_of(url), [None])
+
+    def update(self, host, results, hosts=None):
+        """
+        Apply a list of results, each a speed in bytes/second or None
+        for a failure, to the statistics for host
+        """
+        if hosts is None:
+            hosts = self.hosts
+        stats = hosts.setdefault(host, {"failures": 0, "speed": 0.0})
+        for speed in results:
+            if speed is None:
+                stats["failures"] = stats.get("failures", 0) + 1
+            else:
+                stats["failures"] = 0
+                if stats.get("speed"):
+                    stats["speed"] = (SPEED_WEIGHT * speed +
+                                      (1 - SPEED_WEIGHT) * stats["speed"])
+                else:
+                    stats["speed"] = speed
+
+    def save(self):
+        """
+        Merge the results recorded by this process into the statistics
+        file.   The file is re-read under an exclusive lock, so that
+        results from concurrent planex-fetch processes are not lost, and
+        replaced atomically.
+        """
+        if not self.path or not self.updates:
+            return
+        try:
+            with open(self.path + ".lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                hosts = self.load()
+                for host, results in self.updates.items():
+                    self.update(host, results, hosts)
+                tmp_path = "%s.%d~" % (self.path, os.getpid())
+                with open(tmp_path, "w") as stats_file:
+                    json.dump(hosts, stats_file, indent=2, sort_keys=True)
+                os.rename(tmp_path, self.path)
+        except (IOError, OSError) as exn:
+            # Losing the statistics is not fatal
+            logging.debug("Could not save mirror statistics: %s", exn)
+        self.updates = {}
@@ -13,13 +13,13 @@ import sys
 import tempfile
 
 import argcomplete
-import rpm
 
 from planex import git
 from planex.util import add_common_parser_options
 from planex.util import maybe_copy
 from planex.util import setup_logging
 from planex.util import setup_sigint_handler
+import planex.specscan
 
 
 def pinned_spec_of_spec(spec_path, src_map):
@@ -68,8 +68,7 @@ def version_of_spec_file(path):
     """
     Return the version defined in the spec file at path.
     """
-    spec = rpm.ts().parseSpec(path)
-    return spec.sourceHeader['version']
+    return planex.specscan.load(path, check_package_name=False).version()
 
 
 def update(args):
@@ -1,3 +1,3 @@
-for m in planex-{cache,fetch,pin,depend}; do
+for m in planex-{build,cache,fetch,pin,depend}; do
   eval "$(register-python-argcomplete $m)"
 done
@@ -0,0 +1,153 @@
+"""
+Index of the packages provided by a set of spec files, used to resolve
+build requirements to the binary RPMs which satisfy them.
+"""
+
+import rpm
+
+
+def split_evr(evr):
+    """Split an [epoch:]version[-release] string into its parts.
+       The release is None if evr does not include one."""
+    epoch, _, version = evr.rpartition(':')
+    version, _, release = version.partition('-')
+    return (epoch or '0', version, release or None)
+
+
+def compare_evr(evr1, evr2):
+    """
+    Compare two [epoch:]version[-release] strings, returning -1, 0 or 1.
+    As in RPM, releases are only compared if both strings include one.
+    """
+    epoch1, version1, release1 = split_evr(evr1)
+    epoch2, version2, release2 = split_evr(evr2)
+    if release1 is None or release2 is None:
+        release1 = release2 = ''
+    return rpm.labelCompare((epoch1, version1, release1),
+                            (epoch2, version2, release2))
+
+
+def satisfies(provide_oper, provide_evr, require_oper, require_evr):
+    """
+    Return True if a provide with the given operator and EVR satisfies
+    a requirement with the given operator and EVR
+    """
+    if not require_oper or provide_oper != '=':
+        # Unversioned provides satisfy every requirement.   Ranged
+        # provides are rare enough that we treat them the same way.
+        return True
+
+    cmp_result = compare_evr(provide_evr, require_evr)
+    return ((cmp_result < 0 and '<' in require_oper) or
+            (cmp_result > 0 and '>' in require_oper) or
+            (cmp_result == 0 and '=' in require_oper))
+
+
+def satisfies_all(provider, constraints):
+    """
+    Return True if provider satisfies every one of a list of
+    (operator, evr) requirement constraints
+    """
+    return all(satisfies(provider.oper, provider.evr, oper, evr)
+               for (oper, evr) in constraints)
+
+
+class Provider(object):
+    """A binary package which provides a name"""
+
+    # pylint: disable=R0903
+
+    __slots__ = ('oper', 'evr', 'rpm_path', 'target', 'spec_path')
+
+    def __init__(self, oper, evr, rpm_path, target, spec_path):
+        # pylint: disable=R0913
+        self.oper = oper
+        self.evr = evr
+        self.rpm_path = rpm_path
+        self.target = target
+        self.spec_path = spec_path
+
+
+class ProvidesIndex(object):
+    """
+    Map from provided names to the binary packages which provide them.
+
+    Every binary package (for instance a -devel subpackage) is recorded
+    with its own RPM as well as with the RPM which planex-depend uses as
+    the make target for its whole spec.   The index is built once, after
+    which each requirement is resolved with a single dictionary lookup.
+    File requirements (/usr/bin/foo) are resolved against explicit file
+    provides only, because the file lists of packages which have not
+    been built yet are not known.
+    """
+
+    def __init__(self, specs=None):
+        self.providers = {}
+        for spec in specs or []:
+            self.add_spec(spec)
+
+    def add_spec(self, spec):
+        """Add the packages provided by spec to the index"""
+        rpm_paths = spec.binary_package_paths()
+        target = rpm_paths[-1]
+        for rpm_path, provides in zip(rpm_paths, spec.package_provides()):
+            for (name, oper, evr) in provides:
+                self.providers.setdefault(name, []).append(
+                    Provider(oper, evr, rpm_path, target, spec.specpath()))
+
+    def resolve(self, name, oper='', evr=''):
+        """
+        Return the Provider which satisfies the requirement on name, or
+        None if no spec in the index provides name.   If several packages
+        provide name, the last one added which satisfies the version
+        constraint wins.   If none of them satisfies it, the last one
+        added is returned anyway: the build dependency still exists, and
+        unsatisfied_version reports the mismatch.
+        """
+        return self.resolve_all(name, [(oper, evr)])
+
+    def resolve_all(self, name, constraints):
+        """
+        As resolve, for a name required with a list of (operator, evr)
+        constraints, such as foo >= 1 and foo < 2, all of which the
+        Provider must satisfy.
+        """
+        providers = self.providers.get(name)
+        if not providers:
+            return None
+        for provider in reversed(providers):
+            if satisfies_all(provider, constraints):
+                return provider
+        return providers[-1]
+
+    def unsatisfied_version(self, name, oper, evr):
+        """Return True if name is provided but no provider satisfies the
+           version constraint"""
+        return self.unsatisfied_versions(name, [(oper, evr)])
+
+    def unsatisfied_versions(self, name, constraints):
+        """Return True if name is provided but no provider satisfies all
+           of the (operator, evr) constraints"""
+        return (name in self.providers and
+                not any(satisfies_all(provider, constraints)
+                        for provider in self.providers[name]))
+
+    def duplicates(self):
+        """Return a dictionary mapping each name provided by more than
+           one spec to the sorted list of those specs"""
+        result = {}
+        for name, providers in self.providers.items():
+            spec_paths = set(provider.spec_path for provider in providers)
+            if len(spec_paths) > 1:
+                result[name] = sorted(spec_paths)
+        return result
+
+    def __contains__(self, name):
+        return name in self.providers
+
+    def __getitem__(self, name):
+        """Return the make target of the package which provides name"""
+        provider = self.resolve(name)
+        if provider is None:
+            raise KeyError(name)
+        return provider.target
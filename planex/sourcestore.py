@@ -0,0 +1,167 @@
+"""
+Content-addressed store of downloaded sources, shared by every checkout
+on a build host.
+
+Each store directory holds the contents of downloaded files under
+objects/, named by their sha256 digest, and an index under urls/ which
+maps the sha256 of each URL to the digest of the file downloaded from
+it.   Files are reflinked, where the filesystem supports it, or copied
+between the store and SOURCES, so a tarball used by ten checkouts is
+downloaded only once.   They are never hard linked: make compares the
+timestamps of the files in SOURCES, and touching a file in one checkout
+must not touch it in every other.   Like planex-cache, the store is a
+search path: files are found in any of the directories but only added
+to the first, which is also the only one from which files are evicted.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+
+from planex import util
+
+DEFAULT_STORE_SIZE = 10 * 1024
+
+
+class SourceStore(object):
+    """A content-addressed store of downloaded sources"""
+
+    def __init__(self, store_dirs, max_size=None):
+        """
+        store_dirs is a colon-separated search path.   max_size is the
+        size in bytes to which the first directory is trimmed after
+        adding files, or None for no limit.
+        """
+        self.store_dirs = [os.path.expanduser(store_dir) for store_dir
+                           in store_dirs.split(':') if store_dir]
+        self.max_size = max_size
+
+    @staticmethod
+    def object_path(store_dir, digest):
+        """Return the path of the stored file with the given digest"""
+        return os.path.join(store_dir, "objects", digest[:2], digest)
+
+    @staticmethod
+    def url_path(store_dir, url):
+        """Return the path of the index entry for url"""
+        key = hashlib.sha256(url).hexdigest()
+        return os.path.join(store_dir, "urls", key[:2], key)
+
+    def lookup(self, url, digest=None):
+        """
+        Return the path of the stored copy of the file downloaded from
+        url, or None if it is not in the store.   If the sha256 digest
+        the file should have is known, it is looked up by digest alone:
+        objects are named by their contents, so they need not be hashed
+        again.
+        """
+        for store_dir in self.store_dirs:
+            if digest is None:
+                try:
+                    with open(self.url_path(store_dir, url)) as entry:
+                        stored_digest = entry.read().strip()
+                except IOError:
+                    continue
+            else:
+                stored_digest = digest
+            path = self.object_path(store_dir, stored_digest)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def fetch(self, url, dest, digest=None):
+        """
+        Put the stored copy of url at dest.   Returns False if url is
+        not in the store.
+        """
+        path = self.lookup(url, digest)
+        if path is None:
+            return False
+
+        method = util.clone_file(path, dest, link=False)
+        logging.debug("Source store hit for %s: %s (%s)", url, path, method)
+
+        # The copy keeps the timestamp of the stored file, so update it
+        # to keep make from treating dest as out of date
+        os.utime(dest, None)
+
+        # Mark the stored file as recently used for eviction
+        try:
+            os.utime(path, None)
+        except OSError:
+            # The store might be mounted read-only, for example.
+            pass
+        return True
+
+    def add(self, url, path, digest=None):
+        """
+        Add the file at path, downloaded from url, to the store.
+        digest is the sha256 of the file, if the caller has already
+        computed it.
+        """
+        if not self.store_dirs:
+            return
+        store_dir = self.store_dirs[0]
+        if digest is None:
+            digest = util.sha256_of_file(path)
+        object_path = self.object_path(store_dir, digest)
+        if not os.path.isfile(object_path):
+            # Objects are named by their contents, so an existing one
+            # need not be replaced
+            util.clone_file(path, object_path, link=False)
+
+        entry_path = self.url_path(store_dir, url)
+        util.makedirs(os.path.dirname(entry_path))
+        fdesc, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(entry_path),
+            prefix=".%s." % os.path.basename(entry_path), suffix="~")
+        try:
+            with os.fdopen(fdesc, "w") as entry:
+                entry.write(digest + "\n")
+            # mkstemp made the entry private to us
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_path, 0666 & ~umask)
+            os.rename(tmp_path, entry_path)
+        finally:
+            if os.path.lexists(tmp_path):
+                os.unlink(tmp_path)
+        logging.debug("Added %s to source store as %s", url, digest)
+
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used files from the first store
+        directory until it is no larger than max_size.   Index entries
+        for removed files are left behind; lookup ignores them, and they
+        are overwritten when the URL is downloaded again.
+        """
+        if self.max_size is None or not self.store_dirs:
+            return
+
+        objects = []
+        objects_dir = os.path.join(self.store_dirs[0], "objects")
+        for dirpath, _, filenames in os.walk(objects_dir):
+            for filename in filenames:
+                if filename.endswith("~"):
+                    # Another process is still writing this object
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                objects.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for (_, size, _) in objects)
+        for _, size, path in sorted(objects):
+            if total <= self.max_size:
+                break
+            logging.debug("Evicting %s from source store", path)
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
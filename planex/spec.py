@@ -52,6 +52,55 @@ def rpm_macros(macros):
         rpm.delMacro(key)
 
 
+# Package file name formats compiled by compile_name_format, keyed by the
+# expanded value of %_build_name_fmt.   None marks a format which can
+# only be expanded by librpm.
+_NAME_FORMATS = {}
+
+
+def compile_name_format(pattern):
+    """
+    Compile an expanded %_build_name_fmt pattern, such as
+    %{ARCH}/%{NAME}-%{VERSION}-%{RELEASE}.%{ARCH}.rpm, into a Python
+    format string taking NAME, VERSION, RELEASE and ARCH fields.
+    Returns None if the pattern uses any other macro.   Compiled
+    patterns are shared by every Spec in the process.
+    """
+    if pattern not in _NAME_FORMATS:
+        pieces = []
+        for token in re.split(r'(%%|%\{\w+\}|%\w+|%)', pattern):
+            tag = token.strip('%{}')
+            if token == '%%':
+                pieces.append('%%')
+            elif token.startswith('%') and tag in ('NAME', 'VERSION',
+                                                   'RELEASE', 'ARCH'):
+                pieces.append('%%(%s)s' % tag)
+            elif token.startswith('%'):
+                pieces = None
+                break
+            else:
+                pieces.append(token)
+        _NAME_FORMATS[pattern] = None if pieces is None else ''.join(pieces)
+    return _NAME_FORMATS[pattern]
+
+
+def package_file_name(pattern, name, version, release, arch):
+    """
+    Return the file name of a package, as librpm would expand the
+    %_build_name_fmt pattern with the package's NAME, VERSION, RELEASE
+    and ARCH tags, without touching librpm's macro tables unless the
+    pattern cannot be compiled.
+    """
+    # pylint: disable=R0913
+    fields = OrderedDict([('NAME', name), ('VERSION', version),
+                          ('RELEASE', release), ('ARCH', arch)])
+    name_format = compile_name_format(pattern)
+    if name_format is None:
+        with rpm_macros(fields):
+            return rpm.expandMacro(pattern)
+    return name_format % fields
+
+
 def append_macros(macros1, macros2):
     """Return an ordered dict, making sure that the macros of macros2 apppear
     after the macros in macros1, preserving their order."""
@@ -67,12 +116,78 @@ def append_macros(macros1, macros2):
     return new_dict
 
 
+def dependency_op(flags):
+    """Return the comparison operator encoded in RPM dependency flags,
+       or '' for an unversioned dependency"""
+    oper = ''
+    if flags & rpm.RPMSENSE_LESS:
+        oper += '<'
+    if flags & rpm.RPMSENSE_GREATER:
+        oper += '>'
+    if flags & rpm.RPMSENSE_EQUAL:
+        oper += '='
+    return oper
+
+
+def header_dependencies(hdr, tag):
+    """Return the (name, operator, evr) triples of the dependencies
+       stored under tag ('provide' or 'require') in hdr"""
+    return [(name, dependency_op(flags), version or '')
+            for (name, flags, version) in zip(hdr[tag + 'name'],
+                                              hdr[tag + 'flags'],
+                                              hdr[tag + 'version'])]
+
+
+def package_evr(epoch, version, release):
+    """Return the [epoch:]version-release string of a package"""
+    if epoch:
+        return "%s:%s-%s" % (epoch, version, release)
+    return "%s-%s" % (version, release)
+
+
+def normalize_provides(name, evr, provides):
+    """
+    Return the (name, operator, evr) triples provided by a binary
+    package called name, whose own version is evr.   Architecture
+    constraints are dropped and the package's implicit provide of its
+    own name is included.
+    """
+    # RPM 4.6 adds architecture constraints to dependencies.  Drop them.
+    return sorted(set((re.sub(r'\(x86-64\)$', '', provided), oper, version)
+                      for (provided, oper, version)
+                      in [(name, '=', evr)] + list(provides)))
+
+
 class SpecNameMismatch(Exception):
     """Exception raised when a spec file's name does not match the name
        of the package defined within it"""
     pass
 
 
+def check_spec_name(path, name):
+    """Raise SpecNameMismatch if the spec file at path is not called
+       after the package name it defines"""
+    file_basename = os.path.basename(path).split(".")[0]
+    if file_basename != name:
+        raise SpecNameMismatch(
+            "spec file name '%s' does not match package name '%s'"
+            % (path, name))
+
+
+class PackagePaths(object):
+    """The expanded paths of a spec's sources and of the source and
+       binary packages it produces"""
+
+    # pylint: disable=R0903
+
+    __slots__ = ('sources', 'srpm', 'rpms')
+
+    def __init__(self, sources, srpm, rpms):
+        self.sources = sources
+        self.srpm = srpm
+        self.rpms = rpms
+
+
 class Spec(object):
     """Represents an RPM spec file"""
 
@@ -123,15 +238,13 @@ class Spec(object):
                     raise
 
             if check_package_name:
-                file_basename = os.path.basename(path).split(".")[0]
-                if file_basename != self.name():
-                    raise SpecNameMismatch(
-                        "spec file name '%s' does not match package name '%s'"
-                        % (path, self.name()))
+                check_spec_name(path, self.name())
 
             self.rpmfilenamepat = rpm.expandMacro('%_build_name_fmt')
             self.srpmfilenamepat = rpm.expandMacro('%_build_name_fmt')
 
+        self._package_paths = None
+
     def specpath(self):
         """Return the path to the spec file"""
         return self.path
@@ -159,26 +272,7 @@ class Spec(object):
 
     def source_paths(self):
         """Return the filesystem paths to source files"""
-
-        # RPM only looks at the basename part of the Source URL - the
-        # part after the rightmost /.   We must match this behaviour.
-        #
-        # Examples:
-        #    http://www.example.com/foo/bar.tar.gz -> bar.tar.gz
-        #    http://www.example.com/foo/bar.cgi#/baz.tbz -> baz.tbz
-
-        hdr = self.spec.sourceHeader
-        hardcoded_macros = OrderedDict([
-            ('name', hdr['name']),
-        ])
-
-        # apply custom macros and then append the harcoded overrides
-        with rpm_macros(append_macros(self.macros, hardcoded_macros)):
-            paths = [os.path.join(rpm.expandMacro("%_sourcedir"),
-                                  os.path.basename(url))
-                     for url in self.source_urls()]
-
-        return paths
+        return list(self.package_paths().sources)
 
     # RPM build dependencies.   The 'requires' key for the *source* RPM is
     # actually the 'buildrequires' key from the spec
@@ -187,47 +281,74 @@ class Spec(object):
            (BuildRequires)"""
         return set(self.spec.sourceHeader['requires'])
 
+    def versioned_buildrequires(self):
+        """Return the build requirements of this spec as a list of
+           (name, operator, evr) triples"""
+        return sorted(set(header_dependencies(self.spec.sourceHeader,
+                                              'require')))
+
+    def package_provides(self):
+        """Return, for each binary package in the same order as
+           binary_package_paths, the list of (name, operator, evr)
+           triples which it provides"""
+        return [normalize_provides(pkg.header['name'],
+                                   package_evr(pkg.header['epoch'],
+                                               pkg.header['version'],
+                                               pkg.header['release']),
+                                   header_dependencies(pkg.header,
+                                                       'provide'))
+                for pkg in self.spec.packages]
+
     def source_package_path(self):
         """Return the path of the source package which building this
            spec will produce"""
-        hdr = self.spec.sourceHeader
-        hardcoded_macros = OrderedDict([
-            ('NAME', hdr['name']),
-            ('VERSION', hdr['version']),
-            ('RELEASE', hdr['release']),
-            ('ARCH', 'src')
-        ])
-
-        with rpm_macros(append_macros(self.macros, hardcoded_macros)):
-            # There doesn't seem to be a macro for the name of the source
-            # rpm, but the name appears to be the same as the rpm name
-            # format. Unfortunately expanding that macro gives us a leading
-            # 'src' that we don't want, so we strip that off
-            srpmname = os.path.basename(rpm.expandMacro(self.srpmfilenamepat))
-            result = os.path.join(srpmdir(), srpmname)
-
-        return result
+        return self.package_paths().srpm
 
     def binary_package_paths(self):
         """Return a list of binary packages built by this spec"""
-        def rpm_name_from_header(hdr):
-            """Return the name of the binary package file which
-               will be built from hdr"""
+        return list(self.package_paths().rpms)
+
+    def package_paths(self):
+        """Return the paths of the files which building this spec reads
+           and writes.   They are expanded on first use and then kept,
+           because expanding them means pushing and popping the whole
+           macro set through librpm."""
+        if self._package_paths is None:
+            self._package_paths = self._expand_package_paths()
+        return self._package_paths
+
+    def _expand_package_paths(self):
+        """Expand the source, source package and binary package paths
+           in a single pass over the spec's macros"""
+        hdr = self.spec.sourceHeader
 
-            hardcoded_macros = OrderedDict([
-                ('NAME', hdr['name']),
-                ('VERSION', hdr['version']),
-                ('RELEASE', hdr['release']),
-                ('ARCH', hdr['arch'])
-            ])
+        with rpm_macros(self.macros):
+            # RPM only looks at the basename part of the Source URL - the
+            # part after the rightmost /.   We must match this behaviour.
+            #
+            # Examples:
+            #    http://www.example.com/foo/bar.tar.gz -> bar.tar.gz
+            #    http://www.example.com/foo/bar.cgi#/baz.tbz -> baz.tbz
+            with rpm_macros(OrderedDict([('name', hdr['name'])])):
+                sourcedir = rpm.expandMacro("%_sourcedir")
+            sources = [os.path.join(sourcedir, os.path.basename(url))
+                       for url in self.source_urls()]
 
-            with rpm_macros(append_macros(self.macros, hardcoded_macros)):
-                rpmname = rpm.expandMacro(self.rpmfilenamepat)
-                result = os.path.join(rpmdir(), rpmname)
+            # There doesn't seem to be a macro for the name of the source
+            # rpm, but the name appears to be the same as the rpm name
+            # format. Unfortunately expanding that macro gives us a
+            # leading 'src' that we don't want, so we strip that off
+            srpm = os.path.join(srpmdir(), os.path.basename(
+                package_file_name(self.srpmfilenamepat, hdr['name'],
+                                  hdr['version'], hdr['release'], 'src')))
 
-            return result
+            rpms = [os.path.join(rpmdir(), package_file_name(
+                self.rpmfilenamepat, pkg.header['name'],
+                pkg.header['version'], pkg.header['release'],
+                pkg.header['arch']))
+                    for pkg in self.spec.packages]
 
-        return [rpm_name_from_header(pkg.header) for pkg in self.spec.packages]
+        return PackagePaths(sources, srpm, rpms)
 
     def highest_patch(self):
         """Return the number the highest numbered patch or -1"""
@@ -240,3 +361,121 @@ class Spec(object):
         """Get all sources defined in the spec file"""
         urls = [urlparse.urlparse(url) for url in self.source_urls()]
         return zip(self.source_paths(), urls)
+
+
+class SpecSummary(object):
+    """A plain-data snapshot of the information planex derives from a
+       spec file.   It answers the same queries as Spec, but holds no
+       reference to librpm, so it can be pickled or stored as JSON."""
+
+    # pylint: disable=R0902
+
+    __slots__ = ('path', 'pkg_name', 'pkg_version', 'provided',
+                 'buildrequired', 'urls', 'paths', 'srpm_path',
+                 'rpm_paths', 'rpm_provides', 'buildrequire_deps')
+
+    def __init__(self, path, pkg_name, pkg_version, provided,
+                 buildrequired, urls, paths, srpm_path, rpm_paths,
+                 rpm_provides, buildrequire_deps):
+        # pylint: disable=R0913
+        self.path = path
+        self.pkg_name = pkg_name
+        self.pkg_version = pkg_version
+        self.provided = provided
+        self.buildrequired = buildrequired
+        self.urls = urls
+        self.paths = paths
+        self.srpm_path = srpm_path
+        self.rpm_paths = rpm_paths
+        self.rpm_provides = rpm_provides
+        self.buildrequire_deps = buildrequire_deps
+
+    @classmethod
+    def of_spec(cls, spec):
+        """Return the summary of a parsed Spec"""
+        return cls(path=spec.specpath(),
+                   pkg_name=spec.name(),
+                   pkg_version=spec.version(),
+                   provided=sorted(spec.provides()),
+                   buildrequired=sorted(spec.buildrequires()),
+                   urls=spec.source_urls(),
+                   paths=spec.source_paths(),
+                   srpm_path=spec.source_package_path(),
+                   rpm_paths=spec.binary_package_paths(),
+                   rpm_provides=spec.package_provides(),
+                   buildrequire_deps=spec.versioned_buildrequires())
+
+    @classmethod
+    def from_dict(cls, fields):
+        """Return the summary described by a dictionary produced by
+           to_dict"""
+        def native(value):
+            """JSON decodes strings as unicode; convert them back"""
+            if isinstance(value, unicode):
+                return value.encode('utf-8')
+            if isinstance(value, list):
+                return [native(item) for item in value]
+            return value
+
+        return cls(**dict((str(key), native(value))
+                          for key, value in fields.items()))
+
+    def to_dict(self):
+        """Return the summary as a dictionary suitable for json.dump"""
+        return dict((field, getattr(self, field))
+                    for field in self.__slots__)
+
+    def specpath(self):
+        """Return the path to the spec file"""
+        return self.path
+
+    def provides(self):
+        """Return a list of package names provided by this spec"""
+        return set(self.provided)
+
+    def name(self):
+        """Return the package name"""
+        return self.pkg_name
+
+    def version(self):
+        """Return the package version"""
+        return self.pkg_version
+
+    def source_urls(self):
+        """Return the URLs from which the sources can be downloaded"""
+        return list(self.urls)
+
+    def source_paths(self):
+        """Return the filesystem paths to source files"""
+        return list(self.paths)
+
+    def buildrequires(self):
+        """Return the set of packages needed to build this spec
+           (BuildRequires)"""
+        return set(self.buildrequired)
+
+    def versioned_buildrequires(self):
+        """Return the build requirements of this spec as a list of
+           (name, operator, evr) triples"""
+        return [tuple(dep) for dep in self.buildrequire_deps]
+
+    def package_provides(self):
+        """Return, for each binary package in the same order as
+           binary_package_paths, the list of (name, operator, evr)
+           triples which it provides"""
+        return [[tuple(dep) for dep in provides]
+                for provides in self.rpm_provides]
+
+    def source_package_path(self):
+        """Return the path of the source package which building this
+           spec will produce"""
+        return self.srpm_path
+
+    def binary_package_paths(self):
+        """Return a list of binary packages built by this spec"""
+        return list(self.rpm_paths)
+
+    def all_sources(self):
+        """Get all sources defined in the spec file"""
+        urls = [urlparse.urlparse(url) for url in self.urls]
+        return zip(self.paths, urls)
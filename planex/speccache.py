@@ -0,0 +1,200 @@
+"""
+Persistent cache of the information planex derives from spec files.
+
+Parsing a spec with librpm is by far the most expensive thing
+planex-depend does.   The cache stores a SpecSummary for every spec
+it sees, keyed on the contents of the spec file and the ordered list of
+macros it was parsed with, so an unchanged spec is never handed to
+librpm twice.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+import rpm
+
+from planex import specscan
+from planex.spec import Spec, SpecSummary, check_spec_name
+from planex.util import makedirs
+
+# Change this whenever the format of a cache entry changes
+SPEC_CACHE_SALT = "planex-spec-cache-2"
+
+# Coarsest file modification time resolution we expect to meet, in
+# seconds.   A spec modified less than this long before its stat index
+# entry was written may have been edited again without its metadata
+# changing, so its contents are always rehashed.
+MTIME_GRANULARITY = 2.0
+
+
+def parse_mode(fast_scan):
+    """Return the name of the parser used to summarize specs"""
+    return "specscan" if fast_scan else "librpm"
+
+
+def cache_key(path, spectext, defines, fast_scan=False):
+    """
+    Return the cache key for the spec at path, whose contents are
+    spectext, parsed with the given ordered macro definitions.
+    The path is part of the key because RPM's %_specdir is derived
+    from it.   The parser is part of the key so that summaries made by
+    the scanner are never served to callers which asked for librpm.
+    """
+    key = hashlib.sha256()
+    key.update(SPEC_CACHE_SALT)
+    key.update(rpm.__version__)
+    key.update(parse_mode(fast_scan))
+    key.update(repr(path))
+    key.update(repr([tuple(define) for define in defines or []]))
+    key.update(spectext)
+    return key.hexdigest()
+
+
+def stat_signature(stat):
+    """
+    Return a summary of the inode metadata in stat which changes whenever
+    the file is rewritten or replaced, unless it is rewritten within the
+    mtime granularity of its filesystem.
+    """
+    return [repr(stat.st_mtime), stat.st_size, stat.st_ino]
+
+
+def read_json(path):
+    """Return the JSON document stored at path, or None"""
+    try:
+        with open(path) as entry:
+            return json.load(entry)
+    except (IOError, ValueError):
+        return None
+
+
+def write_json(path, document):
+    """
+    Write document to path.   The document is written to a temporary
+    file and renamed into place, so concurrent readers never see a
+    partial entry.   Failures are logged but are not fatal.
+    """
+    try:
+        entry_dir = os.path.dirname(path)
+        makedirs(entry_dir)
+        with tempfile.NamedTemporaryFile(dir=entry_dir, delete=False) as tmp:
+            json.dump(document, tmp)
+        os.rename(tmp.name, path)
+    except (IOError, OSError) as exn:
+        logging.debug("Could not write spec cache entry %s: %s", path, exn)
+
+
+class SpecCache(object):
+    """
+    A directory of parsed spec summaries.
+
+    Summaries are stored under their content key.   A second, smaller
+    index maps each spec path (and macro list) to the inode metadata
+    and content key it had when it was last loaded, so that specs which
+    have not been touched since the previous run do not even need to be
+    read and hashed.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+
+    def entry_path(self, key):
+        """Return the path of the cache entry for key"""
+        return os.path.join(self.cache_dir, key[:2], key[2:] + ".json")
+
+    def stat_entry_path(self, path, defines, fast_scan=False):
+        """
+        Return the path of the stat index entry for path.   Like the
+        content key, it depends on the cache format and the version of
+        librpm, so that an upgrade does not take the fast path to
+        summaries made by the old version.
+        """
+        index_key = hashlib.sha256(
+            repr((SPEC_CACHE_SALT, rpm.__version__,
+                  os.path.abspath(path),
+                  [tuple(define) for define in defines or []],
+                  parse_mode(fast_scan))))
+        return os.path.join(self.cache_dir, "stat",
+                            index_key.hexdigest() + ".json")
+
+    def lookup(self, key):
+        """Return the cached summary for key, or None"""
+        document = read_json(self.entry_path(key))
+        if document is None:
+            return None
+        try:
+            return SpecSummary.from_dict(document)
+        except (KeyError, TypeError):
+            # Entries written by other versions are simply misses
+            return None
+
+    def store(self, key, summary):
+        """Write summary to the cache"""
+        write_json(self.entry_path(key), summary.to_dict())
+
+    def unchanged_key(self, path, defines, fast_scan=False):
+        """
+        Return the content key recorded for path if the file has not
+        changed since it was recorded, otherwise None.   As in git's
+        racy-clean check, an entry recorded too soon after the file was
+        last modified is not trusted, because a same-size edit in the
+        same timestamp tick would leave the metadata unchanged.
+        """
+        entry = read_json(self.stat_entry_path(path, defines, fast_scan))
+        if entry is None:
+            return None
+        stat = os.stat(path)
+        if entry.get("stat") != stat_signature(stat):
+            return None
+        if stat.st_mtime + MTIME_GRANULARITY >= entry.get("recorded", 0):
+            return None
+        return str(entry.get("key"))
+
+    def load(self, path, check_package_name=True, defines=None,
+             fast_scan=False):
+        """
+        Return a SpecSummary of the spec at path, parsing it only if it
+        is not already in the cache.   If fast_scan is True, specs are
+        read with planex.specscan where possible instead of librpm.
+        """
+        summary = None
+        key = self.unchanged_key(path, defines, fast_scan)
+        if key is not None:
+            summary = self.lookup(key)
+
+        if summary is None:
+            # Take the time before reading the file, so that an edit
+            # made while we read it makes the entry look racy
+            recorded = time.time()
+            signature = stat_signature(os.stat(path))
+            with open(path) as spec:
+                spectext = spec.read()
+            key = cache_key(path, spectext, defines, fast_scan)
+            summary = self.lookup(key)
+            write_json(self.stat_entry_path(path, defines, fast_scan),
+                       {"stat": signature, "key": key,
+                        "recorded": recorded})
+
+        if summary is not None:
+            self.hits += 1
+            if check_package_name:
+                check_spec_name(path, summary.name())
+            return summary
+
+        self.misses += 1
+        if fast_scan:
+            summary = specscan.load(path,
+                                    check_package_name=check_package_name,
+                                    defines=defines)
+        else:
+            summary = SpecSummary.of_spec(
+                Spec(path, check_package_name=check_package_name,
+                     defines=defines))
+        self.store(key, summary)
+        return summary
@@ -0,0 +1,383 @@
+"""
+A lightweight, pure-Python scanner for the subset of spec files which
+planex can evaluate without librpm.
+
+Many planex commands only need the header of a spec: its name, version,
+release, sources, provides and build requirements.   For specs which
+only use simple macros (%define, %global, the header tags and the macros
+planex itself passes with --define), all of these can be read directly
+from the text of the spec, which is much cheaper than rpm.ts().parseSpec.
+Whenever the scanner meets a construct it cannot evaluate - conditionals,
+shell expansions, macros defined by the system configuration and so on -
+it raises ScanFallback and the caller parses the spec with librpm
+instead.
+"""
+
+import logging
+import os
+import re
+from collections import OrderedDict
+
+import rpm
+
+from planex.spec import Spec, SpecSummary, check_spec_name
+from planex.spec import normalize_provides, package_evr, package_file_name
+from planex.spec import rpm_macros, rpmdir, srpmdir
+
+
+# Number of specs answered by the scanner, and number which had to be
+# parsed by librpm instead
+STATS = {'scanned': 0, 'fallback': 0}
+
+# Lines which start a new section of a spec file.   Only %package
+# starts a new preamble; the bodies of all other sections are skipped.
+SECTIONS = ['%package', '%description', '%prep', '%build', '%install',
+            '%check', '%clean', '%files', '%changelog', '%pre', '%post',
+            '%preun', '%postun', '%pretrans', '%posttrans', '%verifyscript',
+            '%triggerprein', '%triggerin', '%triggerun', '%triggerpostun']
+
+CONDITIONALS = ['%if', '%ifarch', '%ifnarch', '%ifos', '%ifnos']
+
+TAG_RE = re.compile(r'^([A-Za-z]+[0-9]*)\s*:\s*(.*?)\s*$')
+MACRO_NAME_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+MACRO_REF_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+SOURCE_TAG_RE = re.compile(r'^(source|patch)[0-9]*$')
+DEP_OPERATORS = ['<', '>', '=', '<=', '>=', '==']
+
+MAX_EXPANSION_DEPTH = 16
+
+
+class ScanFallback(Exception):
+    """Exception raised when a spec uses a construct which the scanner
+       cannot evaluate"""
+    pass
+
+
+def parse_dependencies(text):
+    """
+    Return the dependencies in a Provides or BuildRequires value as a
+    list of (name, operator, evr) triples.
+    """
+    if text.startswith('('):
+        raise ScanFallback("rich dependency %s" % text)
+
+    dependencies = []
+    tokens = text.replace(',', ' ').split()
+    while tokens:
+        name = tokens.pop(0)
+        if tokens and tokens[0] in DEP_OPERATORS:
+            if len(tokens) < 2:
+                raise ScanFallback("malformed dependency %s" % text)
+            oper = tokens.pop(0).replace('==', '=')
+            dependencies.append((name, oper, tokens.pop(0)))
+        else:
+            dependencies.append((name, '', ''))
+    return dependencies
+
+
+class Package(object):
+    """A package declared by a spec file"""
+
+    # pylint: disable=R0903
+
+    __slots__ = ('name', 'epoch', 'version', 'release', 'arch', 'provides')
+
+    def __init__(self, name):
+        self.name = name
+        self.epoch = None
+        self.version = None
+        self.release = None
+        self.arch = None
+        self.provides = []
+
+
+class SpecScanner(object):
+    """The header information of a spec file, read without librpm"""
+
+    def __init__(self, path, defines=None):
+        self.path = path
+        self.defines = OrderedDict(defines) if defines else OrderedDict()
+        if 'dist' not in self.defines:
+            # Spec always overrides %dist, see Spec.__init__
+            self.defines['dist'] = ""
+
+        self.macros = {}
+        self.packages = []
+        self.sources = []
+        self.buildrequires = []
+
+        with open(path) as spec:
+            self.scan(spec)
+
+        if not self.packages or self.packages[0].name is None:
+            raise ScanFallback("no Name tag")
+        main = self.packages[0]
+        if main.version is None or main.release is None:
+            raise ScanFallback("no Version or Release tag")
+        for package in self.packages[1:]:
+            package.epoch = package.epoch or main.epoch
+            package.version = package.version or main.version
+            package.release = package.release or main.release
+            package.arch = package.arch or main.arch
+
+    def lookup(self, name, depth):
+        """Return the expanded value of the macro called name, or None
+           if it is not defined by the spec or by planex"""
+        if name == 'nil':
+            return ""
+        if name in self.macros:
+            value = self.macros[name]
+        elif name in self.defines:
+            value = self.defines[name]
+        else:
+            return None
+
+        if value is None:
+            raise ScanFallback("parametric macro %%%s" % name)
+        return self.expand(value, depth + 1)
+
+    def expand(self, text, depth=0):
+        """Expand the macros in text"""
+        # pylint: disable=R0912
+
+        if depth > MAX_EXPANSION_DEPTH:
+            raise ScanFallback("macro recursion in %s" % text)
+
+        result = []
+        pos = 0
+        while True:
+            start = text.find('%', pos)
+            if start < 0 or start == len(text) - 1:
+                result.append(text[pos:])
+                return "".join(result)
+            result.append(text[pos:start])
+
+            char = text[start + 1]
+            if char == '%':
+                result.append('%')
+                pos = start + 2
+                continue
+
+            if char == '{':
+                end = text.find('}', start)
+                if end < 0:
+                    raise ScanFallback("unterminated macro in %s" % text)
+                name = text[start + 2:end]
+                pos = end + 1
+            else:
+                match = MACRO_REF_RE.match(text, start + 1)
+                if not match:
+                    raise ScanFallback("unsupported macro in %s" % text)
+                name = match.group(0)
+                pos = match.end()
+
+            if name.startswith('?'):
+                name = name[1:]
+            if not MACRO_NAME_RE.match(name):
+                raise ScanFallback("unsupported macro %%{%s}" % name)
+
+            value = self.lookup(name, depth)
+            if value is None:
+                # A macro we do not know about might be defined by the
+                # system configuration, so even %{?name} is ambiguous
+                raise ScanFallback("unknown macro %%%s" % name)
+            result.append(value)
+
+    def define(self, line, eager):
+        """Handle a %define or %global line"""
+        parts = line.split(None, 2)
+        if len(parts) < 3:
+            raise ScanFallback("malformed macro definition %s" % line)
+        name, body = parts[1], parts[2].strip()
+        if body.endswith('\\'):
+            raise ScanFallback("multi-line macro %s" % name)
+        if not MACRO_NAME_RE.match(name):
+            # Parametric macros are only a problem if they are used
+            self.macros[name.split('(')[0]] = None
+            return
+        self.macros[name] = self.expand(body) if eager else body
+
+    def new_package(self, line):
+        """Handle a %package line"""
+        args = line.split()[1:]
+        if not self.packages or not args:
+            raise ScanFallback("malformed %s" % line)
+        if args[0] == '-n' and len(args) == 2:
+            name = self.expand(args[1])
+        elif len(args) == 1 and not args[0].startswith('-'):
+            name = "%s-%s" % (self.packages[0].name, self.expand(args[0]))
+        else:
+            raise ScanFallback("unsupported %s" % line)
+        self.packages.append(Package(name))
+
+    def tag(self, tag, value):
+        """Handle a tag in the preamble of the current package"""
+        # pylint: disable=R0912
+
+        tag = tag.lower()
+        package = self.packages[-1] if self.packages else None
+
+        if tag == 'name':
+            if package is not None:
+                raise ScanFallback("Name tag outside main preamble")
+            package = Package(self.expand(value))
+            self.packages.append(package)
+            self.macros['name'] = package.name
+        elif package is None:
+            raise ScanFallback("%s tag before Name tag" % tag)
+        elif tag in ['version', 'release', 'epoch']:
+            expanded = self.expand(value)
+            setattr(package, tag, expanded)
+            if package is self.packages[0]:
+                self.macros[tag] = expanded
+        elif SOURCE_TAG_RE.match(tag):
+            self.sources.append(self.expand(value))
+        elif tag in ['buildrequires', 'buildprereq']:
+            self.buildrequires.extend(
+                parse_dependencies(self.expand(value)))
+        elif tag == 'provides':
+            package.provides.extend(parse_dependencies(self.expand(value)))
+        elif tag in ['buildarch', 'buildarchitectures']:
+            package.arch = self.expand(value)
+
+    def scan(self, lines):
+        """Scan the lines of a spec file"""
+        # pylint: disable=R0912
+
+        in_preamble = True
+        conditional_depth = 0
+
+        for line in lines:
+            stripped = line.strip()
+            if not stripped or stripped.startswith('#'):
+                continue
+            keyword = stripped.split()[0]
+
+            if keyword in CONDITIONALS:
+                conditional_depth += 1
+                continue
+            if keyword == '%endif':
+                conditional_depth -= 1
+                continue
+            if keyword in ['%else', '%elif', '%elifarch', '%elifos']:
+                continue
+
+            significant = (keyword in ['%define', '%global', '%undefine',
+                                       '%include', '%package'] or
+                           (in_preamble and keyword not in SECTIONS))
+            if significant and conditional_depth > 0:
+                raise ScanFallback("conditional %s" % stripped)
+
+            if keyword in ['%define', '%global']:
+                self.define(stripped, keyword == '%global')
+            elif keyword == '%undefine':
+                self.macros.pop(stripped.split()[-1], None)
+            elif keyword == '%include':
+                raise ScanFallback(stripped)
+            elif keyword == '%package':
+                self.new_package(stripped)
+                in_preamble = True
+            elif keyword in SECTIONS:
+                in_preamble = False
+            elif in_preamble:
+                if stripped.endswith('\\'):
+                    raise ScanFallback("continued line %s" % stripped)
+                match = TAG_RE.match(stripped)
+                if match:
+                    self.tag(match.group(1), match.group(2))
+                elif stripped.startswith('%'):
+                    raise ScanFallback("unsupported %s" % stripped)
+
+    def builds_debuginfo(self):
+        """Return True unless the spec or planex disables the automatic
+           -debuginfo package, which librpm adds while parsing"""
+        try:
+            return self.lookup('debug_package', 0) != ""
+        except ScanFallback:
+            return True
+
+    def summary(self, check_package_name=True):
+        """Return a SpecSummary of the scanned spec"""
+        main = self.packages[0]
+        if check_package_name:
+            check_spec_name(self.path, main.name)
+        if self.builds_debuginfo():
+            raise ScanFallback("spec may build a -debuginfo package")
+
+        # The directories and file name format come from the system
+        # configuration, so they are expanded by librpm.   This only
+        # touches the macro tables; the spec is not parsed.
+        macros = OrderedDict(self.defines)
+        macros['name'] = main.name
+        with rpm_macros(macros):
+            sourcedir = rpm.expandMacro('%_sourcedir')
+            default_arch = rpm.expandMacro('%_target_cpu')
+            namefmt = rpm.expandMacro('%_build_name_fmt')
+
+            def package_path(package, arch, directory):
+                """Return the path of a package file"""
+                return os.path.join(directory, package_file_name(
+                    namefmt, package.name, package.version,
+                    package.release, arch))
+
+            srpm = os.path.join(
+                srpmdir(), os.path.basename(package_path(main, 'src', '')))
+            rpms = [package_path(package, package.arch or default_arch,
+                                 rpmdir())
+                    for package in self.packages]
+
+        rpm_provides = [normalize_provides(package.name,
+                                           package_evr(package.epoch,
+                                                       package.version,
+                                                       package.release),
+                                           package.provides)
+                        for package in self.packages]
+        provides = set(name for provides in rpm_provides
+                       for (name, _, _) in provides)
+
+        return SpecSummary(
+            path=os.path.join(os.path.dirname(self.path),
+                              os.path.basename(self.path)),
+            pkg_name=main.name,
+            pkg_version=main.version,
+            provided=sorted(provides),
+            buildrequired=sorted(set(name for (name, _, _)
+                                     in self.buildrequires)),
+            urls=list(self.sources),
+            paths=[os.path.join(sourcedir, os.path.basename(url))
+                   for url in self.sources],
+            srpm_path=srpm,
+            rpm_paths=rpms,
+            rpm_provides=rpm_provides,
+            buildrequire_deps=sorted(set(self.buildrequires)))
+
+
+def scan(path, check_package_name=True, defines=None):
+    """
+    Return a SpecSummary of the spec at path without parsing it with
+    librpm.   Raises ScanFallback if the spec cannot be scanned.
+    """
+    return SpecScanner(path, defines).summary(check_package_name)
+
+
+def load(path, check_package_name=True, defines=None):
+    """
+    Return a SpecSummary of the spec at path, scanning it if possible
+    and parsing it with librpm otherwise.
+    """
+    try:
+        summary = scan(path, check_package_name, defines)
+        STATS['scanned'] += 1
+        return summary
+    except ScanFallback as exn:
+        logging.debug("Parsing %s with librpm: %s", path, exn)
+        STATS['fallback'] += 1
+        return SpecSummary.of_spec(
+            Spec(path, check_package_name=check_package_name,
+                 defines=defines))
+
+
+def report():
+    """Return a one-line summary of how often the scanner was used"""
+    return ("%d specs scanned, %d parsed by librpm" %
+            (STATS['scanned'], STATS['fallback']))
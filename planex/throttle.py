@@ -0,0 +1,113 @@
+"""
+Limits on the load which concurrent planex-fetch processes put on
+upstream servers.
+
+The limits hold across every process which uses the same lock
+directory: each host has a fixed number of slot files, and a download
+may only run while it holds an flock on one of them; and downloads draw
+from a token bucket, kept in a file, which refills at the configured
+bandwidth.
+"""
+
+import fcntl
+import logging
+import os
+import random
+import time
+
+from planex.util import makedirs
+
+# Bytes drawn from the shared token bucket at a time, so that the bucket
+# file is not locked for every block curl writes
+BUCKET_BATCH = 256 * 1024
+
+# Bounds of the delay before retrying a failed download, in seconds
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+
+def backoff_delay(attempt, retry_after=None):
+    """
+    Return the number of seconds to wait before retry number attempt:
+    exponential backoff with full jitter, or the delay the server asked
+    for in a Retry-After header if that is longer
+    """
+    delay = random.uniform(0, min(BACKOFF_MAX,
+                                  BACKOFF_BASE * 2 ** max(attempt - 1, 0)))
+    try:
+        return max(delay, min(float(retry_after), BACKOFF_MAX))
+    except (TypeError, ValueError):
+        # Retry-After is missing, or an HTTP date which we ignore
+        return delay
+
+
+class Throttle(object):
+    """Per-host connection slots and a shared bandwidth limit"""
+
+    def __init__(self, lock_dir, host_connections, bandwidth=0):
+        """
+        host_connections is the number of downloads which may run at
+        once from each host.   bandwidth is the total rate in bytes per
+        second shared by all downloads, or 0 for no limit.
+        """
+        self.lock_dir = lock_dir
+        self.host_connections = host_connections
+        self.bandwidth = bandwidth
+        self.drawn = 0
+        makedirs(lock_dir)
+
+    def acquire(self, host):
+        """
+        Take a download slot for host.   Returns the slot, to be passed
+        to release, or None if all of the host's slots are taken.
+        """
+        for index in range(self.host_connections):
+            path = os.path.join(self.lock_dir, "%s.%d.slot" % (host, index))
+            slot = open(path, "a")
+            try:
+                fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot
+            except IOError:
+                slot.close()
+        return None
+
+    @staticmethod
+    def release(slot):
+        """Give back a slot taken by acquire"""
+        slot.close()
+
+    def consume(self, nbytes):
+        """
+        Account for nbytes downloaded.   Returns the number of seconds
+        for which the download should pause because the downloads sharing
+        the lock directory have used more than their bandwidth, or 0.
+        """
+        if not self.bandwidth:
+            return 0
+        self.drawn += nbytes
+        if self.drawn < BUCKET_BATCH:
+            return 0
+
+        with open(os.path.join(self.lock_dir, "bandwidth"), "a+") as bucket:
+            fcntl.flock(bucket, fcntl.LOCK_EX)
+            bucket.seek(0)
+            now = time.time()
+            try:
+                tokens, last = [float(field) for field
+                                in bucket.read().split()]
+            except ValueError:
+                tokens, last = self.bandwidth, now
+            # Allow a burst of up to one second's worth
+            tokens = min(self.bandwidth,
+                         tokens + (now - last) * self.bandwidth)
+            tokens -= self.drawn
+            bucket.seek(0)
+            bucket.truncate()
+            bucket.write("%f %f\n" % (tokens, now))
+        self.drawn = 0
+
+        if tokens < 0:
+            logging.debug("Bandwidth limit reached, pausing for %.2fs",
+                          -tokens / self.bandwidth)
+            return -tokens / self.bandwidth
+        return 0
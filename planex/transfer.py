@@ -0,0 +1,679 @@
+"""
+Curl transfers used by planex-fetch: downloading sources, concurrently
+and with retries, checking their format and checksum as they arrive.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+import urlparse
+
+import pkg_resources
+import pycurl
+
+from planex.mirrors import host_of
+from planex.throttle import backoff_delay
+from planex.util import clone_file
+from planex.util import sha256_of_file
+
+
+# This should include all of the extensions in the Makefile.rules for fetch
+SUPPORTED_EXT_TO_MIME = {
+    '.tar': 'application/x-tar',
+    '.gz': 'application/x-gzip',
+    '.tgz': 'application/x-gzip',
+    '.txz': 'application/x-xz',
+    '.xz': 'application/x-xz',
+    '.bz2': 'application/x-bzip2',
+    '.tbz': 'application/x-bzip2',
+    '.zip': 'application/zip',
+    '.pdf': 'application/pdf',
+    '.patch': 'text/x-diff'
+}
+
+# Magic numbers of the formats in SUPPORTED_EXT_TO_MIME, as
+# (offset, magic, mime-type)
+MAGIC_NUMBERS = [
+    (0, '\x1f\x8b', 'application/x-gzip'),
+    (0, 'BZh', 'application/x-bzip2'),
+    (0, '\xfd7zXZ\x00', 'application/x-xz'),
+    (0, 'PK\x03\x04', 'application/zip'),
+    (0, 'PK\x05\x06', 'application/zip'),
+    (0, '%PDF-', 'application/pdf'),
+    (257, 'ustar', 'application/x-tar')
+]
+
+# Number of bytes at the start of a file used to decide its format
+SNIFF_SIZE = 4096
+
+# Size of a tar header block
+TAR_BLOCK_SIZE = 512
+
+# Schemes for which a failed download can be resumed with a range request
+RESUMABLE_URL_SCHEMES = ["http", "https", "ftp"]
+
+
+def setup_curl(curl, url_string, write_function):
+    """
+    Set the options used for every download on a curl handle, which
+    may be reused from an earlier transfer so that its connections
+    are kept open
+    """
+    curl.reset()
+
+    # General options
+    useragent = "planex-fetch/%s" % pkg_resources.require("planex")[0].version
+    curl.setopt(pycurl.USERAGENT, useragent)
+    curl.setopt(pycurl.FOLLOWLOCATION, True)
+    curl.setopt(pycurl.MAXREDIRS, 5)
+    curl.setopt(pycurl.CONNECTTIMEOUT, 30)
+    curl.setopt(pycurl.TIMEOUT, 300)
+    curl.setopt(pycurl.FAILONERROR, True)
+
+    # Cribbed from /usr/lib64/python2.6/site-packages/curl/__init__.py
+    curl.setopt(pycurl.SSL_VERIFYHOST, 2)
+    curl.setopt(pycurl.COOKIEFILE, "/dev/null")
+    curl.setopt(pycurl.NETRC, 1)
+    # If we use threads, we should also set NOSIGNAL and ignore SIGPIPE
+
+    # Set URL to fetch and function to which to pass the response
+    curl.setopt(pycurl.URL, url_string)
+    curl.setopt(pycurl.WRITEFUNCTION, write_function)
+
+
+def make_dir(path):
+    """
+    Ensure that path exists
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+
+def is_tar_header(data):
+    """
+    Return True if data starts with a tar header block.   Pre-POSIX
+    (V7) archives have no ustar magic, so the header is recognised by
+    its checksum: the sum of the bytes of the block, counting the
+    checksum field itself as spaces.   Some old implementations summed
+    signed bytes, so both sums are accepted.
+    """
+    if len(data) < TAR_BLOCK_SIZE or data[0] == '\0':
+        return False
+    try:
+        recorded = int(data[148:156].strip(' \0'), 8)
+    except ValueError:
+        return False
+    header = data[:148] + ' ' * 8 + data[156:TAR_BLOCK_SIZE]
+    unsigned = sum(ord(char) for char in header)
+    signed = unsigned - 256 * sum(1 for char in header if ord(char) > 127)
+    return recorded in (unsigned, signed)
+
+
+def sniff_mime_type(data):
+    """
+    Return the mime-type of a file, judged from its first SNIFF_SIZE
+    bytes, or None if it is not a format planex-fetch knows about
+    """
+    for offset, magic, mime_type in MAGIC_NUMBERS:
+        if data[offset:offset + len(magic)] == magic:
+            return mime_type
+    if is_tar_header(data):
+        return 'application/x-tar'
+
+    if '\0' in data:
+        return None
+    start = data.lstrip()[:64].lower()
+    if start.startswith("<!doctype html") or start.startswith("<html"):
+        return 'text/html'
+    if re.search(r'^(diff |--- |\+\+\+ |Index: |@@ )', data, re.MULTILINE):
+        return 'text/x-diff'
+    return 'text/plain'
+
+
+def format_matches(ext, data):
+    """
+    Return the mime-type of data if it does not match the format
+    expected for a file with extension ext, or None if it does or the
+    extension is not one planex-fetch knows about
+    """
+    expected = SUPPORTED_EXT_TO_MIME.get(ext)
+    mime_type = sniff_mime_type(data)
+    if expected is None or mime_type == expected:
+        return None
+    if expected == 'text/x-diff' and mime_type == 'text/plain':
+        # A patch may start with a long description
+        return None
+    return mime_type or 'unknown'
+
+
+def best_effort_file_verify(path, name=None):
+    """
+    Given a path, check if the file at that path has a sensible format.
+    If the file (or name, if given) has an extension then it checks that
+    the mime-type of this file matches that of the file extension as
+    defined by the IANA:
+        http://www.iana.org/assignments/media-types/media-types.xhtml
+    """
+    _, ext = os.path.splitext(name or path)
+    if ext and ext in SUPPORTED_EXT_TO_MIME:
+        with open(path, 'rb') as in_f:
+            mime_type = format_matches(ext, in_f.read(SNIFF_SIZE))
+
+        if mime_type:
+            sys.exit("%s: Fetched file format looks incorrect: %s: %s" %
+                     (sys.argv[0], path, mime_type))
+
+
+def meta_path(filename):
+    """
+    Return the path of the file which records the HTTP validators of a
+    downloaded source
+    """
+    return filename + ".meta"
+
+
+def load_meta(filename, url_string):
+    """
+    Return the HTTP validators recorded for filename, or an empty
+    dictionary if they are missing, were recorded for a different URL
+    or no longer match the file
+    """
+    try:
+        with open(meta_path(filename)) as meta_file:
+            meta = json.load(meta_file)
+        size = os.path.getsize(filename)
+    except (IOError, OSError, ValueError):
+        return {}
+    if meta.get("url") != url_string or \
+            meta.get("content_length", size) != size:
+        return {}
+    return meta
+
+
+def save_meta(filename, meta):
+    """Record the HTTP validators of a downloaded source"""
+    tmp_path = meta_path(filename) + "~"
+    with open(tmp_path, "w") as meta_file:
+        json.dump(meta, meta_file, indent=2, sort_keys=True)
+    os.rename(tmp_path, meta_path(filename))
+
+
+class Transfer(object):
+    """
+    A download of url to filename.   The response is written to a
+    temporary file which is only moved into place once it is complete
+    and looks like the right kind of file.
+
+    If filename was downloaded from the same URL before, the request is
+    made conditional on the ETag and Last-Modified validators recorded
+    then, and a 304 Not Modified response just refreshes the timestamp
+    of the existing file, once it has been checked against the digest
+    recorded in the lock file, if there is one.
+
+    The format of the file is checked against its extension as soon as
+    its first SNIFF_SIZE bytes arrive, so that an error page served in
+    place of a large tarball is abandoned without downloading the rest.
+
+    The sha256 of the file is computed as it is written, and checked
+    against the digest recorded in a lock file, if there is one.
+
+    A retry after a failed attempt resumes from the end of the partial
+    temporary file with a Range request, guarded by If-Range so that
+    the server sends the whole file again if it has changed.
+
+    Each retry waits for an exponentially growing, jittered delay, or
+    as long as the server asked in a Retry-After header.
+
+    If mirrors are given, they are tried in order before url.   A
+    failure on a mirror moves on to the next one without using up a
+    retry, because a mirror may simply not have the file.
+    """
+
+    # pylint: disable=R0902
+
+    def __init__(self, url, filename, retries, store=None, store_key=None,
+                 expected_sha256=None, mirrors=None, stats=None):
+        # pylint: disable=R0913
+        self.candidates = list(mirrors or [])
+        self.candidates.append(url)
+        self.url = self.candidates[0]
+        self.url_string = urlparse.urlunparse(self.url)
+        self.stats = stats
+        self.filename = filename
+        self.tmp_filename = filename + "~"
+        self.retries = retries
+        self.tmp_file = None
+        self.error = None
+        self.copies = []
+        self.store = store
+        self.store_key = store_key or self.url_string
+        self.headers = {}
+        self.resume_from = 0
+        self.resume_validator = None
+        self.sniffed = None
+        self.bad_format = None
+        self.sha256 = hashlib.sha256()
+        self.expected_sha256 = expected_sha256
+        self.attempts = 0
+        self.not_before = 0.0
+        self.slot = None
+        self.throttle = None
+        self.paused_until = None
+        self.charged = False
+
+    def to_dict(self):
+        """Return the request as a dictionary, to send to a fetch server"""
+        return {"url": urlparse.urlunparse(self.candidates[-1]),
+                "mirrors": [urlparse.urlunparse(mirror)
+                            for mirror in self.candidates[:-1]],
+                "filename": os.path.abspath(self.filename),
+                "copies": [os.path.abspath(path) for path in self.copies],
+                "retries": self.retries,
+                "store_key": self.store_key if self.store else None,
+                "expected_sha256": self.expected_sha256}
+
+    @classmethod
+    def from_dict(cls, data, store, stats):
+        """Make a Transfer from a dictionary created by to_dict"""
+        transfer = cls(urlparse.urlparse(str(data["url"])),
+                       str(data["filename"]), data["retries"],
+                       store if data["store_key"] else None,
+                       data["store_key"] and str(data["store_key"]),
+                       data["expected_sha256"] and
+                       str(data["expected_sha256"]),
+                       [urlparse.urlparse(str(mirror))
+                        for mirror in data["mirrors"]],
+                       stats)
+        transfer.copies = [str(path) for path in data["copies"]]
+        return transfer
+
+    def header(self, line):
+        """Record a response header.   Called by curl."""
+        name, sep, value = line.partition(':')
+        if line.startswith("HTTP/"):
+            # Start of a new response, perhaps after a redirect
+            self.headers = {}
+        elif sep:
+            self.headers[name.strip().lower()] = value.strip()
+
+    def write(self, data):
+        """
+        Write part of the response to the temporary file.   Called by
+        curl: returning a short count aborts the transfer, and returning
+        WRITEFUNC_PAUSE pauses it until fetch_all unpauses it, when curl
+        passes the same data again.   Sleeping here would stall every
+        transfer sharing the multi handle.
+        """
+        if self.throttle and not self.charged:
+            delay = self.throttle.consume(len(data))
+            if delay > 0:
+                self.paused_until = time.time() + delay
+                self.charged = True
+                return pycurl.WRITEFUNC_PAUSE
+        self.charged = False
+        if self.sniffed is not None:
+            self.sniffed += data
+            if len(self.sniffed) >= SNIFF_SIZE and not self.check_format():
+                return 0
+        self.tmp_file.write(data)
+        self.sha256.update(data)
+        return len(data)
+
+    def check_format(self):
+        """Check the format of the start of the response against the
+           extension of the file.   Returns False if it is wrong."""
+        _, ext = os.path.splitext(self.filename)
+        self.bad_format = format_matches(ext, self.sniffed)
+        self.sniffed = None
+        return self.bad_format is None
+
+    def start(self, curl):
+        """Prepare curl to perform this transfer"""
+        logging.debug("Fetching %s to %s", self.url_string, self.filename)
+        make_dir(os.path.dirname(self.filename))
+        self.headers = {}
+        self.bad_format = None
+        self.paused_until = None
+        self.charged = False
+        if self.resume_from:
+            logging.debug("Resuming %s from byte %d", self.url_string,
+                          self.resume_from)
+            self.tmp_file = open(self.tmp_filename, "ab")
+            self.sniffed = None
+            setup_curl(curl, self.url_string, self.write)
+            curl.setopt(pycurl.RESUME_FROM_LARGE, self.resume_from)
+        else:
+            self.tmp_file = open(self.tmp_filename, "wb")
+            self.sniffed = ''
+            self.sha256 = hashlib.sha256()
+            setup_curl(curl, self.url_string, self.write)
+
+        if self.url.scheme in ("http", "https"):
+            curl.setopt(pycurl.HEADERFUNCTION, self.header)
+            meta = {}
+            if not self.resume_from:
+                meta = load_meta(self.filename, self.url_string)
+            conditions = []
+            if self.resume_validator:
+                conditions.append("If-Range: %s" % self.resume_validator)
+            if meta.get("etag"):
+                conditions.append("If-None-Match: %s" % meta["etag"])
+            if meta.get("last_modified"):
+                conditions.append("If-Modified-Since: %s" %
+                                  meta["last_modified"])
+            if conditions:
+                logging.debug("Conditional request: %s", conditions)
+                curl.setopt(pycurl.HTTPHEADER, [str(condition) for condition
+                                                in conditions])
+
+    def finish(self, curl):
+        """
+        Move the downloaded file into place, and copy it to any other
+        paths which need the same URL.   Returns False if the transfer
+        must be made again: because the server would not resume it,
+        because the file which the server said was not modified does
+        not match its recorded checksum, or because the file from a
+        mirror is bad and the next candidate must be tried.
+        """
+        self.tmp_file.close()
+        response_code = curl.getinfo(pycurl.RESPONSE_CODE)
+        if response_code == 416 and self.resume_from:
+            # libcurl reports a refused range request as a success.
+            # Start again from the beginning without using up a retry.
+            logging.debug("%s cannot be resumed", self.url_string)
+            self.resume_from = 0
+            self.resume_validator = None
+            return False
+
+        if response_code == 304:
+            logging.debug("%s not modified", self.url_string)
+            os.unlink(self.tmp_filename)
+            digest = None
+            if self.expected_sha256 or self.store:
+                digest = sha256_of_file(self.filename)
+            if self.expected_sha256 and digest != self.expected_sha256:
+                # The local copy is corrupt or stale: forget its
+                # validators and download it again unconditionally
+                logging.warning("%s does not match its checksum, "
+                                "fetching it again", self.filename)
+                os.unlink(meta_path(self.filename))
+                return False
+            os.utime(self.filename, None)
+        else:
+            digest = self.complete()
+            if digest is None:
+                return False
+            if self.stats:
+                self.stats.record_success(
+                    self.url, curl.getinfo(pycurl.SPEED_DOWNLOAD))
+
+        if self.store:
+            try:
+                self.store.add(self.store_key, self.filename, digest)
+            except (IOError, OSError) as exn:
+                # Failing to share the file is not fatal
+                logging.warning("Could not add %s to source store: %s",
+                                self.filename, exn)
+        for path in self.copies:
+            clone_file(self.filename, path)
+        return True
+
+    def complete(self):
+        """
+        Check the format and checksum of a downloaded file and move it
+        into place.   Returns its sha256 digest, or None if the file is
+        bad and the next candidate URL must be tried.
+        """
+        if self.sniffed is not None:
+            # The whole file was shorter than SNIFF_SIZE
+            if not self.check_format():
+                return self.reject("Fetched file format looks incorrect: "
+                                   "%s: %s" % (self.tmp_filename,
+                                               self.bad_format))
+        elif self.resume_from:
+            best_effort_file_verify(self.tmp_filename, self.filename)
+        digest = self.sha256.hexdigest()
+        if self.expected_sha256 and digest != self.expected_sha256:
+            os.unlink(self.tmp_filename)
+            return self.reject("Checksum mismatch for %s: expected sha256 "
+                               "%s, got %s" % (self.url_string,
+                                               self.expected_sha256, digest))
+        shutil.move(self.tmp_filename, self.filename)
+        self.record_meta()
+        return digest
+
+    def reject(self, message):
+        """
+        Record that the file downloaded from the current URL is bad and
+        fall back to the next candidate.   Exits with message if there
+        are no more candidates.
+        """
+        if self.stats:
+            self.stats.record_failure(self.url)
+        if not self.next_candidate():
+            sys.exit("%s: %s" % (sys.argv[0], message))
+        logging.warning("%s", message)
+        return None
+
+    def next_candidate(self):
+        """
+        Fall back to the next mirror, or to the upstream URL.   Returns
+        False if there are no more candidates.
+        """
+        if len(self.candidates) <= 1:
+            return False
+        self.candidates.pop(0)
+        self.url = self.candidates[0]
+        self.url_string = urlparse.urlunparse(self.url)
+        self.resume_from = 0
+        self.resume_validator = None
+        logging.debug("Falling back to %s", self.url_string)
+        return True
+
+    def record_meta(self):
+        """Save the validators of an HTTP response, if it had any"""
+        meta = {"url": self.url_string,
+                "etag": self.headers.get("etag"),
+                "last_modified": self.headers.get("last-modified"),
+                "content_length": os.path.getsize(self.filename)}
+        if meta["etag"] or meta["last_modified"]:
+            save_meta(self.filename, meta)
+        elif os.path.exists(meta_path(self.filename)):
+            os.unlink(meta_path(self.filename))
+
+    def fail(self, curl, errno, errmsg):
+        """
+        Record a failed attempt.   Returns True if the transfer should
+        be retried.
+        """
+        self.tmp_file.close()
+        logging.debug(errmsg)
+        self.error = pycurl.error(errno, errmsg)
+        if self.stats:
+            self.stats.record_failure(self.url)
+
+        if self.next_candidate():
+            return True
+
+        if self.bad_format:
+            self.error = pycurl.error(
+                errno, "Fetched file format looks incorrect: %s" %
+                self.bad_format)
+            self.retries = 0
+            return False
+
+        if self.resume_from and (
+                errno == pycurl.E_RANGE_ERROR or
+                curl.getinfo(pycurl.RESPONSE_CODE) == 416):
+            # The server would not resume, or the file has changed:
+            # start again from the beginning without using up a retry.
+            # Other errors, such as 503, are retried from the same
+            # point after the usual backoff.
+            self.resume_from = 0
+            self.resume_validator = None
+            return True
+
+        self.retries -= 1
+        self.attempts += 1
+        self.not_before = time.time() + backoff_delay(
+            self.attempts, self.headers.get("retry-after"))
+        if self.url.scheme in RESUMABLE_URL_SCHEMES:
+            self.resume_from = os.path.getsize(self.tmp_filename)
+            self.resume_validator = (self.headers.get("etag") or
+                                     self.headers.get("last-modified"))
+        return self.retries > 0
+
+
+class CurlPool(object):
+    """
+    Idle curl handles, kept so that their connections, DNS cache and TLS
+    sessions can be reused by later transfers.   A pool used by several
+    threads shares those caches between all of its handles.
+    """
+
+    def __init__(self, shared=False):
+        self.idle = []
+        self.lock = threading.Lock()
+        self.share = None
+        if shared:
+            self.share = pycurl.CurlShare()
+            self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+            self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+            if hasattr(pycurl, "LOCK_DATA_CONNECT"):
+                self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_CONNECT)
+
+    def get(self):
+        """Return an idle handle, or a new one"""
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return pycurl.Curl()
+
+    def put(self, curl):
+        """Return a handle to the pool"""
+        with self.lock:
+            self.idle.append(curl)
+
+    def prepare(self, curl):
+        """Set the options which must survive setup_curl's reset"""
+        if self.share is not None:
+            # The handles are used by several threads
+            curl.setopt(pycurl.NOSIGNAL, 1)
+            curl.setopt(pycurl.SHARE, self.share)
+
+    def close(self):
+        """Close all the idle handles"""
+        with self.lock:
+            for curl in self.idle:
+                curl.close()
+            self.idle = []
+
+
+def fetch_all(transfers, parallel=1, pool=None, throttle=None):
+    """
+    Perform transfers, running up to parallel of them at once and
+    retrying each failed transfer on its own.   Curl handles are reused
+    from one transfer to the next, so connections to the same server
+    stay open; if a pool is given they are taken from it and returned
+    to it afterwards.   If a throttle is given, a transfer only starts
+    once it holds one of its host's slots.   Returns the list of
+    transfers which failed.
+    """
+    # pylint: disable=R0912, R0914, R0915
+    queue = list(transfers)
+    own_pool = pool is None
+    if own_pool:
+        pool = CurlPool()
+    multi = pycurl.CurlMulti()
+    handles = [pool.get() for _ in range(max(1, min(parallel, len(queue))))]
+    idle = list(handles)
+    active = {}
+    failed = []
+
+    def done(curl):
+        """Take a finished transfer off curl, releasing its slot"""
+        multi.remove_handle(curl)
+        idle.append(curl)
+        transfer = active.pop(curl)
+        if transfer.slot:
+            throttle.release(transfer.slot)
+            transfer.slot = None
+        return transfer
+
+    try:
+        while queue or active:
+            now = time.time()
+            for transfer in list(queue):
+                if not idle:
+                    break
+                if transfer.not_before > now:
+                    continue
+                if throttle and transfer.url.scheme != "file":
+                    transfer.slot = throttle.acquire(host_of(transfer.url))
+                    if transfer.slot is None:
+                        continue
+                queue.remove(transfer)
+                curl = idle.pop()
+                transfer.throttle = throttle
+                transfer.start(curl)
+                pool.prepare(curl)
+                multi.add_handle(curl)
+                active[curl] = transfer
+
+            # Resume transfers paused by the bandwidth limit
+            for curl, transfer in active.items():
+                if transfer.paused_until and transfer.paused_until <= now:
+                    transfer.paused_until = None
+                    curl.pause(pycurl.PAUSE_CONT)
+
+            # Wait for no longer than until the next retry or resumption
+            # is due
+            timeout = 1.0
+            if queue or active:
+                timeout = max(0.01, min(
+                    [timeout] +
+                    [transfer.not_before - now for transfer in queue] +
+                    [transfer.paused_until - now for transfer
+                     in active.values() if transfer.paused_until]))
+            if not active:
+                time.sleep(timeout)
+                continue
+
+            while multi.perform()[0] == pycurl.E_CALL_MULTI_PERFORM:
+                pass
+
+            while True:
+                remaining, succeeded, errors = multi.info_read()
+                for curl in succeeded:
+                    transfer = done(curl)
+                    if not transfer.finish(curl):
+                        queue.append(transfer)
+                for curl, errno, errmsg in errors:
+                    transfer = done(curl)
+                    if transfer.fail(curl, errno, errmsg):
+                        queue.append(transfer)
+                    else:
+                        failed.append(transfer)
+                if not remaining:
+                    break
+
+            if active:
+                multi.select(timeout)
+    finally:
+        for curl, transfer in active.items():
+            multi.remove_handle(curl)
+            if transfer.slot:
+                throttle.release(transfer.slot)
+        for curl in handles:
+            pool.put(curl)
+        multi.close()
+        if own_pool:
+            pool.close()
+
+    return failed
@@ -5,15 +5,20 @@ Library of generic functions used by other planex components
 """
 
 import errno
+import fcntl
 import hashlib
+import json
 import logging
 import os
 import pipes
 import shutil
 import signal
+import socket
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
 import yum
 
 import pkg_resources
@@ -170,3 +175,181 @@ def makedirs(path):
             pass
         else:
             raise
+
+
+def sha256_of_file(path):
+    """
+    Return the hex sha256 digest of the contents of a file at a given path,
+    reading it in chunks so that large tarballs are not held in memory.
+    """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as in_f:
+        for chunk in iter(lambda: in_f.read(1024 * 1024), ''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+# From <linux/fs.h>: clone all of the extents of one file into another
+FICLONE = 0x40049409
+
+
+def clone_file(src, dst, link=True):
+    """
+    Make dst a copy of src as cheaply as possible: a hard link if src and
+    dst are on the same filesystem, a reflink if the filesystem supports
+    them, and a full copy otherwise.   dst is replaced atomically.
+    Pass link=False for files which may later be rewritten in place,
+    which must not be hard links.
+    Returns the method used: "link", "reflink" or "copy".
+    """
+    if link and os.path.exists(dst) and os.path.samefile(src, dst):
+        return "link"
+
+    makedirs(os.path.dirname(dst))
+    # Each caller gets its own temporary file, as threads of a fetch
+    # server may clone to the same destination at once
+    tmp_dir = os.path.dirname(dst) or "."
+    prefix = ".%s." % os.path.basename(dst)
+
+    if link:
+        # Reserve a unique name, then link src in its place
+        fdesc, tmp_dst = tempfile.mkstemp(dir=tmp_dir, prefix=prefix,
+                                          suffix="~")
+        os.close(fdesc)
+        os.unlink(tmp_dst)
+        try:
+            os.link(src, tmp_dst)
+        except OSError:
+            pass
+        else:
+            try:
+                os.rename(tmp_dst, dst)
+            finally:
+                if os.path.lexists(tmp_dst):
+                    os.unlink(tmp_dst)
+            return "link"
+
+    method = "copy"
+    fdesc, tmp_dst = tempfile.mkstemp(dir=tmp_dir, prefix=prefix, suffix="~")
+    try:
+        with open(src, 'rb') as in_f:
+            with os.fdopen(fdesc, 'wb') as out_f:
+                try:
+                    fcntl.ioctl(out_f.fileno(), FICLONE, in_f.fileno())
+                    method = "reflink"
+                except IOError:
+                    shutil.copyfileobj(in_f, out_f)
+        shutil.copystat(src, tmp_dst)
+        os.rename(tmp_dst, dst)
+    finally:
+        if os.path.lexists(tmp_dst):
+            os.unlink(tmp_dst)
+    return method
+
+
+# From <asm-generic/socket.h>: the credentials of the peer of a Unix
+# socket.   Python 2 does not define it.
+SO_PEERCRED = getattr(socket, "SO_PEERCRED", 17)
+
+
+def listen_unix_socket(path):
+    """
+    Return a socket listening at path, which only its owner can connect
+    to.   A socket file left behind by a server which has exited is
+    replaced, but socket.error is raised if a server is still listening
+    at path.
+    """
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except socket.error:
+            os.unlink(path)
+        else:
+            raise socket.error(errno.EADDRINUSE,
+                               "A server is already listening on %s" % path)
+        finally:
+            probe.close()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0177)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(old_umask)
+    server.listen(64)
+    return server
+
+
+def peer_uid(conn):
+    """Return the user ID of the process at the other end of conn"""
+    creds = conn.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                            struct.calcsize("3i"))
+    _, uid, _ = struct.unpack("3i", creds)
+    return uid
+
+
+def handle_unix_connection(conn, handler):
+    """
+    Read one request from conn, handle it and send the response.
+    Requests from other users are refused, because handlers act on
+    paths named in the request with the server's permissions.
+    """
+    try:
+        uid = peer_uid(conn)
+        if uid != os.geteuid():
+            logging.warning("Refusing request from user %d", uid)
+            return
+        request = json.loads(conn.makefile('r').readline())
+        try:
+            response = handler(request)
+        except Exception as exn:  # pylint: disable=W0703
+            logging.exception("Request failed")
+            response = {"error": str(exn)}
+        conn.sendall(json.dumps(response) + "\n")
+    except (socket.error, ValueError) as exn:
+        logging.debug("Bad request: %s", exn)
+    finally:
+        conn.close()
+
+
+def serve_unix_socket(path, handler):
+    """
+    Serve requests on a Unix socket at path until interrupted.   Each
+    connection carries one request, a JSON object on a single line, and
+    is handled in its own thread by handler, which returns a JSON-able
+    response.   Exceptions raised by handler are sent back as
+    {"error": message}.   Raises socket.error if a server is already
+    listening at path.
+    """
+    server = listen_unix_socket(path)
+    logging.debug("Listening on %s", path)
+
+    try:
+        while True:
+            conn, _ = server.accept()
+            thread = threading.Thread(target=handle_unix_connection,
+                                      args=(conn, handler))
+            thread.daemon = True
+            thread.start()
+    finally:
+        server.close()
+        os.unlink(path)
+
+
+def unix_socket_request(path, request, timeout=None):
+    """
+    Send a request to a server started with serve_unix_socket and return
+    its response.   Raises socket.error if no server is listening.
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.settimeout(timeout)
+        conn.connect(path)
+        conn.sendall(json.dumps(request) + "\n")
+        response = conn.makefile('r').readline()
+    finally:
+        conn.close()
+    if not response:
+        raise socket.error("%s closed the connection" % path)
+    return json.loads(response)
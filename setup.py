@@ -12,6 +12,7 @@ setup(name='planex',
       entry_points={
           'console_scripts': [
               'planex-init = planex.init:_main',
+              'planex-build = planex.build:_main',
               'planex-cache = planex.cache:_main',
               'planex-clone-sources = planex.clonesources:_main',
               'planex-fetch = planex.fetch:_main',
@@ -0,0 +1,97 @@
+# Run these tests with 'nosetests':
+#   install the 'python-nose' package (Fedora/CentOS or Ubuntu)
+#   run 'nosetests' in the root of the repository
+
+import argparse
+import shutil
+import tempfile
+import unittest
+
+import planex.build
+
+
+def graph_of(edges):
+    nodes = set(name for edge in edges for name in edge)
+    return {"nodes": dict((name, {"srpm": name + ".src.rpm",
+                                  "target": name + ".rpm"})
+                          for name in nodes),
+            "edges": [{"from": user, "to": required}
+                      for (user, required) in edges]}
+
+
+class BuildTests(unittest.TestCase):
+    # unittest.TestCase has more methods than Pylint permits
+    # pylint: disable=R0904
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def args(self, jobs=2, keep_going=False):
+        return argparse.Namespace(jobs=jobs, dry_run=False,
+                                  keep_going=keep_going,
+                                  timings=None, configdir=None,
+                                  repo=self.test_dir)
+
+    def test_critical_path_lengths(self):
+        deps = planex.build.dependencies(graph_of(
+            [("b", "a"), ("c", "b"), ("d", "a"), ("e", "e")]))
+        lengths = planex.build.critical_path_lengths(deps, {"d": 5.0})
+
+        self.assertEqual(lengths, {"a": 6.0, "b": 2.0, "c": 1.0,
+                                   "d": 5.0, "e": 1.0})
+
+    def test_cycles_are_detected(self):
+        deps = planex.build.dependencies(graph_of(
+            [("a", "b"), ("b", "a"), ("c", "a")]))
+
+        self.assertRaises(planex.build.CycleError,
+                          planex.build.topological_order, deps)
+
+    def test_longest_chain_starts_first(self):
+        graph = graph_of([("b", "a"), ("c", "b"), ("y", "x")])
+        scheduler = FakeScheduler(graph, self.args(jobs=1), {})
+
+        self.assertTrue(scheduler.run())
+        self.assertEqual(scheduler.built, ["a", "b", "x", "c", "y"])
+
+    def test_failure_blocks_dependents(self):
+        graph = graph_of([("b", "a"), ("y", "x")])
+        scheduler = FakeScheduler(graph, self.args(keep_going=True), {},
+                                  failing=["a"])
+
+        self.assertFalse(scheduler.run())
+        self.assertEqual(scheduler.failed, set(["a", "b"]))
+        self.assertIn("y", scheduler.built)
+
+    def test_missing_command_fails_build(self):
+        graph = graph_of([("b", "a")])
+        scheduler = FakeScheduler(graph, self.args(keep_going=True), {},
+                                  failing=["a"], missing=True)
+
+        self.assertFalse(scheduler.run())
+        self.assertEqual(scheduler.failed, set(["a", "b"]))
+
+
+class FakeScheduler(planex.build.Scheduler):
+    """
+    Scheduler which runs true or false in place of mock and createrepo,
+    recording the order in which packages are built
+    """
+
+    def __init__(self, graph, args, weights, failing=(), missing=False):
+        # pylint: disable=R0913
+        planex.build.Scheduler.__init__(self, graph, args, weights)
+        self.failing = failing
+        self.missing = missing
+        self.built = []
+
+    def commands(self, name):
+        self.built.append(name)
+        if name not in self.failing:
+            return (["true"], ["true"])
+        if self.missing:
+            return (["/nonexistent/planex-build-mock"], ["true"])
+        return (["false"], ["true"])
@@ -0,0 +1,401 @@
+# Run these tests with 'nosetests':
+#   install the 'python-nose' package (Fedora/CentOS or Ubuntu)
+#   run 'nosetests' in the root of the repository
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import planex.cache
+
+
+class FakeHeader(object):
+    # pylint: disable=R0903
+    filenames = ["/usr/lib/libfoo.so", "/usr/include/foo.h"]
+    filedigests = ["aaaa", "bbbb"]
+
+
+class FakePackage(object):
+    # pylint: disable=R0903
+    name = "foo-devel"
+    epoch = "0"
+    version = "1.0"
+    release = "1"
+    arch = "x86_64"
+
+    @staticmethod
+    def returnChecksums():  # pylint: disable=C0103
+        return [("sha256", "cccc", 1)]
+
+    @staticmethod
+    def returnLocalHeader():  # pylint: disable=C0103
+        return FakeHeader()
+
+
+class FakeYumBase(object):
+    # pylint: disable=R0903
+    def __init__(self):
+        self.downloads = 0
+
+    def downloadHeader(self, _):  # pylint: disable=C0103
+        self.downloads += 1
+
+
+class FakeRepo(object):
+    # pylint: disable=R0903
+    def __init__(self, baseurl):
+        self.id = "base"  # pylint: disable=C0103
+        self.baseurl = [baseurl]
+
+
+class FakeRepos(object):
+    def __init__(self, baseurl, conf):
+        self.repos = [FakeRepo(baseurl)]
+        self.conf = conf
+        self.seeded = None
+
+    def listEnabled(self):  # pylint: disable=C0103
+        return self.repos
+
+    def populateSack(self, cacheonly):  # pylint: disable=C0103
+        # pylint: disable=W0613
+        primary = os.path.join(self.conf.cachedir, "primary.sqlite")
+        self.seeded = os.path.exists(primary)
+        if not self.seeded:
+            os.makedirs(self.conf.cachedir)
+            with open(primary, "w") as out_f:
+                out_f.write("packages")
+
+
+class FakeConf(object):
+    # pylint: disable=R0903
+    cachedir = None
+
+
+class FakeSackYumBase(object):
+    """Just enough of YumBase for setup_yumbase and CacheServer"""
+    def __init__(self, baseurl):
+        self.conf = FakeConf()
+        self.repos = FakeRepos(baseurl, self.conf)
+        self.closed = False
+
+    def setCacheDir(self, force, tmpdir, reuse):  # pylint: disable=C0103
+        # pylint: disable=W0613
+        cache_dir = tempfile.mkdtemp(prefix="yum-user-", dir=tmpdir)
+        self.conf.cachedir = os.path.join(cache_dir, "x86_64", "7")
+
+    def close(self):
+        self.closed = True
+
+
+class DependencyIndexTests(unittest.TestCase):
+    # unittest.TestCase has more methods than Pylint permits
+    # pylint: disable=R0904
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.test_dir, "dependency-digests.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_digest_is_memoized(self):
+        yumbase = FakeYumBase()
+        index = planex.cache.DependencyIndex(self.path)
+        digest = index.digest(FakePackage(), yumbase, "MD5")
+        index.save()
+
+        index = planex.cache.DependencyIndex(self.path)
+        self.assertEqual(index.digest(FakePackage(), yumbase, "MD5"), digest)
+        self.assertEqual(yumbase.downloads, 1)
+
+
+class YumSnapshotTests(unittest.TestCase):
+    # unittest.TestCase has more methods than Pylint permits
+    # pylint: disable=R0904
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.snapshot_root = os.path.join(self.test_dir, "snapshots")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def snapshot_dir(self, baseurl="file:///repo"):
+        return planex.cache.snapshot_dir_for(FakeSackYumBase(baseurl),
+                                             self.snapshot_root)
+
+    def test_publish_and_seed(self):
+        yumbase = FakeSackYumBase("file:///repo")
+        private_dir = planex.cache.setup_yumbase(yumbase, self.snapshot_root)
+        self.assertFalse(yumbase.repos.seeded)
+
+        seeded = FakeSackYumBase("file:///repo")
+        seeded_dir = planex.cache.setup_yumbase(seeded, self.snapshot_root)
+        self.assertTrue(seeded.repos.seeded)
+        self.assertNotEqual(seeded_dir, private_dir)
+
+        # The seeded cache does not share files with the snapshot, which
+        # yum could rewrite in place
+        primary = os.path.join(seeded.conf.cachedir, "primary.sqlite")
+        snapshot = os.path.join(self.snapshot_dir(), "current", "x86_64",
+                                "7", "primary.sqlite")
+        self.assertFalse(os.path.samefile(primary, snapshot))
+
+    def test_snapshots_are_kept_per_repository(self):
+        planex.cache.setup_yumbase(FakeSackYumBase("file:///repo"),
+                                   self.snapshot_root)
+        other = FakeSackYumBase("file:///other")
+        planex.cache.setup_yumbase(other, self.snapshot_root)
+
+        self.assertFalse(other.repos.seeded)
+        self.assertNotEqual(self.snapshot_dir("file:///other"),
+                            self.snapshot_dir())
+
+    def test_snapshot_dir_is_private(self):
+        snapshot_dir = self.snapshot_dir()
+        self.assertEqual(stat.S_IMODE(os.stat(snapshot_dir).st_mode), 0700)
+
+        os.chmod(snapshot_dir, 0777)
+        self.assertRaises(OSError, self.snapshot_dir)
+
+        # Without a private snapshot, yum populates its cache itself
+        yumbase = FakeSackYumBase("file:///repo")
+        planex.cache.setup_yumbase(yumbase, self.snapshot_root)
+        self.assertFalse(yumbase.repos.seeded)
+        self.assertEqual(os.listdir(snapshot_dir), [])
+
+    def test_unchanged_cache_is_not_republished(self):
+        planex.cache.setup_yumbase(FakeSackYumBase("file:///repo"),
+                                   self.snapshot_root)
+        snapshot = os.path.join(self.snapshot_dir(), "current")
+        inode = os.stat(snapshot).st_ino
+
+        planex.cache.setup_yumbase(FakeSackYumBase("file:///repo"),
+                                   self.snapshot_root)
+        self.assertEqual(os.stat(snapshot).st_ino, inode)
+
+
+class CacheServerTests(unittest.TestCase):
+    # unittest.TestCase has more methods than Pylint permits
+    # pylint: disable=R0904
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.repomd = os.path.join(self.test_dir, "repo", "repodata",
+                                   "repomd.xml")
+        os.makedirs(os.path.dirname(self.repomd))
+        with open(self.repomd, "w") as out_f:
+            out_f.write("<repomd/>")
+        os.utime(self.repomd, (1000, 1000))
+
+        self.get_yumbase = planex.cache.util.get_yumbase
+        self.load_mock_config = planex.cache.util.load_mock_config
+        planex.cache.util.get_yumbase = lambda config: FakeSackYumBase(
+            "file://%s" % os.path.join(self.test_dir, "repo"))
+        planex.cache.util.load_mock_config = lambda config: config
+        self.server = planex.cache.CacheServer(
+            os.path.join(self.test_dir, "snapshot"))
+
+    def tearDown(self):
+        planex.cache.util.get_yumbase = self.get_yumbase
+        planex.cache.util.load_mock_config = self.load_mock_config
+        shutil.rmtree(self.test_dir)
+
+    def test_yumbase_is_kept(self):
+        yumbase = self.server.yumbase("default.cfg")
+        self.assertIs(self.server.yumbase("default.cfg"), yumbase)
+        self.assertIsNot(self.server.yumbase("other.cfg"), yumbase)
+
+    def test_yumbase_is_reloaded_when_repo_changes(self):
+        yumbase = self.server.yumbase("default.cfg")
+        private_dir = self.server.yumbases["default.cfg"][2]
+        self.assertTrue(os.path.isdir(private_dir))
+
+        os.utime(self.repomd, (2000, 2000))
+        reloaded = self.server.yumbase("default.cfg")
+
+        self.assertIsNot(reloaded, yumbase)
+        self.assertTrue(yumbase.closed)
+        # The private cache of the old yumbase is removed at once
+        self.assertFalse(os.path.exists(private_dir))
+        self.assertTrue(os.path.isdir(self.server.yumbases["default.cfg"][2]))
+
+    def test_request_hash_times_out(self):
+        # A server which accepts the request but never answers
+        path = os.path.join(self.test_dir, "socket")
+        server = planex.cache.util.listen_unix_socket(path)
+        timeout = planex.cache.CACHE_SERVER_TIMEOUT
+        planex.cache.CACHE_SERVER_TIMEOUT = 0.1
+        try:
+            self.assertIsNone(planex.cache.request_hash(
+                path, "default.cfg", "foo.src.rpm", [self.test_dir]))
+        finally:
+            planex.cache.CACHE_SERVER_TIMEOUT = timeout
+            server.close()
+
+    def test_request_hash_without_server(self):
+        self.assertIsNone(planex.cache.request_hash(
+            os.path.join(self.test_dir, "socket"), "default.cfg",
+            "foo.src.rpm", [self.test_dir]))
+
+
+class CacheTests(unittest.TestCase):
+    # unittest.TestCase has more methods than Pylint permits
+    # pylint: disable=R0904
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.cachedirs = [os.path.join(self.test_dir, "cache")]
+        self.build_dir = os.path.join(self.test_dir, "build")
+        os.makedirs(self.build_dir)
+        for name in ["foo-1.0-1.x86_64.rpm", "build.log"]:
+            with open(os.path.join(self.build_dir, name), "w") as out_f:
+                out_f.write(name)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_cache_hit_does_not_share_files(self):
+        planex.cache.add_to_cache(self.cachedirs, "abc", self.build_dir)
+        resultdir = os.path.join(self.test_dir, "RPMS")
+        planex.cache.get_from_cache(self.cachedirs, "abc", resultdir)
+
+        cached = os.path.join(self.cachedirs[0], "abc", "output")
+        for name in ["foo-1.0-1.x86_64.rpm", "build.log"]:
+            self.assertFalse(os.path.samefile(
+                os.path.join(cached, name),
+                os.path.join(resultdir, name)))
+            with open(os.path.join(resultdir, name)) as in_f:
+                self.assertEqual(in_f.read(), name)
+
+    def test_build_products_are_moved_into_cache(self):
+        build_inode = os.stat(os.path.join(self.build_dir,
+                                           "foo-1.0-1.x86_64.rpm")).st_ino
+        planex.cache.add_to_cache(self.cachedirs, "abc", self.build_dir)
+
+        self.assertEqual(os.listdir(self.build_dir), [])
+        cached = os.path.join(self.cachedirs[0], "abc", "output",
+                              "foo-1.0-1.x86_64.rpm")
+        self.assertEqual(os.stat(cached).st_ino, build_inode)
+
+    def test_build_products_are_kept_if_already_cached(self):
+        other_build = os.path.join(self.test_dir, "other-build")
+        shutil.copytree(self.build_dir, other_build)
+        planex.cache.add_to_cache(self.cachedirs, "abc", other_build)
+        planex.cache.add_to_cache(self.cachedirs, "abc", self.build_dir)
+
+        self.assertEqual(sorted(os.listdir(self.build_dir)),
+                         ["build.log", "foo-1.0-1.x86_64.rpm"])
+
+    def test_build_and_cache(self):
+        def build_package(configdir, root, passthrough_args, work_dir):
+            # pylint: disable=W0613
+            output = tempfile.mkdtemp(dir=work_dir)
+            for name in os.listdir(self.build_dir):
+                shutil.copy(os.path.join(self.build_dir, name), output)
+            return output
+
+        real_build_package = planex.cache.build_package
+        planex.cache.build_package = build_package
+        try:
+            resultdir = os.path.join(self.test_dir, "RPMS")
+            os.makedirs(resultdir)
+            args = planex.cache.parse_args_or_exit(
+                ["--root", "epel-7-x86_64", "foo.src.rpm"])[0]
+            planex.cache.build_and_cache(args, [], self.cachedirs, "abc",
+                                         resultdir)
+        finally:
+            planex.cache.build_package = real_build_package
+
+        self.assertEqual(sorted(os.listdir(resultdir)),
+                         ["build.log", "foo-1.0-1.x86_64.rpm"])
+        self.assertTrue(planex.cache.in_cache(self.cachedirs, "abc"))
+        # The build directory is removed
+        self.assertEqual(os.listdir(self.cachedirs[0]), ["abc"])
+
+    def test_cache_hit_does_not_touch_other_results(self):
+        planex.cache.add_to_cache(self.cachedirs, "abc", self.build_dir)
+        resultdir = os.path.join(self.test_dir, "RPMS")
+        planex.cache.get_from_cache(self.cachedirs, "abc", resultdir)
+        rpm_path = os.path.join(resultdir, "foo-1.0-1.x86_64.rpm")
+        os.utime(rpm_path, (0, 0))
+
+        planex.cache.get_from_cache(self.cachedirs, "abc",
+                                    os.path.join(self.test_dir, "other"))
+        self.assertEqual(os.path.getmtime(rpm_path), 0)
+
+    def test_add_to_cache_publishes_complete_entry(self):
+        planex.cache.add_to_cache(self.cachedirs, "abc", self.build_dir)
+        entry = os.path.join(self.cachedirs[0], "abc")
+        self.assertTrue(planex.cache.entry_complete(entry))
+        self.assertTrue(planex.cache.in_cache(self.cachedirs, "abc"))
+        # No staging directories are left behind
+        self.assertEqual(os.listdir(self.cachedirs[0]), ["abc"])
+
+    def test_entry_permissions_follow_umask(self):
+        old_umask = os.umask(0022)
+        try:
+            planex.cache.add_to_cache(self.cachedirs, "abc", self.build_dir)
+        finally:
+            os.umask(old_umask)
+
+        entry = os.path.join(self.cachedirs[0], "abc")
+        self.assertEqual(stat.S_IMODE(os.stat(entry).st_mode), 0755)
+
+    def test_racing_complete_entry_is_not_removed(self):
+        other_build = os.path.join(self.test_dir, "other-build")
+        shutil.copytree(self.build_dir, other_build)
+        planex.cache.add_to_cache(self.cachedirs, "abc", other_build)
+        entry = os.path.join(self.cachedirs[0], "abc")
+        staging_dir = os.path.join(self.cachedirs[0], ".abc-staging")
+        os.makedirs(staging_dir)
+
+        # The entry is published just after we check it
+        entry_complete = planex.cache.entry_complete
+        checked = []
+
+        def racing_entry_complete(path):
+            if not checked:
+                checked.append(path)
+                return False
+            return entry_complete(path)
+
+        planex.cache.entry_complete = racing_entry_complete
+        try:
+            self.assertFalse(planex.cache.publish_cache_entry(staging_dir,
+                                                              entry))
+        finally:
+            planex.cache.entry_complete = entry_complete
+
+        self.assertTrue(planex.cache.entry_complete(entry))
+        self.assertEqual(sorted(os.listdir(os.path.join(entry, "output"))),
+                         ["build.log", "foo-1.0-1.x86_64.rpm"])
+
+    def test_stale_dirs_are_removed(self):
+        os.makedirs(self.cachedirs[0])
+        stale = os.path.join(self.cachedirs[0], ".abc-crashed")
+        running = os.path.join(self.cachedirs[0], ".abc-running")
+        os.mkdir(stale)
+        os.mkdir(running)
+        old = os.path.getmtime(stale) - planex.cache.STALE_DIR_AGE - 60
+        os.utime(stale, (old, old))
+
+        planex.cache.add_to_cache(self.cachedirs, "abc", self.build_dir)
+        self.assertEqual(sorted(os.listdir(self.cachedirs[0])),
+                         [".abc-running", "abc"])
+
+    def test_incomplete_entry_is_a_miss(self):
+        partial = os.path.join(self.cachedirs[0], "abc", "output")
+        os.makedirs(partial)
+        with open(os.path.join(partial, "build.log"), "w") as out_f:
+            out_f.write("partial")
+        self.assertFalse(planex.cache.in_cache(self.cachedirs, "abc"))
+
+        planex.cache.add_to_cache(self.cachedirs, "abc", self.build_dir)
+        self.assertTrue(planex.cache.in_cache(self.cachedirs, "abc"))
+        self.assertEqual(sorted(os.listdir(partial)),
+                         ["build.log", "foo-1.0-1.x86_64.rpm"])
+        self.assertEqual(os.listdir(self.cachedirs[0]), ["abc"])
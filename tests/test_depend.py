@@ -2,6 +2,7 @@
 #   install the 'python-nose' package (Fedora/CentOS or Ubuntu)
 #   run 'nosetests' in the root of the repository
 
+import argparse
 import glob
 import os
 import sys
@@ -65,3 +66,61 @@ class BasicTests(unittest.TestCase):
             "./RPMS/x86_64/ocaml-uri-devel-1.6.0-1.el6.x86_64.rpm\n"
             "./RPMS/x86_64/ocaml-cohttp-devel-0.9.8-1.el6.x86_64.rpm: "
             "./RPMS/x86_64/ocaml-cstruct-devel-1.4.0-1.el6.x86_64.rpm\n")
+
+    def test_load_specs_in_parallel(self):
+        spec_paths = sorted(glob.glob(os.path.join("tests/data",
+                                                   "ocaml-*.spec")))
+        defines = [('dist', '.el6')]
+        options = argparse.Namespace(check_package_names=True,
+                                     spec_cache=None, fast_scan=False,
+                                     jobs=1)
+
+        serial = planex.depend.load_specs(spec_paths, defines, options)
+        options.jobs = 2
+        parallel = planex.depend.load_specs(spec_paths, defines, options)
+
+        self.assertEqual(
+            [planex.spec.SpecSummary.of_spec(spec).to_dict()
+             for spec in serial],
+            [summary.to_dict() for summary in parallel])
+
+    def test_build_graph(self):
+        spec_paths = glob.glob(os.path.join("tests/data", "ocaml-*.spec"))
+        specs = [planex.spec.Spec(spec_path, defines=[('dist', '.el6')])
+                 for spec_path in spec_paths]
+        graph = planex.depend.build_graph(
+            specs, planex.depend.package_to_rpm_map(specs),
+            set(["tests/data/ocaml-uri.spec"]))
+
+        self.assertEqual(sorted(graph["nodes"]),
+                         ["ocaml-cohttp", "ocaml-cstruct", "ocaml-uri"])
+        self.assertTrue(graph["nodes"]["ocaml-uri"]["pinned"])
+        self.assertFalse(graph["nodes"]["ocaml-cohttp"]["pinned"])
+        self.assertEqual(
+            [(edge["from"], edge["to"]) for edge in graph["edges"]],
+            [("ocaml-cohttp", "ocaml-cstruct"), ("ocaml-cohttp", "ocaml-uri")])
+
+        dot = planex.depend.graph_to_dot(graph)
+        self.assertIn('"ocaml-cohttp" -> "ocaml-uri";', dot)
+        self.assertIn('"ocaml-uri" [label="ocaml-uri\\n1.6.0", style=bold];',
+                      dot)
+
+    def test_find_cycles(self):
+        deps = {"a": set(["b"]), "b": set(["c"]), "c": set(["a"]),
+                "d": set(["a", "d"]), "e": set(["d"]), "f": set()}
+
+        self.assertEqual(planex.depend.find_cycles(deps),
+                         [["a", "b", "c"], ["d"]])
+        self.assertEqual(planex.depend.find_cycles({"f": set()}), [])
+
+    def test_analyze(self):
+        spec_paths = glob.glob(os.path.join("tests/data", "ocaml-*.spec"))
+        specs = [planex.spec.Spec(spec_path, defines=[('dist', '.el6')])
+                 for spec_path in spec_paths]
+        report = planex.depend.analyze(
+            specs, planex.depend.package_to_rpm_map(specs))
+
+        self.assertEqual(report["cycles"], [])
+        self.assertEqual(report["duplicates"], {})
+        self.assertIn("ocaml", report["unresolved"])
+        self.assertNotIn("ocaml-uri-devel", report["unresolved"])
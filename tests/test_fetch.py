@@ -0,0 +1,207 @@
+# Run these tests with 'nosetests':
+#   install the 'python-nose' package (Fedora/CentOS or Ubuntu)
+#   run 'nosetests' in the root of the repository
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import urlparse
+
+import planex.fetch
+import planex.transfer
+
+
+SPEC = """\
+Name: foo
+Version: 1.0
+Release: 1
+Summary: Test package
+License: MIT
+Source0: file://%(upstream)s/foo-1.0.tar.gz
+Source1: foo-generated.patch
+Source2: foo-local.patch
+Source3: git://git.example.com/foo-extras.git
+%%global debug_package %%{nil}
+
+%%description
+Test package
+"""
+
+
+class FetchAllTests(unittest.TestCase):
+    # unittest.TestCase has more methods than Pylint permits
+    # pylint: disable=R0904
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.upstream = os.path.join(self.test_dir, "upstream")
+        self.sources = os.path.join(self.test_dir, "SOURCES")
+        os.makedirs(self.upstream)
+        os.makedirs(self.sources)
+
+        self.tarball = os.path.join(self.upstream, "foo-1.0.tar.gz")
+        tarball = gzip.open(self.tarball, "wb")
+        tarball.write("foo-1.0/\n")
+        tarball.close()
+        with open(os.path.join(self.sources, "foo-local.patch"),
+                  "w") as patch:
+            patch.write("--- a\n+++ b\n")
+
+        self.spec = os.path.join(self.test_dir, "foo.spec")
+        with open(self.spec, "w") as spec:
+            spec.write(SPEC % {"upstream": self.upstream})
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def fetch_all(self, *args):
+        planex.fetch.main(["--all", "--fast-scan", "--quiet",
+                           "--define", "_sourcedir %s" % self.sources] +
+                          list(args) + [self.spec])
+
+    def test_missing_remote_sources(self):
+        summary = planex.spec.SpecSummary(
+            path=self.spec, pkg_name="foo", pkg_version="1.0",
+            provided=[], buildrequired=[],
+            urls=["file://%s" % self.tarball, "foo-local.patch",
+                  "foo-generated.patch",
+                  "git://git.example.com/foo-extras.git"],
+            paths=[os.path.join(self.sources, name) for name
+                   in ["foo-1.0.tar.gz", "foo-local.patch",
+                       "foo-generated.patch", "foo-extras.git"]],
+            srpm_path=None, rpm_paths=[], rpm_provides=[],
+            buildrequire_deps=[])
+
+        self.assertEqual(
+            [path for (path, _) in
+             planex.fetch.missing_remote_sources(summary)],
+            [os.path.join(self.sources, "foo-1.0.tar.gz")])
+
+    def test_fetch_all_skips_local_sources(self):
+        # foo-generated.patch is made by another rule, so its absence
+        # must not stop the remote sources being prefetched
+        self.fetch_all()
+
+        with open(os.path.join(self.sources, "foo-1.0.tar.gz")) as fetched:
+            with open(self.tarball) as upstream:
+                self.assertEqual(fetched.read(), upstream.read())
+        self.assertFalse(os.path.exists(
+            os.path.join(self.sources, "foo-generated.patch")))
+
+    def test_fetch_all_skips_unsupported_schemes(self):
+        # The git:// source does not stop the other sources being
+        # fetched, nor is it recorded in the lock file
+        lockfile = os.path.join(self.test_dir, "sources.lock")
+        self.fetch_all("--lockfile", lockfile, "--update-lockfile")
+
+        self.assertTrue(os.path.exists(
+            os.path.join(self.sources, "foo-1.0.tar.gz")))
+        with open(lockfile) as in_f:
+            self.assertEqual(list(json.load(in_f)),
+                             ["file://%s" % self.tarball])
+
+    def test_fetch_all_skips_present_sources(self):
+        present = os.path.join(self.sources, "foo-1.0.tar.gz")
+        shutil.copy(self.tarball, present)
+        os.utime(present, (0, 0))
+        self.fetch_all()
+
+        self.assertEqual(os.path.getmtime(present), 0)
+
+    def write_lockfile(self, digest):
+        lockfile = os.path.join(self.test_dir, "sources.lock")
+        with open(lockfile, "w") as out_f:
+            json.dump({"file://%s" % self.tarball: digest}, out_f)
+        return lockfile
+
+    def test_lockfile_is_enforced(self):
+        lockfile = self.write_lockfile("0" * 64)
+
+        self.assertRaises(SystemExit, self.fetch_all, "--lockfile", lockfile)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.sources, "foo-1.0.tar.gz")))
+
+    def test_spec_lockfile_in_spec_lock_dir(self):
+        # The spec is a copy of one in another directory, which holds
+        # its lock file
+        spec_dir = os.path.join(self.test_dir, "SPECS")
+        os.makedirs(spec_dir)
+        with open(os.path.join(spec_dir, "foo.lock"), "w") as out_f:
+            json.dump({"file://%s" % self.tarball: "0" * 64}, out_f)
+
+        self.assertRaises(SystemExit, self.fetch_all,
+                          "--spec-lock-dir", spec_dir)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.sources, "foo-1.0.tar.gz")))
+
+    def test_update_lockfile(self):
+        # The upstream tarball has changed since the lock was written
+        lockfile = self.write_lockfile("0" * 64)
+        self.fetch_all("--lockfile", lockfile, "--update-lockfile")
+
+        with open(self.tarball) as tarball:
+            digest = hashlib.sha256(tarball.read()).hexdigest()
+        with open(lockfile) as in_f:
+            self.assertEqual(json.load(in_f),
+                             {"file://%s" % self.tarball: digest})
+        # The relocked tree now fetches cleanly
+        os.unlink(os.path.join(self.sources, "foo-1.0.tar.gz"))
+        self.fetch_all("--lockfile", lockfile)
+
+
+class FetchServerTests(unittest.TestCase):
+    # unittest.TestCase has more methods than Pylint permits
+    # pylint: disable=R0904
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.test_dir)
+        self.upstream = os.path.join(self.test_dir, "foo.patch")
+        with open(self.upstream, "w") as out_f:
+            out_f.write("--- a\n")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.test_dir)
+
+    def request(self, *argv):
+        transfer = planex.transfer.Transfer(
+            urlparse.urlparse("file://%s" % self.upstream),
+            os.path.join("SOURCES", "foo.patch"), 1)
+        args = planex.fetch.parse_args_or_exit(
+            list(argv) + ["--all", "foo.spec"])
+        # Round trip through JSON, as the request would reach a server
+        return json.loads(json.dumps(
+            planex.fetch.fetch_request([transfer], args)))
+
+    def test_request_paths_are_absolute(self):
+        # The server runs in a different working directory
+        request = self.request("--store-dirs", "store:other",
+                               "--lock-dir", "locks",
+                               "--mirror", "http://mirror.example.com",
+                               "--mirror-stats", "stats")
+
+        self.assertEqual(request["store_dirs"],
+                         "%s/store:%s/other" % (self.test_dir, self.test_dir))
+        self.assertEqual(request["lock_dir"],
+                         os.path.join(self.test_dir, "locks"))
+        self.assertEqual(request["mirror_stats"],
+                         os.path.join(self.test_dir, "stats"))
+        self.assertEqual(request["transfers"][0]["filename"],
+                         os.path.join(self.test_dir, "SOURCES",
+                                      "foo.patch"))
+
+    def test_handle(self):
+        request = self.request("--store-dirs", "store", "--lock-dir", "locks")
+        os.chdir(self.cwd)
+        response = planex.fetch.FetchServer().handle(request)
+
+        self.assertEqual(response, {"failed": []})
+        with open(os.path.join(self.test_dir, "SOURCES",
+                               "foo.patch")) as in_f:
+            self.assertEqual(in_f.read(), "--- a\n")
@@ -0,0 +1,48 @@
+# Run these tests with 'nosetests':
+#   install the 'python-nose' package (Fedora/CentOS or Ubuntu)
+#   run 'nosetests' in the root of the repository
+
+import os
+import shutil
+import tempfile
+import unittest
+import urlparse
+
+import planex.mirrors
+
+
+class MirrorStatsTests(unittest.TestCase):
+    # unittest.TestCase has more methods than Pylint permits
+    # pylint: disable=R0904
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.test_dir, "stats")
+        self.fast = urlparse.urlparse("http://fast.example.com/foo.tar.gz")
+        self.slow = urlparse.urlparse("http://slow.example.com/foo.tar.gz")
+        self.down = urlparse.urlparse("http://down.example.com/foo.tar.gz")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_order(self):
+        stats = planex.mirrors.MirrorStats(self.path)
+        stats.record_success(self.slow, 1000.0)
+        stats.record_success(self.fast, 100000.0)
+        stats.record_success(self.down, 1000000.0)
+        stats.record_failure(self.down)
+
+        self.assertEqual(stats.order([self.down, self.slow, self.fast]),
+                         [self.fast, self.slow, self.down])
+
+    def test_save_merges_concurrent_results(self):
+        first = planex.mirrors.MirrorStats(self.path)
+        second = planex.mirrors.MirrorStats(self.path)
+        first.record_success(self.fast, 100000.0)
+        second.record_failure(self.down)
+        first.save()
+        second.save()
+
+        stats = planex.mirrors.MirrorStats(self.path)
+        self.assertEqual(stats.hosts["fast.example.com"]["speed"], 100000.0)
+        self.assertEqual(stats.hosts["down.example.com"]["failures"], 1)
@@ -0,0 +1,71 @@
+# Run these tests with 'nosetests':
+#   install the 'python-nose' package (Fedora/CentOS or Ubuntu)
+#   run 'nosetests' in the root of the repository
+
+import glob
+import os
+import unittest
+
+import planex.provides
+import planex.spec
+
+
+class ProvidesTests(unittest.TestCase):
+    # unittest.TestCase has more methods than Pylint permits
+    # pylint: disable=R0904
+
+    def setUp(self):
+        spec_paths = glob.glob(os.path.join("tests/data", "ocaml-*.spec"))
+        self.specs = [planex.spec.Spec(spec_path, defines=[('dist', '.el6')])
+                      for spec_path in spec_paths]
+        self.index = planex.provides.ProvidesIndex(self.specs)
+
+    def test_satisfies(self):
+        satisfies = planex.provides.satisfies
+        self.assertTrue(satisfies('', '', '>=', '2.0'))
+        self.assertTrue(satisfies('=', '1.6.0-1', '', ''))
+        self.assertTrue(satisfies('=', '1.6.0-1', '>=', '1.6'))
+        self.assertTrue(satisfies('=', '1.6.0-1', '=', '1.6.0'))
+        self.assertFalse(satisfies('=', '1.6.0-1', '>', '1.6.0'))
+        self.assertFalse(satisfies('=', '1.6.0-1', '<', '1:1.0'))
+
+    def test_subpackages_map_to_their_own_rpm(self):
+        provider = self.index.resolve('ocaml-uri')
+
+        self.assertEqual(provider.rpm_path.split('/')[-1][:13],
+                         'ocaml-uri-1.6')
+        self.assertEqual(provider.target.split('/')[-1][:19],
+                         'ocaml-uri-devel-1.6')
+        self.assertEqual(self.index['ocaml-uri'], provider.target)
+
+    def test_versioned_requirements(self):
+        self.assertIsNotNone(self.index.resolve('ocaml-uri-devel', '>=',
+                                                '1.5'))
+        self.assertTrue(self.index.unsatisfied_version('ocaml-uri-devel',
+                                                       '>=', '2.0'))
+        self.assertIsNone(self.index.resolve('ocaml-lwt-devel'))
+        self.assertNotIn('ocaml-lwt-devel', self.index)
+
+    def test_duplicate_providers(self):
+        self.assertEqual(self.index.duplicates(), {})
+
+        self.index.add_spec(planex.spec.Spec("tests/data/bad-name.spec",
+                                             check_package_name=False))
+        self.assertEqual(
+            self.index.duplicates()['ocaml-cohttp-devel'],
+            ['tests/data/bad-name.spec', 'tests/data/ocaml-cohttp.spec'])
+
+    def test_all_constraints_must_be_satisfied(self):
+        index = planex.provides.ProvidesIndex()
+        for evr in ['1.5', '2.1']:
+            index.providers.setdefault('foo', []).append(
+                planex.provides.Provider('=', evr, 'foo-%s.rpm' % evr,
+                                         'foo-%s.rpm' % evr, 'foo.spec'))
+        constraints = [('>=', '1'), ('<', '2')]
+
+        # The newer provider satisfies the first bound but not the second
+        self.assertEqual(index.resolve('foo', '>=', '1').evr, '2.1')
+        self.assertEqual(index.resolve_all('foo', constraints).evr, '1.5')
+        self.assertFalse(index.unsatisfied_versions('foo', constraints))
+        self.assertTrue(index.unsatisfied_versions(
+            'foo', [('>=', '2'), ('<', '2')]))
@@ -0,0 +1,97 @@
+# Run these tests with 'nosetests':
+#   install the 'python-nose' package (Fedora/CentOS or Ubuntu)
+#   run 'nosetests' in the root of the repository
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import planex.sourcestore
+
+
+class SourceStoreTests(unittest.TestCase):
+    # unittest.TestCase has more methods than Pylint permits
+    # pylint: disable=R0904
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.store_dir = os.path.join(self.test_dir, "store")
+        self.store = planex.sourcestore.SourceStore(self.store_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write_file(self, name, contents):
+        path = os.path.join(self.test_dir, name)
+        with open(path, "w") as out_f:
+            out_f.write(contents)
+        return path
+
+    def test_add_and_fetch(self):
+        url = "http://example.com/foo-1.0.tar.gz"
+        self.store.add(url, self.write_file("foo-1.0.tar.gz", "foo"))
+
+        dest = os.path.join(self.test_dir, "SOURCES", "foo", "foo-1.0.tar.gz")
+        self.assertTrue(self.store.fetch(url, dest))
+        with open(dest) as in_f:
+            self.assertEqual(in_f.read(), "foo")
+
+        self.assertIsNone(self.store.lookup("http://example.com/bar.tgz"))
+        self.assertFalse(self.store.fetch("http://example.com/bar.tgz",
+                                          dest + "~"))
+
+    def test_lookup_by_digest(self):
+        url = "http://example.com/foo-1.0.tar.gz"
+        self.store.add(url, self.write_file("foo-1.0.tar.gz", "foo"))
+        digest = ("2c26b46b68ffc68ff99b453c1d30413413422d706483bfa0f98a5e886"
+                  "266e7ae")
+
+        self.assertEqual(self.store.lookup("http://mirror/foo.tgz", digest),
+                         self.store.lookup(url))
+        self.assertIsNone(self.store.lookup(url, "0" * 64))
+
+    def test_search_path(self):
+        url = "http://example.com/foo-1.0.tar.gz"
+        self.store.add(url, self.write_file("foo-1.0.tar.gz", "foo"))
+
+        store = planex.sourcestore.SourceStore(
+            os.path.join(self.test_dir, "empty") + ":" + self.store_dir)
+        self.assertTrue(store.lookup(url).startswith(self.store_dir))
+
+    def test_evict_least_recently_used(self):
+        store = planex.sourcestore.SourceStore(self.store_dir, max_size=6)
+        store.add("http://example.com/old", self.write_file("old", "old"))
+        os.utime(store.lookup("http://example.com/old"), (0, 0))
+        store.add("http://example.com/new", self.write_file("new", "new!"))
+
+        self.assertIsNone(store.lookup("http://example.com/old"))
+        self.assertIsNotNone(store.lookup("http://example.com/new"))
+
+    def test_evict_skips_objects_being_written(self):
+        store = planex.sourcestore.SourceStore(self.store_dir, max_size=0)
+        partial = os.path.join(self.store_dir, "objects", "ab", "abcd.1.~")
+        os.makedirs(os.path.dirname(partial))
+        with open(partial, "w") as out_f:
+            out_f.write("partial")
+        store.evict()
+
+        self.assertTrue(os.path.exists(partial))
+
+    def test_fetched_files_do_not_share_timestamps(self):
+        url = "http://example.com/foo-1.0.tar.gz"
+        source = self.write_file("foo-1.0.tar.gz", "foo")
+        self.store.add(url, source)
+        stored = self.store.lookup(url)
+        self.assertFalse(os.path.samefile(source, stored))
+
+        dest = os.path.join(self.test_dir, "SOURCES", "foo-1.0.tar.gz")
+        other = os.path.join(self.test_dir, "other", "foo-1.0.tar.gz")
+        self.store.fetch(url, dest)
+        self.store.fetch(url, other)
+        os.utime(other, (0, 0))
+
+        self.assertFalse(os.path.samefile(dest, stored))
+        self.assertFalse(os.path.samefile(dest, other))
+        self.assertNotEqual(os.path.getmtime(dest), 0)
+        self.assertNotEqual(os.path.getmtime(stored), 0)
@@ -82,3 +82,28 @@ class RpmTests(unittest.TestCase):
                     "ocaml-cohttp-devel-0.9.8-1.el6.{machine}.rpm"])
             ]
         )
+
+    def test_package_paths_are_memoized(self):
+        paths = self.spec.package_paths()
+        self.spec.binary_package_paths().append("modified")
+
+        self.assertIs(self.spec.package_paths(), paths)
+        self.assertEqual(self.spec.binary_package_paths(), paths.rpms)
+        self.assertEqual(len(paths.rpms), 2)
+
+    def test_compile_name_format(self):
+        self.assertEqual(
+            planex.spec.compile_name_format(
+                "%{ARCH}/%{NAME}-%{VERSION}-%{RELEASE}.%{ARCH}.rpm"),
+            "%(ARCH)s/%(NAME)s-%(VERSION)s-%(RELEASE)s.%(ARCH)s.rpm")
+        self.assertEqual(planex.spec.compile_name_format("%NAME-100%%.rpm"),
+                         "%(NAME)s-100%%.rpm")
+        self.assertIsNone(
+            planex.spec.compile_name_format("%{NAME}%{?dist}.rpm"))
+
+    def test_package_file_name(self):
+        self.assertEqual(
+            planex.spec.package_file_name(
+                "%{ARCH}/%{NAME}-%{VERSION}-%{RELEASE}.%{ARCH}.rpm",
+                "ocaml-uri", "1.6.0", "1.el6", "x86_64"),
+            "x86_64/ocaml-uri-1.6.0-1.el6.x86_64.rpm")
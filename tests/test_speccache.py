@@ -0,0 +1,148 @@
+# Run these tests with 'nosetests':
+#   install the 'python-nose' package (Fedora/CentOS or Ubuntu)
+#   run 'nosetests' in the root of the repository
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import planex.spec
+import planex.speccache
+
+
+class SpecCacheTests(unittest.TestCase):
+    # unittest.TestCase has more methods than Pylint permits
+    # pylint: disable=R0904
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = planex.speccache.SpecCache(self.cache_dir)
+        self.rpm_defines = [("dist", ".el6"),
+                            ("_topdir", "."),
+                            ("_sourcedir", "%_topdir/SOURCES/%name")]
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def load(self, path="tests/data/ocaml-cohttp.spec", defines=None):
+        return self.cache.load(path, defines=defines or self.rpm_defines)
+
+    def test_summary_matches_spec(self):
+        spec = planex.spec.Spec("tests/data/ocaml-cohttp.spec",
+                                defines=self.rpm_defines)
+        summary = self.load()
+
+        self.assertEqual(summary.name(), spec.name())
+        self.assertEqual(summary.version(), spec.version())
+        self.assertEqual(summary.provides(), spec.provides())
+        self.assertEqual(summary.buildrequires(), spec.buildrequires())
+        self.assertEqual(summary.source_paths(), spec.source_paths())
+        self.assertEqual(summary.source_package_path(),
+                         spec.source_package_path())
+        self.assertEqual(summary.binary_package_paths(),
+                         spec.binary_package_paths())
+
+    def test_second_load_is_a_hit(self):
+        first = self.load()
+        second = self.load()
+
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(first.to_dict(), second.to_dict())
+        self.assertIsInstance(second.name(), str)
+
+    def test_macros_are_part_of_the_key(self):
+        self.load()
+        summary = self.load(defines=[("dist", ".el7")] + self.rpm_defines[1:])
+
+        self.assertEqual(self.cache.misses, 2)
+        self.assertEqual(summary.source_package_path(),
+                         "./SRPMS/ocaml-cohttp-0.9.8-1.el7.src.rpm")
+
+    def test_name_checked_on_hit(self):
+        bad_name = os.path.join(self.cache_dir, "bad-name.spec")
+        shutil.copy("tests/data/bad-name.spec", bad_name)
+        self.cache.load(bad_name, check_package_name=False)
+
+        self.assertRaises(planex.spec.SpecNameMismatch,
+                          self.cache.load, bad_name)
+
+    def test_edited_spec_is_reparsed(self):
+        spec_path = os.path.join(self.cache_dir, "ocaml-cohttp.spec")
+        shutil.copy("tests/data/ocaml-cohttp.spec", spec_path)
+        self.load(spec_path)
+        self.load(spec_path)
+
+        with open(spec_path) as spec:
+            spectext = spec.read()
+        with open(spec_path, "w") as spec:
+            spec.write(spectext.replace("0.9.8", "0.9.9"))
+        summary = self.load(spec_path)
+
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+        self.assertEqual(summary.version(), "0.9.9")
+
+    def test_same_size_edit_in_same_tick_is_reparsed(self):
+        spec_path = os.path.join(self.cache_dir, "ocaml-cohttp.spec")
+        shutil.copy("tests/data/ocaml-cohttp.spec", spec_path)
+        stat = os.stat(spec_path)
+        self.load(spec_path)
+
+        # Rewrite the spec in place without changing its size, inode or
+        # modification time, as an edit within one mtime tick would
+        with open(spec_path) as spec:
+            spectext = spec.read()
+        with open(spec_path, "w") as spec:
+            spec.write(spectext.replace("0.9.8", "0.9.9"))
+        os.utime(spec_path, (stat.st_atime, stat.st_mtime))
+        summary = self.load(spec_path)
+
+        self.assertEqual(self.cache.misses, 2)
+        self.assertEqual(summary.version(), "0.9.9")
+
+    def test_old_unchanged_spec_is_not_reread(self):
+        spec_path = os.path.join(self.cache_dir, "ocaml-cohttp.spec")
+        shutil.copy("tests/data/ocaml-cohttp.spec", spec_path)
+        old = os.stat(spec_path).st_mtime - 60
+        os.utime(spec_path, (old, old))
+        first = self.load(spec_path)
+
+        with open(spec_path) as spec:
+            key = planex.speccache.cache_key(spec_path, spec.read(),
+                                             self.rpm_defines)
+        self.assertEqual(
+            self.cache.unchanged_key(spec_path, self.rpm_defines), key)
+        self.assertEqual(self.load(spec_path).to_dict(), first.to_dict())
+
+    def test_stat_index_depends_on_rpm_version(self):
+        spec_path = os.path.join(self.cache_dir, "ocaml-cohttp.spec")
+        shutil.copy("tests/data/ocaml-cohttp.spec", spec_path)
+        old = os.stat(spec_path).st_mtime - 60
+        os.utime(spec_path, (old, old))
+        self.cache.load(spec_path, defines=self.rpm_defines, fast_scan=True)
+        self.assertIsNotNone(self.cache.unchanged_key(
+            spec_path, self.rpm_defines, fast_scan=True))
+
+        rpm_version = planex.speccache.rpm.__version__
+        salt = planex.speccache.SPEC_CACHE_SALT
+        try:
+            planex.speccache.rpm.__version__ = "upgraded"
+            self.assertIsNone(self.cache.unchanged_key(
+                spec_path, self.rpm_defines, fast_scan=True))
+            planex.speccache.rpm.__version__ = rpm_version
+            planex.speccache.SPEC_CACHE_SALT = "new-format"
+            self.assertIsNone(self.cache.unchanged_key(
+                spec_path, self.rpm_defines, fast_scan=True))
+        finally:
+            planex.speccache.rpm.__version__ = rpm_version
+            planex.speccache.SPEC_CACHE_SALT = salt
+
+    def test_parse_mode_is_part_of_the_key(self):
+        spec_path = "tests/data/ocaml-cohttp.spec"
+        self.cache.load(spec_path, defines=self.rpm_defines, fast_scan=True)
+        self.load(spec_path)
+
+        self.assertEqual(self.cache.misses, 2)
+        self.assertNotEqual(
+            planex.speccache.cache_key(spec_path, "", None, fast_scan=True),
+            planex.speccache.cache_key(spec_path, "", None))
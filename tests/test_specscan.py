@@ -0,0 +1,84 @@
+# Run these tests with 'nosetests':
+#   install the 'python-nose' package (Fedora/CentOS or Ubuntu)
+#   run 'nosetests' in the root of the repository
+
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+
+import planex.spec
+import planex.pin
+import planex.specscan
+
+
+class SpecScanTests(unittest.TestCase):
+    # unittest.TestCase has more methods than Pylint permits
+    # pylint: disable=R0904
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.rpm_defines = [("dist", ".el6"),
+                            ("_topdir", "."),
+                            ("_sourcedir", "%_topdir/SOURCES/%name")]
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write_spec(self, name, text):
+        path = os.path.join(self.test_dir, name + ".spec")
+        with open(path, "w") as spec:
+            spec.write(text)
+        return path
+
+    def test_scan_matches_librpm(self):
+        for path in glob.glob(os.path.join("tests/data", "ocaml-*.spec")):
+            spec = planex.spec.Spec(path, defines=self.rpm_defines)
+            summary = planex.specscan.scan(path, defines=self.rpm_defines)
+
+            self.assertEqual(summary.to_dict(),
+                             planex.spec.SpecSummary.of_spec(spec).to_dict())
+
+    def test_scan_checks_name(self):
+        self.assertRaises(planex.spec.SpecNameMismatch,
+                          planex.specscan.scan, "tests/data/bad-name.spec")
+
+    def test_conditionals_fall_back(self):
+        path = self.write_spec("cond", "%global debug_package %{nil}\n"
+                               "Name: cond\nVersion: 1\nRelease: 1\n"
+                               "%if 0%{?rhel}\nBuildRequires: foo\n%endif\n")
+
+        self.assertRaises(planex.specscan.ScanFallback,
+                          planex.specscan.scan, path)
+
+    def test_unknown_macros_fall_back(self):
+        path = self.write_spec("unknown", "%global debug_package %{nil}\n"
+                               "Name: unknown\nVersion: %{_libdir}\n"
+                               "Release: 1\n")
+
+        self.assertRaises(planex.specscan.ScanFallback,
+                          planex.specscan.scan, path)
+
+    def test_fallback_is_counted(self):
+        path = self.write_spec("debuginfo", "Name: debuginfo\nVersion: 1\n"
+                               "Release: 1\nSummary: x\nLicense: x\n"
+                               "%description\nx\n%files\n")
+        fallbacks = planex.specscan.STATS['fallback']
+
+        summary = planex.specscan.load(path, defines=self.rpm_defines)
+
+        self.assertEqual(summary.name(), "debuginfo")
+        self.assertEqual(planex.specscan.STATS['fallback'], fallbacks + 1)
+
+    def test_parse_dependencies(self):
+        self.assertEqual(
+            planex.specscan.parse_dependencies("a >= 1.0, b c = 2:3-4 d"),
+            [("a", ">=", "1.0"), ("b", "", ""), ("c", "=", "2:3-4"),
+             ("d", "", "")])
+
+    def test_pin_version_lookup_is_counted(self):
+        scanned = planex.specscan.STATS['scanned']
+        self.assertEqual(planex.pin.version_of_spec_file(
+            "tests/data/ocaml-cohttp.spec"), "0.9.8")
+        self.assertEqual(planex.specscan.STATS['scanned'], scanned + 1)
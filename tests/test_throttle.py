@@ -0,0 +1,54 @@
+# Run these tests with 'nosetests':
+#   install the 'python-nose' package (Fedora/CentOS or Ubuntu)
+#   run 'nosetests' in the root of the repository
+
+import shutil
+import tempfile
+import unittest
+
+import planex.throttle
+
+
+class ThrottleTests(unittest.TestCase):
+    # unittest.TestCase has more methods than Pylint permits
+    # pylint: disable=R0904
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_host_slots(self):
+        throttle = planex.throttle.Throttle(self.test_dir, 2)
+        first = throttle.acquire("example.com")
+        second = throttle.acquire("example.com")
+
+        self.assertIsNotNone(first)
+        self.assertIsNotNone(second)
+        self.assertIsNone(throttle.acquire("example.com"))
+        self.assertIsNotNone(throttle.acquire("example.org"))
+
+        throttle.release(first)
+        self.assertIsNotNone(throttle.acquire("example.com"))
+
+    def test_consume(self):
+        batch = planex.throttle.BUCKET_BATCH
+        throttle = planex.throttle.Throttle(self.test_dir, 1, batch * 2)
+
+        self.assertEqual(planex.throttle.Throttle(self.test_dir, 1).consume(
+            batch * 10), 0)
+        # The bucket starts with a second's worth of bandwidth
+        self.assertEqual(throttle.consume(batch * 2), 0)
+        delay = throttle.consume(batch)
+        self.assertTrue(0.4 < delay <= 0.5)
+
+    def test_backoff_delay(self):
+        for attempt in range(1, 10):
+            delay = planex.throttle.backoff_delay(attempt)
+            self.assertTrue(0 <= delay <= min(planex.throttle.BACKOFF_MAX,
+                                              2 ** (attempt - 1)))
+
+        self.assertGreaterEqual(planex.throttle.backoff_delay(1, "30"), 30)
+        self.assertLessEqual(planex.throttle.backoff_delay(
+            1, "Wed, 21 Oct 2015 07:28:00 GMT"), 1)
@@ -0,0 +1,441 @@
+# Run these tests with 'nosetests':
+#   install the 'python-nose' package (Fedora/CentOS or Ubuntu)
+#   run 'nosetests' in the root of the repository
+
+import BaseHTTPServer
+import bz2
+import hashlib
+import os
+import shutil
+import SocketServer
+import StringIO
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+import urlparse
+import zipfile
+import zlib
+
+import planex.mirrors
+import planex.sourcestore
+import planex.throttle
+import planex.transfer
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves the files in server.files, a dictionary mapping paths to
+    their contents, recording every request in server.requests.
+    Responses queued in server.errors[path] are sent, in order, before
+    the file itself is: a status code, or "truncate" to send the first
+    half of the file and drop the connection.   Files are served with
+    an ETag derived from their contents, and conditional and range
+    requests are honoured.
+    """
+
+    def do_GET(self):
+        # pylint: disable=C0103
+        self.server.requests.append((self.path, dict(self.headers)))
+        errors = self.server.errors.get(self.path)
+        error = errors.pop(0) if errors else None
+        if isinstance(error, int):
+            self.send_response(error)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if self.path not in self.server.files:
+            self.send_error(404)
+            return
+
+        body = self.server.files[self.path]
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        start = 0
+        byte_range = self.headers.get("Range")
+        if byte_range and self.headers.get("If-Range", etag) == etag:
+            start = int(byte_range.split("=")[1].split("-")[0])
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" %
+                             (start, len(body) - 1, len(body)))
+        else:
+            self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body) - start))
+        self.end_headers()
+        if error == "truncate":
+            self.wfile.write(body[start:len(body) // 2])
+            self.close_connection = 1
+        else:
+            self.wfile.write(body[start:])
+
+    def log_message(self, *_):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A local HTTP server, run in a background thread"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), Handler)
+        self.files = {}
+        self.errors = {}
+        self.requests = []
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        """Return the parsed URL of path on the server"""
+        return urlparse.urlparse("http://127.0.0.1:%d%s" %
+                                 (self.server_address[1], path))
+
+    def stop(self):
+        """Stop serving"""
+        self.shutdown()
+        self.server_close()
+
+
+def tar_archive():
+    """Return a POSIX (ustar) tar archive holding one file"""
+    archive = StringIO.StringIO()
+    tar = tarfile.open(fileobj=archive, mode="w",
+                       format=tarfile.USTAR_FORMAT)
+    info = tarfile.TarInfo("foo-1.0/README")
+    info.size = 6
+    tar.addfile(info, StringIO.StringIO("hello\n"))
+    tar.close()
+    return archive.getvalue()
+
+
+def v7_tar_archive():
+    """Return a pre-POSIX tar archive, whose header has no ustar magic"""
+    data = tar_archive()
+    header = data[:257] + "\0" * (512 - 257)
+    header = header[:148] + " " * 8 + header[156:]
+    checksum = "%06o\0 " % sum(ord(char) for char in header)
+    return header[:148] + checksum + header[156:] + data[512:]
+
+
+def gzip_data(data):
+    """Return data compressed in gzip format"""
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def zip_archive():
+    """Return a zip archive holding one file"""
+    archive = StringIO.StringIO()
+    zipped = zipfile.ZipFile(archive, "w")
+    zipped.writestr("foo-1.0/README", "hello\n")
+    zipped.close()
+    return archive.getvalue()
+
+
+class SniffTests(unittest.TestCase):
+    # unittest.TestCase has more methods than Pylint permits
+    # pylint: disable=R0904
+
+    def assert_accepted(self, ext, data):
+        self.assertIsNone(planex.transfer.format_matches(ext, data))
+
+    def test_archives_are_accepted(self):
+        self.assert_accepted(".tar", tar_archive())
+        self.assert_accepted(".tar", v7_tar_archive())
+        self.assert_accepted(".gz", gzip_data(tar_archive()))
+        self.assert_accepted(".tgz", gzip_data(tar_archive()))
+        self.assert_accepted(".bz2", bz2.compress(tar_archive()))
+        self.assert_accepted(".xz", "\xfd7zXZ\x00\x00\x04" + "\0" * 100)
+        self.assert_accepted(".zip", zip_archive())
+
+    def test_text_formats_are_accepted(self):
+        self.assert_accepted(".patch", "--- a/foo\n+++ b/foo\n@@ -1 +1 @@\n")
+        self.assert_accepted(".patch", "Fix the frobnicator\n\n"
+                             "diff --git a/foo b/foo\n")
+        self.assert_accepted(".patch", "A description only\n")
+        self.assert_accepted(".unknown", "<html></html>")
+
+    def test_error_pages_are_rejected(self):
+        page = "<!DOCTYPE html>\n<html><body>Not found</body></html>\n"
+        for ext in [".tar", ".gz", ".bz2", ".xz", ".zip", ".patch"]:
+            self.assertEqual(planex.transfer.format_matches(ext, page),
+                             "text/html")
+
+    def test_wrong_formats_are_rejected(self):
+        self.assertEqual(planex.transfer.format_matches(
+            ".gz", bz2.compress(tar_archive())), "application/x-bzip2")
+        self.assertEqual(planex.transfer.format_matches(
+            ".tar", gzip_data(tar_archive())), "application/x-gzip")
+        self.assertEqual(planex.transfer.format_matches(
+            ".zip", "\x00\x01\x02" * 200), "unknown")
+
+    def test_corrupt_tar_header_is_rejected(self):
+        data = v7_tar_archive()
+        corrupt = data[:10] + "X" + data[11:]
+        self.assertFalse(planex.transfer.is_tar_header(corrupt))
+        self.assertEqual(planex.transfer.format_matches(".tar", corrupt),
+                         "unknown")
+        self.assertFalse(planex.transfer.is_tar_header("\0" * 1024))
+        self.assertFalse(planex.transfer.is_tar_header(data[:100]))
+
+    def test_best_effort_file_verify(self):
+        test_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(test_dir, "foo-1.0.tar.gz~")
+            with open(path, "w") as out_f:
+                out_f.write("<html></html>")
+            self.assertRaises(SystemExit,
+                              planex.transfer.best_effort_file_verify, path,
+                              "foo-1.0.tar.gz")
+            # Without the real name, the extension is not recognised
+            planex.transfer.best_effort_file_verify(path)
+        finally:
+            shutil.rmtree(test_dir)
+
+
+class TransferTests(unittest.TestCase):
+    # unittest.TestCase has more methods than Pylint permits
+    # pylint: disable=R0904
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.server = Server()
+        # Keep the backoff between retries short
+        self.backoff_base = planex.throttle.BACKOFF_BASE
+        planex.throttle.BACKOFF_BASE = 0.01
+        self.bucket_batch = planex.throttle.BUCKET_BATCH
+
+    def tearDown(self):
+        planex.throttle.BACKOFF_BASE = self.backoff_base
+        planex.throttle.BUCKET_BATCH = self.bucket_batch
+        self.server.stop()
+        shutil.rmtree(self.test_dir)
+
+    def transfer(self, path, retries=1, **kwargs):
+        return planex.transfer.Transfer(
+            self.server.url(path),
+            os.path.join(self.test_dir, "SOURCES", os.path.basename(path)),
+            retries, **kwargs)
+
+    def read(self, transfer):
+        with open(transfer.filename) as in_f:
+            return in_f.read()
+
+    def test_fetch_all(self):
+        for name in ["a.patch", "b.patch", "c.patch"]:
+            self.server.files["/" + name] = "--- %s\n+++ %s\n" % (name, name)
+        transfers = [self.transfer("/" + name)
+                     for name in ["a.patch", "b.patch", "c.patch"]]
+
+        self.assertEqual(planex.transfer.fetch_all(transfers, parallel=2),
+                         [])
+        for transfer in transfers:
+            self.assertEqual(self.read(transfer),
+                             self.server.files[transfer.url.path])
+            self.assertFalse(os.path.exists(transfer.tmp_filename))
+
+    def test_failed_transfers_are_returned(self):
+        self.server.files["/a.patch"] = "--- a\n"
+        good = self.transfer("/a.patch")
+        missing = self.transfer("/missing.patch")
+
+        self.assertEqual(planex.transfer.fetch_all([good, missing], 2),
+                         [missing])
+        self.assertEqual(missing.error.args[0],
+                         planex.transfer.pycurl.E_HTTP_RETURNED_ERROR)
+        self.assertFalse(os.path.exists(missing.filename))
+        self.assertEqual(self.read(good), "--- a\n")
+
+    def test_copies_are_made(self):
+        self.server.files["/a.patch"] = "--- a\n"
+        transfer = self.transfer("/a.patch")
+        copy = os.path.join(self.test_dir, "other", "a.patch")
+        os.makedirs(os.path.dirname(copy))
+        transfer.copies.append(copy)
+
+        self.assertEqual(planex.transfer.fetch_all([transfer]), [])
+        with open(copy) as in_f:
+            self.assertEqual(in_f.read(), "--- a\n")
+
+    def test_handles_are_reused_from_pool(self):
+        self.server.files["/a.patch"] = "--- a\n"
+        pool = planex.transfer.CurlPool()
+        try:
+            planex.transfer.fetch_all([self.transfer("/a.patch")], 1, pool)
+            self.assertEqual(len(pool.idle), 1)
+            curl = pool.idle[0]
+            planex.transfer.fetch_all([self.transfer("/a.patch")], 1, pool)
+            self.assertEqual(pool.idle, [curl])
+        finally:
+            pool.close()
+
+    def test_dict_round_trip(self):
+        transfer = self.transfer("/a.patch", retries=3,
+                                 expected_sha256="abc",
+                                 mirrors=[self.server.url("/m/a.patch")])
+        transfer.copies.append("copy.patch")
+        copy = planex.transfer.Transfer.from_dict(transfer.to_dict(),
+                                                  None, None)
+
+        self.assertEqual(copy.candidates, transfer.candidates)
+        self.assertEqual(copy.filename, transfer.filename)
+        self.assertEqual(copy.retries, 3)
+        self.assertEqual(copy.expected_sha256, "abc")
+        self.assertEqual(copy.copies, [os.path.abspath("copy.patch")])
+
+    def test_not_modified(self):
+        self.server.files["/a.patch"] = "--- a\n"
+        transfer = self.transfer("/a.patch")
+        planex.transfer.fetch_all([transfer])
+        os.utime(transfer.filename, (0, 0))
+
+        self.assertEqual(planex.transfer.fetch_all([self.transfer(
+            "/a.patch")]), [])
+        self.assertIn("if-none-match", self.server.requests[-1][1])
+        self.assertEqual(self.read(transfer), "--- a\n")
+        self.assertNotEqual(os.path.getmtime(transfer.filename), 0)
+
+    def test_not_modified_file_is_verified(self):
+        self.server.files["/a.patch"] = "--- a\n"
+        digest = hashlib.sha256("--- a\n").hexdigest()
+        transfer = self.transfer("/a.patch", expected_sha256=digest)
+        planex.transfer.fetch_all([transfer])
+        with open(transfer.filename, "w") as out_f:
+            out_f.write("--- b\n")
+
+        self.assertEqual(planex.transfer.fetch_all([self.transfer(
+            "/a.patch", expected_sha256=digest)]), [])
+        self.assertEqual(self.read(transfer), "--- a\n")
+        # The corrupt file was fetched again, unconditionally
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertNotIn("if-none-match", self.server.requests[-1][1])
+
+    def test_not_modified_file_is_stored(self):
+        self.server.files["/a.patch"] = "--- a\n"
+        planex.transfer.fetch_all([self.transfer("/a.patch")])
+        store = planex.sourcestore.SourceStore(
+            os.path.join(self.test_dir, "store"))
+        transfer = self.transfer("/a.patch", store=store)
+
+        self.assertEqual(planex.transfer.fetch_all([transfer]), [])
+        self.assertIn("if-none-match", self.server.requests[-1][1])
+        self.assertIsNotNone(store.lookup(transfer.url_string))
+
+    def test_resume(self):
+        body = "--- a\n" + "+" * 1000 + "\n"
+        self.server.files["/a.patch"] = body
+        self.server.errors["/a.patch"] = ["truncate"]
+        transfer = self.transfer("/a.patch", retries=2)
+
+        self.assertEqual(planex.transfer.fetch_all([transfer]), [])
+        self.assertEqual(self.read(transfer), body)
+        self.assertEqual(self.server.requests[-1][1]["range"],
+                         "bytes=%d-" % (len(body) // 2))
+        self.assertEqual(transfer.sha256.hexdigest(),
+                         hashlib.sha256(body).hexdigest())
+
+    def test_resume_refused(self):
+        body = "--- a\n" + "+" * 1000 + "\n"
+        self.server.files["/a.patch"] = body
+        self.server.errors["/a.patch"] = ["truncate", 416]
+        # Falling back to a full download does not use up a retry
+        transfer = self.transfer("/a.patch", retries=2)
+
+        self.assertEqual(planex.transfer.fetch_all([transfer]), [])
+        self.assertEqual(self.read(transfer), body)
+        self.assertNotIn("range", self.server.requests[-1][1])
+
+    def test_resume_retried_after_server_error(self):
+        body = "--- a\n" + "+" * 1000 + "\n"
+        self.server.files["/a.patch"] = body
+        self.server.errors["/a.patch"] = ["truncate", 503]
+        transfer = self.transfer("/a.patch", retries=3)
+
+        self.assertEqual(planex.transfer.fetch_all([transfer]), [])
+        self.assertEqual(self.read(transfer), body)
+        # The partial download survived the 503
+        self.assertEqual(self.server.requests[-1][1]["range"],
+                         "bytes=%d-" % (len(body) // 2))
+
+    def test_retries_are_limited(self):
+        self.server.files["/a.patch"] = "--- a\n"
+        self.server.errors["/a.patch"] = [503, 503, 503]
+        transfer = self.transfer("/a.patch", retries=2)
+
+        self.assertEqual(planex.transfer.fetch_all([transfer]), [transfer])
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_error_page_is_abandoned(self):
+        page = "<html>" + " " * planex.transfer.SNIFF_SIZE * 4 + "</html>"
+        self.server.files["/foo-1.0.tar.gz"] = page
+        transfer = self.transfer("/foo-1.0.tar.gz", retries=3)
+
+        self.assertEqual(planex.transfer.fetch_all([transfer]), [transfer])
+        self.assertIn("format looks incorrect", transfer.error.args[1])
+        # A bad format is not retried
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertFalse(os.path.exists(transfer.filename))
+
+    def test_corrupt_mirror_falls_back(self):
+        self.server.files["/m/a.patch"] = "--- corrupt\n"
+        self.server.files["/a.patch"] = "--- a\n"
+        mirror = self.server.url("/m/a.patch")._replace(
+            netloc="localhost:%d" % self.server.server_address[1])
+        stats = planex.mirrors.MirrorStats(None)
+        transfer = self.transfer(
+            "/a.patch", mirrors=[mirror], stats=stats,
+            expected_sha256=hashlib.sha256("--- a\n").hexdigest())
+
+        self.assertEqual(planex.transfer.fetch_all([transfer]), [])
+        self.assertEqual(self.read(transfer), "--- a\n")
+        self.assertEqual(stats.updates[planex.mirrors.host_of(mirror)],
+                         [None])
+        self.assertEqual(len(stats.updates[planex.mirrors.host_of(
+            transfer.url)]), 1)
+
+    def test_checksum_mismatch_on_every_candidate_exits(self):
+        self.server.files["/m/a.patch"] = "--- corrupt\n"
+        self.server.files["/a.patch"] = "--- also corrupt\n"
+        transfer = self.transfer(
+            "/a.patch", mirrors=[self.server.url("/m/a.patch")],
+            expected_sha256=hashlib.sha256("--- a\n").hexdigest())
+
+        self.assertRaises(SystemExit, planex.transfer.fetch_all, [transfer])
+        self.assertEqual([request[0] for request in self.server.requests],
+                         ["/m/a.patch", "/a.patch"])
+        self.assertFalse(os.path.exists(transfer.filename))
+
+    def test_bandwidth_limit_pauses_transfers(self):
+        planex.throttle.BUCKET_BATCH = 4096
+        for name in ["a.patch", "b.patch"]:
+            self.server.files["/" + name] = "".join(
+                "+%s line %d\n" % (name, i) for i in range(4096))
+        transfers = [self.transfer("/a.patch"), self.transfer("/b.patch")]
+        total = sum(len(data) for data in self.server.files.values())
+        bandwidth = total * 2 / 3
+        throttle = planex.throttle.Throttle(
+            os.path.join(self.test_dir, "locks"), 2, bandwidth)
+
+        start = time.time()
+        self.assertEqual(planex.transfer.fetch_all(transfers, 2,
+                                                   throttle=throttle), [])
+        # The bucket starts with a second's worth, so the rest takes
+        # at least half a second; data passed again after a pause must
+        # only be written once
+        self.assertGreaterEqual(time.time() - start, 0.4)
+        for transfer in transfers:
+            self.assertEqual(self.read(transfer),
+                             self.server.files[transfer.url.path])
@@ -0,0 +1,137 @@
+# Run these tests with 'nosetests':
+#   install the 'python-nose' package (Fedora/CentOS or Ubuntu)
+#   run 'nosetests' in the root of the repository
+
+import json
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import threading
+import unittest
+
+import planex.util
+
+
+class UnixSocketTests(unittest.TestCase):
+    # unittest.TestCase has more methods than Pylint permits
+    # pylint: disable=R0904
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.test_dir, "socket")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_socket_is_private(self):
+        old_umask = os.umask(0)
+        try:
+            server = planex.util.listen_unix_socket(self.path)
+        finally:
+            os.umask(old_umask)
+        server.close()
+
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0600)
+
+    def test_stale_socket_is_replaced(self):
+        planex.util.listen_unix_socket(self.path).close()
+        server = planex.util.listen_unix_socket(self.path)
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(self.path)
+        client.close()
+        server.close()
+
+    def test_live_server_is_not_replaced(self):
+        server = planex.util.listen_unix_socket(self.path)
+        try:
+            self.assertRaises(socket.error, planex.util.listen_unix_socket,
+                              self.path)
+            self.assertTrue(os.path.exists(self.path))
+        finally:
+            server.close()
+
+    def test_peer_uid(self):
+        (conn, client) = socket.socketpair(socket.AF_UNIX,
+                                           socket.SOCK_STREAM)
+        self.assertEqual(planex.util.peer_uid(conn), os.geteuid())
+        conn.close()
+        client.close()
+
+    def test_handle_connection(self):
+        (conn, client) = socket.socketpair(socket.AF_UNIX,
+                                           socket.SOCK_STREAM)
+        client.sendall(json.dumps({"n": 1}) + "\n")
+        planex.util.handle_unix_connection(conn,
+                                           lambda req: {"n": req["n"] + 1})
+
+        self.assertEqual(json.loads(client.makefile('r').readline()),
+                         {"n": 2})
+        client.close()
+
+    def test_handler_errors_are_reported(self):
+        (conn, client) = socket.socketpair(socket.AF_UNIX,
+                                           socket.SOCK_STREAM)
+        client.sendall(json.dumps({}) + "\n")
+        planex.util.handle_unix_connection(conn, lambda req: req["n"])
+
+        self.assertEqual(json.loads(client.makefile('r').readline()),
+                         {"error": "'n'"})
+        client.close()
+
+
+class CloneFileTests(unittest.TestCase):
+    # unittest.TestCase has more methods than Pylint permits
+    # pylint: disable=R0904
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.dst = os.path.join(self.test_dir, "out", "object")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write_file(self, name, contents):
+        path = os.path.join(self.test_dir, name)
+        with open(path, "w") as out_f:
+            out_f.write(contents)
+        return path
+
+    def test_clone_file(self):
+        src = self.write_file("src", "contents")
+        for link in [True, False]:
+            method = planex.util.clone_file(src, self.dst, link=link)
+            with open(self.dst) as in_f:
+                self.assertEqual(in_f.read(), "contents")
+            self.assertEqual(os.path.samefile(src, self.dst), link)
+            self.assertEqual(method == "link", link)
+        self.assertEqual(os.listdir(os.path.dirname(self.dst)), ["object"])
+
+    def test_others_temporary_files_are_left_alone(self):
+        src = self.write_file("src", "contents")
+        os.makedirs(os.path.dirname(self.dst))
+        other = "%s.%d~" % (self.dst, os.getpid())
+        with open(other, "w") as out_f:
+            out_f.write("partial")
+
+        planex.util.clone_file(src, self.dst, link=False)
+        with open(other) as in_f:
+            self.assertEqual(in_f.read(), "partial")
+
+    def test_concurrent_clones(self):
+        contents = ["%d" % i * 100000 for i in range(8)]
+        srcs = [self.write_file("src%d" % i, data)
+                for (i, data) in enumerate(contents)]
+        threads = [threading.Thread(target=planex.util.clone_file,
+                                    args=(src, self.dst, False))
+                   for src in srcs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        with open(self.dst) as in_f:
+            self.assertIn(in_f.read(), contents)
+        self.assertEqual(os.listdir(os.path.dirname(self.dst)), ["object"])